@@ -1,5 +1,122 @@
 from django.contrib import admin
-from .models import PatientProfile, Invoice, InvoiceLineItem, LabTest, DoctorVisit
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .models import (
+    ArchivedDoctorVisit, ArchivedLabTest, DoctorVisit, Invoice, InvoiceLineItem, Job, LabTest, PatientProfile,
+)
+
+# Below this many rows an exact COUNT(*) is cheap and worth the accuracy
+EXACT_COUNT_THRESHOLD = 10_000
+# Patients whose username matches a search prefix, at most
+PATIENT_SEARCH_LIMIT = 500
+
+
+def estimate_count(queryset):
+    """
+    Row count from planner statistics, or None when the database has none.
+    PostgreSQL: pg_class.reltuples for a whole table, the EXPLAIN row estimate
+    for a filtered queryset. SQLite: sqlite_stat1 (filled by ANALYZE), whole
+    tables only.
+    """
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    unfiltered = not queryset.query.where
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            if unfiltered:
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+                row = cursor.fetchone()
+                # -1 means the table was never analyzed
+                return row[0] if row and row[0] >= 0 else None
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+            return int(plan[0]['Plan']['Plan Rows'])
+        if connection.vendor == 'sqlite' and unfiltered:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+            row = cursor.fetchone()
+            return int(row[0].split()[0]) if row else None
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """Uses the planner's estimate instead of COUNT(*) once a result set is large"""
+
+    @cached_property
+    def count(self):
+        estimate = estimate_count(self.object_list)
+        if estimate is None or estimate < EXACT_COUNT_THRESHOLD:
+            return super().count
+        return estimate
+
+
+def cached_values_filter(field_name, title, timeout=3600):
+    """
+    List filter over a column's distinct values, cached so the changelist
+    doesn't scan the whole table for them on every page view.
+    """
+
+    class CachedValuesFilter(admin.SimpleListFilter):
+        parameter_name = field_name
+
+        def lookups(self, request, model_admin):
+            model = model_admin.model
+            values = cache.get_or_set(
+                f'admin:values:{model._meta.label_lower}:{field_name}',
+                lambda: list(
+                    model._default_manager.order_by(field_name)
+                    .values_list(field_name, flat=True).distinct()[:100]
+                ),
+                timeout,
+            )
+            return [(value, value) for value in values]
+
+        def queryset(self, request, queryset):
+            if self.value():
+                return queryset.filter(**{field_name: self.value()})
+            return queryset
+
+    CachedValuesFilter.title = title
+    return CachedValuesFilter
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Changelist settings for tables with millions of rows: estimated counts, no
+    second unfiltered COUNT(*), and prefix search on indexed columns. A patient
+    is matched by username prefix, resolved to ids first so the main query
+    filters on the indexed foreign key instead of joining auth_user.
+    """
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    patient_search_path = None
+    search_help_text = 'Matches the start of the value (case-sensitive) or a patient username.'
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        query = Q()
+        for field in self.get_search_fields(request):
+            query |= Q(**{f'{field}__startswith': search_term})
+        if self.patient_search_path:
+            patient_ids = list(
+                User.objects.filter(username__startswith=search_term)
+                .values_list('pk', flat=True)[:PATIENT_SEARCH_LIMIT]
+            )
+            if patient_ids:
+                query |= Q(**{f'{self.patient_search_path}__in': patient_ids})
+        return queryset.filter(query), False
 
 
 class InvoiceLineItemInline(admin.TabularInline):
@@ -11,30 +128,51 @@ class InvoiceLineItemInline(admin.TabularInline):
 @admin.register(PatientProfile)
 class PatientProfileAdmin(admin.ModelAdmin):
     list_display = ['user', 'phone_number', 'insurance_provider', 'created_at']
+    list_select_related = ['user']
     search_fields = ['user__username', 'user__email', 'user__first_name', 'user__last_name', 'phone_number']
     list_filter = ['insurance_provider', 'created_at']
     readonly_fields = ['created_at', 'updated_at']
+    autocomplete_fields = ['user']
 
 
 @admin.register(LabTest)
-class LabTestAdmin(admin.ModelAdmin):
+class LabTestAdmin(LargeTableAdmin):
     list_display = ['test_name', 'patient', 'test_category', 'status', 'order_date', 'is_abnormal']
-    list_filter = ['status', 'test_category', 'is_abnormal', 'order_date']
-    search_fields = ['test_name', 'patient__username', 'patient__first_name', 'patient__last_name', 'ordered_by']
+    list_select_related = ['patient']
+    list_filter = ['status', cached_values_filter('test_category', 'test category'), 'is_abnormal', 'order_date']
+    search_fields = ['test_name']
+    patient_search_path = 'patient'
+    autocomplete_fields = ['patient']
 
 
 @admin.register(DoctorVisit)
-class DoctorVisitAdmin(admin.ModelAdmin):
+class DoctorVisitAdmin(LargeTableAdmin):
     list_display = ['doctor_name', 'patient', 'specialty', 'visit_type', 'visit_date']
-    list_filter = ['visit_type', 'specialty', 'visit_date']
-    search_fields = ['doctor_name', 'patient__username', 'patient__first_name', 'patient__last_name', 'reason']
+    list_select_related = ['patient']
+    list_filter = ['visit_type', cached_values_filter('specialty', 'specialty'), 'visit_date']
+    search_fields = ['doctor_name']
+    patient_search_path = 'patient'
+    autocomplete_fields = ['patient']
+
+
+@admin.register(ArchivedLabTest)
+class ArchivedLabTestAdmin(LabTestAdmin):
+    list_display = LabTestAdmin.list_display + ['archived_at']
+
+
+@admin.register(ArchivedDoctorVisit)
+class ArchivedDoctorVisitAdmin(DoctorVisitAdmin):
+    list_display = DoctorVisitAdmin.list_display + ['archived_at']
 
 
 @admin.register(Invoice)
-class InvoiceAdmin(admin.ModelAdmin):
+class InvoiceAdmin(LargeTableAdmin):
     list_display = ['invoice_number', 'patient', 'total', 'status', 'due_date', 'created_at']
+    list_select_related = ['patient']
     list_filter = ['status', 'issue_date', 'due_date']
-    search_fields = ['invoice_number', 'patient__username', 'patient__email', 'patient__first_name', 'patient__last_name']
+    search_fields = ['invoice_number']
+    patient_search_path = 'patient'
+    autocomplete_fields = ['patient', 'created_by']
     readonly_fields = ['invoice_number', 'created_at', 'updated_at']
     inlines = [InvoiceLineItemInline]
     fieldsets = (
@@ -52,7 +190,27 @@ class InvoiceAdmin(admin.ModelAdmin):
 
 
 @admin.register(InvoiceLineItem)
-class InvoiceLineItemAdmin(admin.ModelAdmin):
+class InvoiceLineItemAdmin(LargeTableAdmin):
     list_display = ['invoice', 'description', 'quantity', 'unit_price', 'total_price', 'service_date']
-    list_filter = ['service_date', 'provider_name']
-    search_fields = ['description', 'invoice__invoice_number', 'provider_name']
+    # Invoice.__str__ shows the patient's name
+    list_select_related = ['invoice__patient']
+    list_filter = ['service_date', cached_values_filter('provider_name', 'provider name')]
+    search_fields = ['invoice__invoice_number', 'provider_name']
+    patient_search_path = 'invoice__patient'
+    autocomplete_fields = ['invoice']
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['task', 'status', 'priority', 'attempts', 'run_at', 'started_at', 'finished_at']
+    list_filter = ['status', 'priority', 'task']
+    search_fields = ['task']
+    readonly_fields = ['created_at', 'started_at', 'finished_at', 'locked_by', 'last_error']
+    actions = ['retry_jobs']
+
+    @admin.action(description='Retry selected jobs now')
+    def retry_jobs(self, request, queryset):
+        count = queryset.exclude(status='running').update(
+            status='queued', attempts=0, run_at=timezone.now(), finished_at=None, locked_by='',
+        )
+        self.message_user(request, f'{count} jobs queued')
@@ -0,0 +1,231 @@
+"""
+Read-only JSON API over the signed-in patient's records, for the mobile app.
+
+Rows are serialized straight from ``values_list()`` tuples, never model
+instances. ``?fields=a,b`` limits the columns that are selected as well as
+those returned. Pages are keyset-paginated, newest first. Each response's
+``next`` URL carries an opaque ``after`` cursor (sort date and id of the
+last row), so page 50 costs what page 1 does. Responses carry an ETag, and a
+matching ``If-None-Match`` gets an empty 304.
+
+``/api/sync/`` is the delta feed for offline clients: lab tests and visits
+saved since a watermark, plus tombstones for the ones deleted. Rows that
+``archive_records`` moves out are neither changed nor deleted, so clients
+keep them.
+"""
+import base64
+import binascii
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils import timezone
+from django.utils.http import quote_etag, urlencode
+
+from .models import DeletedRecord, DoctorVisit, Invoice, InvoiceLineItem, LabTest
+from .routers import replica_reads
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+LINE_ITEM_FIELDS = ['id', 'description', 'quantity', 'unit_price', 'total_price', 'service_date', 'provider_name']
+
+
+class Resource:
+    """A patient-scoped model exposed by the API, newest first by ``order_field``"""
+
+    def __init__(self, model, fields, order_field, nested=()):
+        self.model = model
+        self.fields = fields
+        self.order_field = order_field
+        # Fields filled in by a second query rather than selected
+        self.nested = nested
+
+    def page(self, patient, fields, after, limit):
+        """Up to ``limit`` rows as dicts, and the cursor for the next page (None on the last)"""
+        selected = [name for name in fields if name not in self.nested]
+        # The sort key is fetched for the cursor even when the client didn't ask for it
+        columns = selected + [name for name in (self.order_field, 'id') if name not in selected]
+        rows = self.model.objects.filter(patient=patient)
+        if after is not None:
+            value, pk = after
+            rows = rows.filter(Q(**{f'{self.order_field}__lt': value}) | Q(**{self.order_field: value, 'pk__lt': pk}))
+        rows = list(rows.order_by(f'-{self.order_field}', '-pk').values_list(*columns)[:limit + 1])
+
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            cursor = encode_token([last[columns.index(self.order_field)], last[columns.index('id')]])
+        results = [dict(zip(selected, row)) for row in rows]
+        if 'line_items' in fields:
+            add_line_items(results, [row[columns.index('id')] for row in rows])
+        return results, cursor
+
+
+def parse_position(model, field, position):
+    """``[value, pk]`` from a cursor or watermark, with the value parsed as ``model.field``"""
+    try:
+        value, pk = position
+        return model._meta.get_field(field).to_python(value), int(pk)
+    except (TypeError, ValueError, ValidationError):
+        raise ValueError(f'Invalid position {position!r}')
+
+
+def encode_token(data):
+    """Opaque URL-safe token for cursors and watermarks"""
+    # Full-precision timestamps: DjangoJSONEncoder would cut them to milliseconds
+    raw = json.dumps(data, default=lambda value: value.isoformat(), separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_token(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f'Invalid token {token!r}')
+
+
+def add_line_items(results, invoice_ids):
+    """Attach each invoice's line items, loaded for the whole page in one query"""
+    by_invoice = {pk: [] for pk in invoice_ids}
+    items = (
+        InvoiceLineItem.objects.filter(invoice_id__in=invoice_ids)
+        .order_by('invoice_id', 'pk').values_list('invoice_id', *LINE_ITEM_FIELDS)
+    )
+    for invoice_id, *values in items:
+        by_invoice[invoice_id].append(dict(zip(LINE_ITEM_FIELDS, values)))
+    for result, pk in zip(results, invoice_ids):
+        result['line_items'] = by_invoice[pk]
+
+
+RESOURCES = {
+    'lab_tests': Resource(LabTest, [
+        'id', 'test_name', 'test_category', 'ordered_by', 'order_date', 'result_date', 'status',
+        'result_value', 'reference_range', 'unit', 'is_abnormal', 'notes', 'created_at', 'updated_at',
+    ], 'order_date'),
+    'visits': Resource(DoctorVisit, [
+        'id', 'doctor_name', 'specialty', 'visit_date', 'visit_type', 'reason', 'diagnosis', 'treatment_plan',
+        'follow_up_date', 'vitals_bp', 'vitals_heart_rate', 'vitals_temperature', 'vitals_weight', 'notes',
+        'created_at', 'updated_at',
+    ], 'visit_date'),
+    'invoices': Resource(Invoice, [
+        'id', 'invoice_number', 'issue_date', 'due_date', 'status', 'subtotal', 'tax', 'total', 'notes',
+        'created_at', 'updated_at', 'line_items',
+    ], 'created_at', nested=('line_items',)),
+}
+
+
+def error(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+@replica_reads()
+def resource_list(request, resource):
+    """``GET /api/<resource>/?fields=&limit=&after=``"""
+    if not request.user.is_authenticated:
+        return error('Authentication required', status=401)
+    resource = RESOURCES[resource]
+
+    fields = resource.fields
+    if request.GET.get('fields'):
+        fields = list(dict.fromkeys(name.strip() for name in request.GET['fields'].split(',') if name.strip()))
+        unknown = [name for name in fields if name not in resource.fields]
+        if unknown:
+            return error(f'Unknown fields: {", ".join(unknown)}; available: {", ".join(resource.fields)}')
+    try:
+        limit = min(int(request.GET.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+        after = None
+        if request.GET.get('after'):
+            after = parse_position(resource.model, resource.order_field, decode_token(request.GET['after']))
+    except ValueError as exc:
+        return error(str(exc))
+    if limit < 1:
+        return error('limit must be at least 1')
+
+    results, cursor = resource.page(request.user, fields, after, limit)
+    next_url = None
+    if cursor is not None:
+        next_url = f'{request.path}?{urlencode({**request.GET.dict(), "after": cursor})}'
+    body = json.dumps({'results': results, 'next': next_url}, cls=DjangoJSONEncoder, separators=(',', ':'))
+
+    etag = quote_etag(hashlib.md5(body.encode(), usedforsecurity=False).hexdigest())
+    response = get_conditional_response(request, etag=etag) or HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    # Clients may keep a copy but must revalidate it, which the ETag makes cheap
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def changed_since(queryset, field, position, settled, columns, limit):
+    """Up to ``limit + 1`` rows after ``position`` in ``(field, pk)`` order, saved no later than ``settled``"""
+    rows = queryset.filter(**{f'{field}__lte': settled})
+    if position is not None:
+        value, pk = position
+        # The plain range condition is what lets the (patient, field) index bound the scan
+        rows = rows.filter(**{f'{field}__gte': value}).filter(Q(**{f'{field}__gt': value}) | Q(pk__gt=pk))
+    return list(rows.order_by(field, 'pk').values_list(*columns)[:limit + 1])
+
+
+@replica_reads()
+def sync(request):
+    """
+    ``GET /api/sync/?since=<watermark>&limit=``: rows changed since the
+    watermark, oldest change first, up to ``limit`` of each kind, and the
+    next watermark. Without ``since`` every live row is sent. Repeat while
+    ``more`` is true. Only changes older than ``SYNC_SETTLE_SECONDS`` are
+    sent, so a transaction that commits late can't land behind a watermark
+    already handed out. A watermark older than ``SYNC_TOMBSTONE_DAYS`` gets
+    410 Gone: deletions that old are forgotten, so the client must start over.
+    """
+    if not request.user.is_authenticated:
+        return error('Authentication required', status=401)
+    now = timezone.now()
+    settled = now - timedelta(seconds=settings.SYNC_SETTLE_SECONDS)
+    try:
+        limit = min(int(request.GET.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+        since = decode_token(request.GET['since']) if request.GET.get('since') else {}
+        positions = {
+            name: parse_position(RESOURCES[name].model, 'updated_at', since[name]) if since.get(name) else None
+            for name in ('lab_tests', 'visits')
+        }
+        # A first sync has nothing to delete, so its tombstone feed starts now
+        positions['deleted'] = parse_position(DeletedRecord, 'deleted_at', since['deleted']) if since else (settled, 0)
+    except (AttributeError, KeyError, ValueError):
+        return error('Invalid watermark')
+    if limit < 1:
+        return error('limit must be at least 1')
+    if positions['deleted'][0] < now - timedelta(days=settings.SYNC_TOMBSTONE_DAYS):
+        return error('Watermark expired; sync again without since', status=410)
+
+    data = {'more': False}
+    for name in ('lab_tests', 'visits'):
+        resource = RESOURCES[name]
+        columns = resource.fields
+        rows = changed_since(
+            resource.model.objects.filter(patient=request.user), 'updated_at', positions[name], settled,
+            columns, limit,
+        )
+        data['more'] |= len(rows) > limit
+        rows = rows[:limit]
+        if rows:
+            positions[name] = (rows[-1][columns.index('updated_at')], rows[-1][columns.index('id')])
+        data[name] = [dict(zip(columns, row)) for row in rows]
+
+    rows = changed_since(
+        DeletedRecord.objects.filter(patient=request.user), 'deleted_at', positions['deleted'], settled,
+        ['record_type', 'record_id', 'deleted_at', 'id'], limit,
+    )
+    data['more'] |= len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        positions['deleted'] = rows[-1][2:]
+    data['deleted'] = [{'type': record_type, 'id': record_id} for record_type, record_id, _, _ in rows]
+    data['watermark'] = encode_token({name: position for name, position in positions.items() if position})
+    return JsonResponse(data, json_dumps_params={'separators': (',', ':')})
@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.contrib.staticfiles.apps import StaticFilesConfig
 
 
 class CoreConfig(AppConfig):
+    default = True
     default_auto_field = "django.db.models.BigAutoField"
     name = "apps.core"
+
+    def ready(self):
+        """Load signal handlers when app is ready."""
+        import apps.core.signals  # noqa: F401
+
+
+class PortalStaticFilesConfig(StaticFilesConfig):
+    """Keeps the Tailwind source (compiled into output.css) out of collectstatic"""
+    ignore_patterns = StaticFilesConfig.ignore_patterns + ["input.css"]
@@ -0,0 +1,60 @@
+"""
+Hot/cold storage for lab tests and doctor visits.
+
+Rows dated more than ``ARCHIVE_HORIZON_DAYS`` ago move from the live tables
+into ``ArchivedLabTest`` and ``ArchivedDoctorVisit`` (see the
+``archive_records`` command). They keep their ids and ``created_at``. The
+portal reads only the live tables unless a patient asks for older records,
+so the live tables stay at roughly one horizon's worth of rows.
+"""
+from django.db import connections, transaction
+from django.db.models import DateTimeField, Value
+
+from .models import ArchivedDoctorVisit, ArchivedLabTest, DoctorVisit, LabTest
+
+# name -> (live model, archive model, date field the horizon applies to)
+ARCHIVES = {
+    'lab_tests': (LabTest, ArchivedLabTest, 'order_date'),
+    'doctor_visits': (DoctorVisit, ArchivedDoctorVisit, 'visit_date'),
+}
+
+
+def archive_batch(model, archive_model, date_field, cutoff, batch_size, now):
+    """
+    Move up to ``batch_size`` rows dated before ``cutoff`` in one transaction,
+    as an INSERT ... SELECT and a DELETE by id. Returns the number of rows
+    moved and their patients' ids.
+    """
+    db = model.objects.db
+    connection = connections[db]
+    fields = [field.attname for field in model._meta.concrete_fields]
+    columns = [model._meta.get_field(name).column for name in fields] + ['archived_at']
+
+    with transaction.atomic(using=db):
+        ids = list(
+            model.objects.filter(**{f'{date_field}__lt': cutoff})
+            .order_by().values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return 0, set()
+        # Ingest updates archived records in place, but one ingested while
+        # this runs can still end up with an archived copy; the live row is newer
+        archive_model.objects.filter(
+            external_id__in=model.objects.filter(pk__in=ids, external_id__isnull=False).values('external_id'),
+        )._raw_delete(db)
+        rows = (
+            model.objects.filter(pk__in=ids).order_by()
+            .annotate(archived_at_value=Value(now, output_field=DateTimeField()))
+            .values_list(*fields, 'archived_at_value')
+        )
+        select_sql, params = rows.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {connection.ops.quote_name(archive_model._meta.db_table)} '
+                f'({", ".join(connection.ops.quote_name(column) for column in columns)}) {select_sql}',
+                params,
+            )
+        patient_ids = set(model.objects.filter(pk__in=ids).values_list('patient_id', flat=True).distinct())
+        # Nothing references these rows, so skip the ORM's cascade collection
+        model.objects.filter(pk__in=ids)._raw_delete(db)
+    return len(ids), patient_ids
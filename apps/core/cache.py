@@ -0,0 +1,290 @@
+"""
+Two-tier Django cache backend.
+
+L1 is a small in-process LRU with a short TTL; L2 is another configured cache
+alias shared by every worker (file-based locally, Redis or similar in
+production). Reads hit L1 first, then L2, and L2 hits are copied into L1.
+Writes go to both. Because L1 is per process, other workers may serve a
+value for up to ``L1_TIMEOUT`` seconds after it changed in L2. Django hands
+each thread its own backend instance, so L1 and the counters live in
+module-level state shared by every instance configured the same way.
+
+Keys are grouped into namespaces by their first ``:``-separated segment
+(``portal:dashboard:42`` belongs to ``portal``); hit, miss and eviction
+counters are kept per namespace. ``namespace()`` returns a versioned view
+whose keys can all be invalidated at once with ``bump()``.
+"""
+import math
+import random
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+from . import metrics
+
+_MISSING = object()
+
+# (location, L2 alias, key prefix) -> (l1, l1 lock, stats), shared across threads
+_process_state = {}
+_process_state_lock = threading.Lock()
+
+
+def _shared_state(key):
+    with _process_state_lock:
+        if key not in _process_state:
+            _process_state[key] = (OrderedDict(), threading.Lock(), defaultdict(lambda: defaultdict(int)))
+        return _process_state[key]
+
+
+def _metric_series():
+    """Hit/miss counters of every TieredCache in this process, for /metrics"""
+    totals = defaultdict(int)
+    for _, _, stats in list(_process_state.values()):
+        for namespace, counters in list(stats.items()):
+            for result in ('l1_hits', 'l2_hits', 'misses'):
+                totals[(namespace, result)] += counters.get(result, 0)
+    return [
+        ('portal_cache_requests_total', {'namespace': namespace, 'result': result}, 'counter', {'value': value})
+        for (namespace, result), value in totals.items()
+    ]
+
+
+metrics.register_collector(_metric_series)
+
+
+class _Entry:
+    """Value written by get_or_set, carrying what probabilistic early expiry needs"""
+
+    __slots__ = ('value', 'expires_at', 'delta')
+
+    def __init__(self, value, expires_at, delta):
+        self.value = value
+        self.expires_at = expires_at
+        self.delta = delta
+
+
+class TieredCache(BaseCache):
+    """
+    OPTIONS:
+        L2: alias of the shared cache (required)
+        L1_MAX_ENTRIES: in-process LRU size (default 1000)
+        L1_TIMEOUT: upper bound on how long L1 holds a value (default 5s)
+        LOCK_TIMEOUT: how long get_or_set waits on another worker's recompute (default 10s)
+        EARLY_EXPIRY_BETA: XFetch beta; 0 disables early recompute (default 1.0)
+    """
+
+    def __init__(self, location, params):
+        options = params.get('OPTIONS', {})
+        super().__init__(params)
+        self._l2_alias = options['L2']
+        self._l1_max_entries = int(options.get('L1_MAX_ENTRIES', 1000))
+        self._l1_timeout = float(options.get('L1_TIMEOUT', 5))
+        self._lock_timeout = float(options.get('LOCK_TIMEOUT', 10))
+        self._beta = float(options.get('EARLY_EXPIRY_BETA', 1.0))
+        self._l1, self._l1_lock, self._stats = _shared_state((location, self._l2_alias, self.key_prefix))
+
+    @property
+    def l2(self):
+        return caches[self._l2_alias]
+
+    # -- stats ---------------------------------------------------------------
+
+    @staticmethod
+    def _namespace_of(key):
+        return key.split(':', 1)[0] if ':' in key else 'default'
+
+    def _count(self, key, counter):
+        self._stats[self._namespace_of(key)][counter] += 1
+
+    def stats(self):
+        """Per-namespace counters: l1_hits, l2_hits, misses, evictions, sets"""
+        return {namespace: dict(counters) for namespace, counters in self._stats.items()}
+
+    # -- L1 ------------------------------------------------------------------
+
+    def _l1_get(self, l1_key):
+        with self._l1_lock:
+            item = self._l1.get(l1_key)
+            if item is None:
+                return _MISSING
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._l1[l1_key]
+                return _MISSING
+            self._l1.move_to_end(l1_key)
+            return value
+
+    def _l1_set(self, key, l1_key, value, timeout):
+        ttl = self._l1_timeout if timeout is None else min(timeout, self._l1_timeout)
+        if ttl <= 0:
+            self._l1_delete(l1_key)
+            return
+        evicted = []
+        with self._l1_lock:
+            self._l1[l1_key] = (value, time.monotonic() + ttl)
+            self._l1.move_to_end(l1_key)
+            while len(self._l1) > self._l1_max_entries:
+                evicted.append(self._l1.popitem(last=False)[0])
+        for evicted_key in evicted:
+            self._count(evicted_key.split(':', 2)[-1], 'evictions')
+
+    def _l1_delete(self, l1_key):
+        with self._l1_lock:
+            self._l1.pop(l1_key, None)
+
+    # -- BaseCache API -------------------------------------------------------
+
+    def _resolve_timeout(self, timeout):
+        return self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+
+    def _lookup(self, key, version):
+        """Return the raw stored value (possibly an _Entry) or _MISSING"""
+        l1_key = self.make_and_validate_key(key, version=version)
+        value = self._l1_get(l1_key)
+        if value is not _MISSING:
+            self._count(key, 'l1_hits')
+            return value
+        value = self.l2.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            self._count(key, 'misses')
+            return value
+        self._count(key, 'l2_hits')
+        ttl = self._l1_timeout
+        if isinstance(value, _Entry):
+            ttl = min(ttl, max(value.expires_at - time.time(), 0))
+        self._l1_set(key, l1_key, value, ttl)
+        return value
+
+    def get(self, key, default=None, version=None):
+        value = self._lookup(key, version)
+        if value is _MISSING:
+            return default
+        return value.value if isinstance(value, _Entry) else value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        timeout = self._resolve_timeout(timeout)
+        self.l2.set(key, value, timeout, version=version)
+        self._l1_set(key, self.make_and_validate_key(key, version=version), value, timeout)
+        self._count(key, 'sets')
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        timeout = self._resolve_timeout(timeout)
+        added = self.l2.add(key, value, timeout, version=version)
+        if added:
+            self._l1_set(key, self.make_and_validate_key(key, version=version), value, timeout)
+            self._count(key, 'sets')
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        self._l1_delete(self.make_and_validate_key(key, version=version))
+        return self.l2.touch(key, self._resolve_timeout(timeout), version=version)
+
+    def delete(self, key, version=None):
+        self._l1_delete(self.make_and_validate_key(key, version=version))
+        return self.l2.delete(key, version=version)
+
+    def has_key(self, key, version=None):
+        return self._lookup(key, version) is not _MISSING
+
+    def incr(self, key, delta=1, version=None):
+        self._l1_delete(self.make_and_validate_key(key, version=version))
+        return self.l2.incr(key, delta, version=version)
+
+    def clear(self):
+        with self._l1_lock:
+            self._l1.clear()
+        self.l2.clear()
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Stampede-safe get_or_set. A missing value is recomputed by one worker
+        holding a short L2 lock while the others wait for it. A present value is
+        recomputed early with probability rising as expiry nears (XFetch), in
+        proportion to how long it took to compute, so hot keys rarely expire
+        under load.
+        """
+        timeout = self._resolve_timeout(timeout)
+        entry = self._lookup(key, version)
+        if entry is not _MISSING:
+            if not isinstance(entry, _Entry) or not self._should_refresh(entry):
+                return entry.value if isinstance(entry, _Entry) else entry
+            return self._compute(key, default, timeout, version)
+
+        lock_key = f'{key}:lock'
+        if self.l2.add(lock_key, 1, self._lock_timeout, version=version):
+            try:
+                return self._compute(key, default, timeout, version)
+            finally:
+                self.l2.delete(lock_key, version=version)
+
+        deadline = time.monotonic() + self._lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            entry = self.l2.get(key, _MISSING, version=version)
+            if entry is not _MISSING:
+                return entry.value if isinstance(entry, _Entry) else entry
+        return self._compute(key, default, timeout, version)
+
+    def _should_refresh(self, entry):
+        if self._beta <= 0 or entry.expires_at == math.inf:
+            return False
+        jitter = -entry.delta * self._beta * math.log(1.0 - random.random())
+        return time.time() + jitter >= entry.expires_at
+
+    def _compute(self, key, default, timeout, version):
+        start = time.time()
+        value = default() if callable(default) else default
+        delta = time.time() - start
+        expires_at = math.inf if timeout is None else time.time() + timeout
+        self.set(key, _Entry(value, expires_at, delta), timeout, version=version)
+        return value
+
+    # -- namespaces ----------------------------------------------------------
+
+    def namespace(self, name):
+        return Namespace(self, name)
+
+
+class Namespace:
+    """
+    Versioned key space over any Django cache. Every key is stored as ``<name>:<version>:<key>``;
+    ``bump()`` moves to a new version so all old keys become unreachable and
+    age out of L2 on their own.
+    """
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+        self._version_key = f'{name}:__version__'
+
+    @property
+    def version(self):
+        version = self.cache.get(self._version_key)
+        if version is None:
+            self.cache.add(self._version_key, 1, None)
+            version = self.cache.get(self._version_key, 1)
+        return version
+
+    def bump(self):
+        # incr is atomic on Redis and memcached, so concurrent bumps each get
+        # their own version; on a TieredCache it goes to L2 and drops the L1 copy
+        self.cache.add(self._version_key, 1, None)
+        self.cache.incr(self._version_key)
+
+    def key(self, key):
+        return f'{self.name}:{self.version}:{key}'
+
+    def get(self, key, default=None):
+        return self.cache.get(self.key(key), default)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        self.cache.set(self.key(key), value, timeout)
+
+    def delete(self, key):
+        return self.cache.delete(self.key(key))
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT):
+        return self.cache.get_or_set(self.key(key), default, timeout)
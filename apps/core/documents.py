@@ -0,0 +1,164 @@
+"""
+Printable invoice and statement documents.
+
+Single documents are rendered on demand and cached in the default cache,
+keyed on the invoice's ``updated_at`` (which line item changes also touch),
+so an edit produces a new key instead of needing an explicit invalidation.
+PDF output needs WeasyPrint, which is optional; PDFs are slow to render, so
+the download view has a background job render them into the cache.
+
+``render_batch`` is the unit of work for the ``generate_documents`` command.
+It writes one file per document and stamps the file's mtime with the source
+rows' ``updated_at``. A rerun skips files that are still current, which is how
+an interrupted run resumes.
+"""
+import calendar
+import datetime
+import os
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+from django.template.loader import render_to_string
+
+from .models import Invoice
+
+FORMATS = ('html', 'pdf')
+UNPAID_STATUSES = ['pending', 'overdue']
+DOCUMENT_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def html_to_pdf(html):
+    try:
+        from weasyprint import HTML
+    except ImportError as exc:
+        raise ImproperlyConfigured('PDF documents need WeasyPrint: pip install weasyprint') from exc
+    return HTML(string=html).write_pdf()
+
+
+def pdf_available():
+    try:
+        import weasyprint  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _encode(html, fmt):
+    return html_to_pdf(html) if fmt == 'pdf' else html.encode()
+
+
+def statement_period(period):
+    """First and last day of a ``YYYY-MM`` period"""
+    start = datetime.datetime.strptime(period, '%Y-%m').date()
+    return start, start.replace(day=calendar.monthrange(start.year, start.month)[1])
+
+
+def invoice_html(invoice):
+    """Expects ``patient__patient_profile`` selected and ``line_items`` prefetched"""
+    return render_to_string('core/documents/invoice.html', {
+        'invoice': invoice,
+        'line_items': invoice.line_items.all(),
+    })
+
+
+def statement_html(patient, invoices, period):
+    start, end = statement_period(period)
+    return render_to_string('core/documents/statement.html', {
+        'patient': patient,
+        'invoices': invoices,
+        'period_start': start,
+        'period_end': end,
+        'balance_due': sum((invoice.total for invoice in invoices if invoice.status in UNPAID_STATUSES), Decimal(0)),
+    })
+
+
+def invoice_document_key(invoice, fmt):
+    return f'documents:invoice:{invoice.pk}:{invoice.updated_at.timestamp()}:{fmt}'
+
+
+def invoice_document(invoice, fmt='html'):
+    """Rendered invoice as bytes, cached until the invoice or its line items change"""
+    return cache.get_or_set(
+        invoice_document_key(invoice, fmt), lambda: _encode(invoice_html(invoice), fmt), DOCUMENT_CACHE_TIMEOUT,
+    )
+
+
+def cached_invoice_document(invoice, fmt='html'):
+    """The rendered invoice if it is already cached, else None"""
+    return cache.get(invoice_document_key(invoice, fmt))
+
+
+def period_invoices(period):
+    """Invoices that go on the period's statements: issued in it, or still unpaid at its end"""
+    start, end = statement_period(period)
+    return Invoice.objects.filter(Q(issue_date__range=(start, end)) | Q(status__in=UNPAID_STATUSES, issue_date__lte=end))
+
+
+def statement_invoices(patient_ids, period):
+    """Invoices issued in the period plus anything still unpaid, for each patient"""
+    return period_invoices(period).filter(patient_id__in=patient_ids).order_by('patient_id', 'issue_date', 'pk')
+
+
+def _stamp(updated_at):
+    """``updated_at`` as integer nanoseconds, which survive a round trip through mtime exactly"""
+    return (updated_at - EPOCH) // datetime.timedelta(microseconds=1) * 1000
+
+
+def _write(path, content, stamp):
+    """Write atomically, so an interrupted run never leaves a partial document behind"""
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+    os.utime(path, ns=(stamp, stamp))
+
+
+def _is_current(path, stamp):
+    try:
+        return os.stat(path).st_mtime_ns == stamp
+    except FileNotFoundError:
+        return False
+
+
+def render_batch(kind, ids, output_dir, fmt='html', period=None):
+    """
+    Render and write the invoices (or the statements of the patients) in ``ids``.
+    Returns ``(written, skipped)``; patients with no statement activity count as skipped.
+    """
+    written = skipped = 0
+    if kind == 'invoices':
+        invoices = (
+            Invoice.objects.filter(pk__in=ids)
+            .select_related('patient__patient_profile')
+            .prefetch_related('line_items')
+            .order_by()
+        )
+        for invoice in invoices:
+            path = os.path.join(output_dir, f'{invoice.invoice_number}.{fmt}')
+            stamp = _stamp(invoice.updated_at)
+            if _is_current(path, stamp):
+                skipped += 1
+                continue
+            _write(path, _encode(invoice_html(invoice), fmt), stamp)
+            written += 1
+        return written, skipped
+
+    by_patient = {}
+    for invoice in statement_invoices(ids, period).select_related('patient__patient_profile'):
+        by_patient.setdefault(invoice.patient_id, []).append(invoice)
+    for patient_id in ids:
+        invoices = by_patient.get(patient_id)
+        if not invoices:
+            skipped += 1
+            continue
+        path = os.path.join(output_dir, f'{patient_id}.{fmt}')
+        stamp = _stamp(max(invoice.updated_at for invoice in invoices))
+        if _is_current(path, stamp):
+            skipped += 1
+            continue
+        _write(path, _encode(statement_html(invoices[0].patient, invoices, period), fmt), stamp)
+        written += 1
+    return written, skipped
@@ -0,0 +1,186 @@
+"""
+Bulk population export in the style of FHIR ``$export``.
+
+Patients, lab results (as Observations) and visits (as Encounters) are
+written as FHIR-like resources, one per line, to one gzipped NDJSON file per
+resource type. There is also a ``manifest.json`` listing the files and their
+counts. Archived rows are exported alongside live ones.
+
+The work is split into disjoint patient-id ranges (``patient_ranges``).
+``export_part`` writes one resource type for one range to its own part file,
+streaming rows from a server-side cursor and compressing them as it goes, so
+parts can run in parallel processes without sharing anything. Gzip members
+can be concatenated, so the parts of a type are joined into the final file
+without recompressing.
+"""
+import gzip
+import json
+import math
+import os
+import shutil
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import ArchivedDoctorVisit, ArchivedLabTest, DoctorVisit, LabTest, PatientProfile
+
+RESOURCE_TYPES = ('Patient', 'Observation', 'Encounter')
+CHUNK_SIZE = 2000
+
+PATIENT_COLUMNS = [
+    'user_id', 'user__first_name', 'user__last_name', 'user__email', 'date_of_birth', 'phone_number',
+    'address', 'insurance_provider', 'insurance_policy_number',
+]
+OBSERVATION_COLUMNS = [
+    'pk', 'patient_id', 'test_name', 'test_category', 'ordered_by', 'order_date', 'result_date', 'status',
+    'result_value', 'reference_range', 'unit', 'is_abnormal', 'notes',
+]
+ENCOUNTER_COLUMNS = [
+    'pk', 'patient_id', 'doctor_name', 'specialty', 'visit_date', 'visit_type', 'reason', 'diagnosis',
+    'treatment_plan', 'follow_up_date', 'notes',
+]
+OBSERVATION_STATUSES = {'pending': 'registered', 'completed': 'final', 'reviewed': 'amended'}
+VISIT_TYPES = dict(DoctorVisit.VISIT_TYPE_CHOICES)
+
+
+def patient_resource(user_id, first_name, last_name, email, birth_date, phone, address, insurer, policy):
+    resource = {
+        'resourceType': 'Patient',
+        'id': str(user_id),
+        'name': [{'family': last_name, 'given': [first_name]}],
+        'telecom': [{'system': 'email', 'value': email}, {'system': 'phone', 'value': phone}],
+        'birthDate': birth_date,
+        'address': [{'text': address}],
+    }
+    if insurer:
+        resource['identifier'] = [{'system': insurer, 'value': policy}]
+    return resource
+
+
+def observation_resource(pk, patient_id, test_name, category, ordered_by, order_date, result_date, status,
+                         value, reference_range, unit, is_abnormal, notes):
+    resource = {
+        'resourceType': 'Observation',
+        'id': str(pk),
+        'status': OBSERVATION_STATUSES.get(status, 'unknown'),
+        'category': [{'text': category}],
+        'code': {'text': test_name},
+        'subject': {'reference': f'Patient/{patient_id}'},
+        'effectiveDateTime': order_date,
+        'performer': [{'display': ordered_by}],
+    }
+    if result_date:
+        resource['issued'] = result_date
+    if value:
+        resource['valueString'] = f'{value} {unit}'.strip()
+    if reference_range:
+        resource['referenceRange'] = [{'text': reference_range}]
+    if is_abnormal:
+        resource['interpretation'] = [{'text': 'Abnormal'}]
+    if notes:
+        resource['note'] = [{'text': notes}]
+    return resource
+
+
+def encounter_resource(pk, patient_id, doctor_name, specialty, visit_date, visit_type, reason, diagnosis,
+                       treatment_plan, follow_up_date, notes):
+    resource = {
+        'resourceType': 'Encounter',
+        'id': str(pk),
+        'status': 'finished',
+        'type': [{'text': VISIT_TYPES.get(visit_type, visit_type)}],
+        'serviceType': {'text': specialty},
+        'subject': {'reference': f'Patient/{patient_id}'},
+        'participant': [{'individual': {'display': doctor_name}}],
+        'period': {'start': visit_date},
+        'reasonCode': [{'text': reason}],
+    }
+    if diagnosis:
+        resource['diagnosis'] = [{'condition': {'display': diagnosis}}]
+    # No FHIR Encounter field for these; kept as notes rather than dropped
+    extra = [text for text in (treatment_plan, notes) if text]
+    if follow_up_date:
+        extra.append(f'Follow-up on {follow_up_date.isoformat()}')
+    if extra:
+        resource['note'] = [{'text': text} for text in extra]
+    return resource
+
+
+# resource type -> [(queryset, patient id field, columns)], resource builder
+SOURCES = {
+    'Patient': ([(PatientProfile.objects.all(), 'user_id', PATIENT_COLUMNS)], patient_resource),
+    'Observation': (
+        [(model.objects.all(), 'patient_id', OBSERVATION_COLUMNS) for model in (LabTest, ArchivedLabTest)],
+        observation_resource,
+    ),
+    'Encounter': (
+        [(model.objects.all(), 'patient_id', ENCOUNTER_COLUMNS) for model in (DoctorVisit, ArchivedDoctorVisit)],
+        encounter_resource,
+    ),
+}
+
+
+def patient_ranges(parts):
+    """
+    Split patients into up to ``parts`` half-open ``(first_id, next_first_id)``
+    ranges of similar size. The first range is open below and the last open
+    above (``None``), so records of patients without a profile are still
+    covered.
+    """
+    ids = PatientProfile.objects.order_by('user_id').values_list('user_id', flat=True)
+    count = ids.count()
+    if not count:
+        return [(None, None)]
+    step = math.ceil(count / parts)
+    starts = [None] + [ids[offset] for offset in range(step, count, step)]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def part_path(output_dir, resource_type, index):
+    return os.path.join(output_dir, f'{resource_type}.part{index:04d}.ndjson.gz')
+
+
+def export_part(resource_type, first_id, next_id, path, since=None):
+    """Write ``resource_type`` for patients in ``[first_id, next_id)`` to ``path``; returns the count"""
+    querysets, build = SOURCES[resource_type]
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=6) as out:
+        for queryset, patient_field, columns in querysets:
+            rows = queryset
+            if first_id is not None:
+                rows = rows.filter(**{f'{patient_field}__gte': first_id})
+            if next_id is not None:
+                rows = rows.filter(**{f'{patient_field}__lt': next_id})
+            if since is not None:
+                rows = rows.filter(updated_at__gte=since)
+            # iterator() streams from a server-side cursor on PostgreSQL
+            for row in rows.order_by(patient_field, 'pk').values_list(*columns).iterator(chunk_size=CHUNK_SIZE):
+                out.write(encoder.encode(build(*row)))
+                out.write('\n')
+                count += 1
+    return count
+
+
+def join_parts(paths, path):
+    """Concatenate gzip part files into ``path``, removing the parts"""
+    with open(path, 'wb') as out:
+        for part in paths:
+            with open(part, 'rb') as f:
+                shutil.copyfileobj(f, out)
+            os.remove(part)
+
+
+def write_manifest(output_dir, transaction_time, counts, since=None):
+    manifest = {
+        'transactionTime': transaction_time.isoformat(),
+        'request': '$export' + (f'?_since={since.isoformat()}' if since else ''),
+        'requiresAccessToken': False,
+        'output': [
+            {'type': resource_type, 'url': f'{resource_type}.ndjson.gz', 'count': count}
+            for resource_type, count in counts.items()
+        ],
+        'error': [],
+    }
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
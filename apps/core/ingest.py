@@ -0,0 +1,218 @@
+"""
+Streaming ingestion of lab results and doctor visits from CSV or NDJSON files.
+
+The pipeline is a chain of generators, so one batch is in memory at a time
+however large the file is:
+
+    read_rows -> clean_rows -> batches -> resolve_patients -> upsert
+
+Each row needs ``external_id`` (the sender's id for the record) and
+``patient`` (a username or email, see ``--match``), plus the model's
+required columns. Rows are upserted on ``external_id``, so a corrected file
+can simply be sent again; a record ``archive_records`` has already moved is
+updated in the archive rather than inserted again. Rows that fail get written to the reject file with
+their line number and the reason, and the rest of the file carries on.
+"""
+import csv
+import gzip
+import io
+import json
+import sys
+from collections import OrderedDict
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, models, transaction
+from django.utils import timezone
+
+from .archive import ARCHIVES
+from .models import DoctorVisit, LabTest
+
+MODELS = {'lab_tests': LabTest, 'visits': DoctorVisit}
+ARCHIVE_MODELS = {model: archive_model for model, archive_model, _ in ARCHIVES.values()}
+# Set by the database or by the pipeline, never read from the file
+SKIPPED_FIELDS = {'id', 'patient', 'created_at', 'updated_at'}
+BOOLEANS = {'true': True, 't': True, 'yes': True, 'y': True, '1': True,
+            'false': False, 'f': False, 'no': False, 'n': False, '0': False}
+
+
+class RejectedRow(Exception):
+    pass
+
+
+def open_input(path):
+    """Text stream for ``path``; ``-`` is stdin and ``.gz`` files are decompressed as they are read"""
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def read_rows(stream, fmt):
+    """Yield ``(line_number, dict)``; a line that isn't a JSON object yields ``(line_number, error)``"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            yield line_number, f'Invalid JSON: {exc}'
+            continue
+        yield line_number, row if isinstance(row, dict) else 'Expected a JSON object'
+
+
+def ingest_fields(model):
+    return [field for field in model._meta.concrete_fields if field.name not in SKIPPED_FIELDS]
+
+
+def clean_value(field, value):
+    if isinstance(value, str):
+        value = value.strip()
+    if value in ('', None):
+        if field.has_default():
+            return field.get_default()
+        if field.null:
+            return None
+        if field.blank:
+            return ''
+        raise RejectedRow(f'{field.name} is required')
+    if isinstance(field, models.BooleanField) and isinstance(value, str):
+        if value.lower() not in BOOLEANS:
+            raise RejectedRow(f'{field.name}: {value!r} is not true or false')
+        value = BOOLEANS[value.lower()]
+    try:
+        return field.clean(value, None)
+    except ValidationError as exc:
+        raise RejectedRow(f'{field.name}: {" ".join(exc.messages)}')
+
+
+def clean_rows(rows, model, rejects):
+    """Yield ``(line_number, patient_key, values)`` for the rows that validate"""
+    fields = ingest_fields(model)
+    for line_number, row in rows:
+        try:
+            if isinstance(row, str):
+                raise RejectedRow(row)
+            if not row.get('external_id'):
+                raise RejectedRow('external_id is required')
+            patient = str(row.get('patient') or '').strip()
+            if not patient:
+                raise RejectedRow('patient is required')
+            values = {field.attname: clean_value(field, row.get(field.name)) for field in fields}
+        except RejectedRow as exc:
+            rejects.write(line_number, str(exc), row)
+            continue
+        yield line_number, patient, values
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class PatientLookup:
+    """
+    Patient ids by username or email, fetched one query per batch for the
+    keys not seen yet and kept in a bounded LRU, since a nightly file
+    mentions the same patients over and over.
+    """
+
+    def __init__(self, match='username', size=100_000):
+        self.match = match
+        self.size = size
+        self._ids = OrderedDict()
+
+    def resolve(self, keys):
+        missing = {key for key in keys if key not in self._ids}
+        if missing:
+            found = dict(User.objects.filter(**{f'{self.match}__in': missing}).values_list(self.match, 'pk'))
+            for key in missing:
+                # Unknown keys are cached too, as None, so they cost one lookup
+                self._ids[key] = found.get(key)
+        result = {}
+        for key in keys:
+            self._ids.move_to_end(key)
+            result[key] = self._ids[key]
+        while len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+        return result
+
+
+def resolve_patients(batches, lookup, rejects):
+    """Yield each batch as ``(line_number, values, patient_id)`` rows, rejecting unknown patients"""
+    for batch in batches:
+        patient_ids = lookup.resolve({patient for _, patient, _ in batch})
+        objs = {}
+        for line_number, patient, values in batch:
+            if patient_ids[patient] is None:
+                rejects.write(line_number, f'Unknown patient {patient!r}', {'patient': patient, **values})
+                continue
+            # A later row for the same record wins, as it would across batches
+            objs[values['external_id']] = (line_number, values, patient_ids[patient])
+        yield list(objs.values())
+
+
+def upsert(model, rows, rejects):
+    """Insert or update one batch on ``external_id``; returns the rows written and their patients' ids"""
+    archive_model = ARCHIVE_MODELS[model]
+    update_fields = [field.name for field in ingest_fields(model) if field.name != 'external_id']
+    update_fields += ['patient', 'updated_at']
+    try:
+        with transaction.atomic():
+            # external_id is only unique per table, so inserting an archived
+            # record into the live table would keep two copies of it
+            archived = dict(
+                archive_model.objects.filter(external_id__in=[values['external_id'] for _, values, _ in rows])
+                .values_list('external_id', 'pk')
+            )
+            if archived:
+                now = timezone.now()
+                archive_model.objects.bulk_update([
+                    archive_model(pk=archived[values['external_id']], patient_id=patient_id, updated_at=now, **values)
+                    for _, values, patient_id in rows if values['external_id'] in archived
+                ], update_fields)
+            model.objects.bulk_create(
+                [
+                    model(patient_id=patient_id, **values)
+                    for _, values, patient_id in rows if values['external_id'] not in archived
+                ],
+                update_conflicts=True, unique_fields=['external_id'], update_fields=update_fields,
+            )
+    except DatabaseError as exc:
+        for line_number, values, _ in rows:
+            rejects.write(line_number, f'Database error: {exc}', values)
+        return 0, set()
+    return len(rows), {patient_id for _, _, patient_id in rows}
+
+
+class RejectFile:
+    """CSV of rejected rows, created on the first reject"""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = self._writer = None
+
+    def write(self, line_number, error, row):
+        if self._writer is None:
+            self._file = open(self.path, 'w', newline='', encoding='utf-8')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(['line', 'error', 'row'])
+        self._writer.writerow([line_number, error, json.dumps(row, default=str)])
+        self.count += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
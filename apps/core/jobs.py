@@ -0,0 +1,199 @@
+"""
+Database-backed background jobs, no broker needed.
+
+``enqueue(func, *args, **kwargs)`` stores a call to any importable function
+(arguments must be JSON-serialisable) and returns at once. The ``run_jobs``
+command's workers claim jobs in priority order and run them.
+
+- Claiming uses ``SELECT ... FOR UPDATE SKIP LOCKED`` where the database
+  supports it (PostgreSQL), so workers never wait on one another. Elsewhere
+  (SQLite) a worker picks a candidate and claims it with a conditional
+  ``UPDATE ... WHERE status = 'queued'``; if another worker got there first
+  it simply tries the next one.
+- A failed job is retried with exponential backoff until ``max_attempts``.
+- Lower ``priority`` runs first; ``LANES`` names the usual levels, and a
+  worker can be limited to some of them.
+- A claim holds a lease of ``JOB_LEASE_SECONDS``, which the worker renews
+  while the job runs, so long jobs are fine. A job whose lease runs out is
+  assumed to belong to a dead worker and is queued again, or failed if it has
+  used up its attempts. Outcomes are only recorded while the lease is still
+  the worker's own, so a worker that lost its job can't overwrite a newer run.
+"""
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .models import Job
+
+LANES = {'high': 0, 'default': 10, 'low': 20}
+
+# Due jobs a worker tries to claim per poll before giving up on the fallback path
+CLAIM_CANDIDATES = 10
+
+
+def lane_name(priority):
+    return {value: name for name, value in LANES.items()}.get(priority, str(priority))
+
+
+def task_name(func):
+    return func if isinstance(func, str) else f'{func.__module__}.{func.__qualname__}'
+
+
+def enqueue(func, *args, lane='default', priority=None, delay=0, max_attempts=None, **kwargs):
+    """Queue ``func(*args, **kwargs)`` and return the ``Job``"""
+    name = task_name(func)
+    import_string(name)  # fail now, not in the worker, if it can't be imported
+    return Job.objects.create(
+        task=name, args=list(args), kwargs=kwargs,
+        priority=LANES[lane] if priority is None else priority,
+        max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS,
+        run_at=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def claim(worker, priorities=None):
+    """Mark the next due job as running for ``worker`` and return it, or None"""
+    now = timezone.now()
+    due = Job.objects.filter(status='queued', run_at__lte=now).order_by('priority', 'run_at')
+    if priorities is not None:
+        due = due.filter(priority__in=priorities)
+    claimed = {
+        'status': 'running', 'locked_by': worker, 'started_at': now,
+        'locked_until': now + timedelta(seconds=settings.JOB_LEASE_SECONDS), 'attempts': F('attempts') + 1,
+    }
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            pk = due.select_for_update(skip_locked=True).values_list('pk', flat=True).first()
+            if pk is None:
+                return None
+            Job.objects.filter(pk=pk).update(**claimed)
+        return Job.objects.get(pk=pk)
+
+    # No row locks here: the UPDATE only matches while the job is still
+    # queued, so of two workers picking the same job exactly one gets it
+    for pk in due.values_list('pk', flat=True)[:CLAIM_CANDIDATES]:
+        if Job.objects.filter(pk=pk, status='queued').update(**claimed):
+            return Job.objects.get(pk=pk)
+    return None
+
+
+def backoff(attempts):
+    """Seconds before retry ``attempts + 1``: doubling from JOB_RETRY_BACKOFF_SECONDS, with jitter"""
+    base = settings.JOB_RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1)
+    return base * random.uniform(0.75, 1.25)
+
+
+def renew_lease(job):
+    """Extend the lease on a running job; False if the job is no longer this worker's"""
+    return bool(Job.objects.filter(pk=job.pk, status='running', locked_by=job.locked_by).update(
+        locked_until=timezone.now() + timedelta(seconds=settings.JOB_LEASE_SECONDS),
+    ))
+
+
+def _heartbeat(job, stop):
+    try:
+        while not stop.wait(settings.JOB_LEASE_SECONDS / 3):
+            if not renew_lease(job):
+                return
+    finally:
+        # This thread's own connection
+        connections.close_all()
+
+
+def run(job):
+    """Run a claimed job and record the outcome; returns True on success"""
+    metrics.histogram('portal_job_wait_seconds', lane=lane_name(job.priority)).observe(
+        (job.started_at - job.run_at).total_seconds()
+    )
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(job, stop), name=f'job-heartbeat-{job.pk}', daemon=True)
+    heartbeat.start()
+    start = time.perf_counter()
+    try:
+        import_string(job.task)(*job.args, **job.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+    else:
+        error = None
+    finally:
+        stop.set()
+        heartbeat.join()
+
+    # Outcomes only land while the job is still this worker's, so one that
+    # lost its lease can't overwrite the run that took over
+    ours = Job.objects.filter(pk=job.pk, status='running', locked_by=job.locked_by)
+    if error is None:
+        ours.update(status='succeeded', finished_at=timezone.now(), locked_by='', locked_until=None)
+        outcome = 'succeeded'
+    else:
+        retry = job.attempts < job.max_attempts
+        ours.update(
+            status='queued' if retry else 'failed',
+            run_at=timezone.now() + timedelta(seconds=backoff(job.attempts)) if retry else job.run_at,
+            finished_at=None if retry else timezone.now(),
+            locked_by='', locked_until=None, last_error=error,
+        )
+        outcome = 'retried' if retry else 'failed'
+    metrics.histogram('portal_job_duration_seconds', task=job.task).observe(time.perf_counter() - start)
+    metrics.counter('portal_jobs_total', task=job.task, outcome=outcome).inc()
+    return outcome == 'succeeded'
+
+
+def recover_and_purge():
+    """Requeue jobs whose lease ran out (failing those out of attempts); delete old succeeded jobs"""
+    now = timezone.now()
+    orphaned = Job.objects.filter(status='running', locked_until__lt=now)
+    # Each claim counted an attempt, so a job that keeps killing its worker
+    # stops being retried like one that keeps raising
+    orphaned.filter(attempts__gte=F('max_attempts')).update(
+        status='failed', finished_at=now, locked_by='', locked_until=None,
+        last_error='Worker lost; its lease ran out',
+    )
+    requeued = orphaned.update(status='queued', locked_by='', locked_until=None, run_at=now)
+    purged, _ = Job.objects.filter(
+        status='succeeded', finished_at__lt=now - timedelta(days=settings.JOB_RETENTION_DAYS),
+    ).delete()
+    return requeued, purged
+
+
+def queue_stats():
+    """
+    Per lane: ``depth`` (due jobs waiting), ``scheduled`` (queued for later,
+    including retries), ``running``, ``failed``, and ``oldest_seconds``, how
+    long the oldest due job has waited, which is the queue's latency.
+    """
+    now = timezone.now()
+    due = Q(status='queued', run_at__lte=now)
+    rows = (
+        Job.objects.exclude(status='succeeded').values('priority')
+        .annotate(
+            depth=Count('pk', filter=due),
+            scheduled=Count('pk', filter=Q(status='queued', run_at__gt=now)),
+            running=Count('pk', filter=Q(status='running')),
+            failed=Count('pk', filter=Q(status='failed')),
+            oldest=Min('run_at', filter=due),
+        )
+        .order_by('priority')
+    )
+    stats = {}
+    for row in rows:
+        oldest = row.pop('oldest')
+        row['oldest_seconds'] = round((now - oldest).total_seconds(), 3) if oldest else 0.0
+        stats[lane_name(row.pop('priority'))] = row
+    return stats
@@ -0,0 +1,66 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.core.archive import ARCHIVES, archive_batch
+from apps.core.models import DeletedRecord
+from apps.core.signals import lab_tests_namespace
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves lab tests and doctor visits dated more than --horizon-days ago into the '
+        'archive tables, one short transaction per batch. Schedule it daily to keep the '
+        'live tables bounded, e.g. "15 1 * * * python manage.py archive_records". Also '
+        'deletes sync tombstones older than SYNC_TOMBSTONE_DAYS.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horizon-days', type=int, default=settings.ARCHIVE_HORIZON_DAYS)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--only', choices=ARCHIVES, help='Archive just this table')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to pause between batches')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows that would move')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.localdate() - datetime.timedelta(days=options['horizon_days'])
+        names = [options['only']] if options['only'] else list(ARCHIVES)
+
+        for name in names:
+            model, archive_model, date_field = ARCHIVES[name]
+            if options['dry_run']:
+                count = model.objects.filter(**{f'{date_field}__lt': cutoff}).count()
+                self.stdout.write(self.style.WARNING(f'{count} {name} dated before {cutoff} would be archived'))
+                continue
+
+            start = time.perf_counter()
+            total = 0
+            patients = set()
+            while True:
+                moved, patient_ids = archive_batch(
+                    model, archive_model, date_field, cutoff, options['batch_size'], timezone.now(),
+                )
+                total += moved
+                patients |= patient_ids
+                if moved < options['batch_size']:
+                    break
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+            if name == 'lab_tests':
+                # Raw deletes send no signals; expire the affected lab table fragments
+                for patient_id in patients:
+                    lab_tests_namespace(patient_id).bump()
+
+            elapsed = time.perf_counter() - start
+            self.stdout.write(self.style.SUCCESS(
+                f'Archived {total} {name} dated before {cutoff} in {elapsed:.2f}s '
+                f'({total / elapsed if elapsed else 0:.0f} rows/s)'
+            ))
+
+        if not options['dry_run']:
+            expired = timezone.now() - datetime.timedelta(days=settings.SYNC_TOMBSTONE_DAYS)
+            purged, _ = DeletedRecord.objects.filter(deleted_at__lt=expired).delete()
+            self.stdout.write(f'Deleted {purged} sync tombstones older than {settings.SYNC_TOMBSTONE_DAYS} days')
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+
+PORTAL_VIEWS = ['patient_dashboard', 'lab_tests', 'doctor_visits', 'invoice_list', 'pricing', 'dashboard']
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures requests per second of the portal views against the configured database. '
+        'Run once per profile (e.g. with and without DATABASE_URL) or per handler '
+        '(--handler wsgi / asgi) to compare them.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Requests per view')
+        parser.add_argument('--concurrency', type=int, default=1, help='Requests in flight at once')
+        parser.add_argument(
+            '--handler', choices=['wsgi', 'asgi'], default='wsgi',
+            help='Drive the views through the WSGI handler (one thread per in-flight request) '
+                 'or the ASGI handler (one event loop)',
+        )
+        parser.add_argument('--patient', default='patient1', help='Username to log in as (see seed_dummy_data)')
+
+    def handle(self, *args, **options):
+        try:
+            self.user = User.objects.get(username=options['patient'])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['patient']} not found; run seed_dummy_data first")
+
+        db = connection.settings_dict
+        self.stdout.write(self.style.WARNING(
+            f"Profile: {connection.vendor} ({db['NAME']}), CONN_MAX_AGE={db['CONN_MAX_AGE']}, "
+            f"OPTIONS={sorted(db.get('OPTIONS', {}))}, handler={options['handler']}, "
+            f"concurrency={options['concurrency']}"
+        ))
+
+        run = self.run_wsgi if options['handler'] == 'wsgi' else async_to_sync(self.run_asgi)
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            for view_name in PORTAL_VIEWS:
+                url = reverse(view_name)
+                elapsed = run(url, options['requests'], options['concurrency'])
+                self.stdout.write(self.style.SUCCESS(
+                    f"{view_name:<20} {options['requests'] / elapsed:8.1f} req/s  "
+                    f"{elapsed / options['requests'] * 1000:6.2f} ms/req"
+                ))
+
+    def check_response(self, url, response):
+        if response.status_code != 200:
+            raise CommandError(f'{url} returned {response.status_code}')
+
+    def run_wsgi(self, url, requests, concurrency):
+        def worker(count):
+            client = Client()
+            client.force_login(self.user)
+            client.get(url)  # warm templates and connections
+            barrier.wait()
+            for _ in range(count):
+                self.check_response(url, client.get(url))
+            close_old_connections()
+
+        counts = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+        barrier = threading.Barrier(concurrency + 1)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [pool.submit(worker, count) for count in counts]
+            barrier.wait()
+            start = time.perf_counter()
+            for future in futures:
+                future.result()
+        return time.perf_counter() - start
+
+    async def run_asgi(self, url, requests, concurrency):
+        client = AsyncClient()
+        await client.aforce_login(self.user)
+        await client.get(url)  # warm templates and connections
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                self.check_response(url, await client.get(url))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        return time.perf_counter() - start
@@ -0,0 +1,230 @@
+import http.client
+import json
+import statistics
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlparse
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from apps.core import profiling
+from apps.core.models import Invoice, LabTest
+
+from .seed_benchmark_data import CATEGORIES, USERNAME_PREFIX
+
+
+def routes():
+    """(label, url) for every page in apps.core.urls and apps.pro.urls worth timing, with each filter"""
+    result = [('portal', reverse('patient_dashboard'))]
+    lab_tests = reverse('lab_tests')
+    result.append(('lab_tests', lab_tests))
+    result += [(f'lab_tests?status={status}', f'{lab_tests}?status={status}') for status, _ in LabTest.STATUS_CHOICES]
+    result += [
+        (f'lab_tests?category={category}', f'{lab_tests}?{urlencode({"category": category})}')
+        for category in CATEGORIES
+    ]
+    result.append(('lab_tests_older', reverse('archived_lab_tests')))
+    result.append(('visits', reverse('doctor_visits')))
+    result.append(('visits_older', reverse('archived_doctor_visits')))
+    invoices = reverse('invoice_list')
+    result.append(('invoices', invoices))
+    result += [(f'invoices?status={status}', f'{invoices}?status={status}') for status, _ in Invoice.STATUS_CHOICES]
+    # The JSON API's first page next to the HTML views above
+    result.append(('api_lab_tests', reverse('api_lab_tests')))
+    result.append(('api_lab_tests?limit=500', f"{reverse('api_lab_tests')}?limit=500"))
+    result.append(('api_lab_tests?fields=id,test_name,status', f"{reverse('api_lab_tests')}?fields=id,test_name,status"))
+    result.append(('api_visits', reverse('api_doctor_visits')))
+    result.append(('api_invoices', reverse('api_invoices')))
+    result.append(('investment_calculator', reverse('investment_calculator')))
+    result.append(('pro_dashboard', reverse('dashboard')))
+    return result
+
+
+def percentiles(samples):
+    if len(samples) == 1:
+        return dict.fromkeys(('p50', 'p90', 'p95', 'p99'), samples[0])
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {'p50': cuts[49], 'p90': cuts[89], 'p95': cuts[94], 'p99': cuts[98]}
+
+
+class Command(BaseCommand):
+    help = (
+        'Times every portal route (each lab-test filter and invoice tab included) as a '
+        'seeded benchmark patient and writes latency percentiles, query counts and peak '
+        'memory as JSON. With --baseline, fails when a route regresses. Seed first with '
+        'seed_benchmark_data --scale small|100k|10m.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=20, help='Timed requests per route')
+        parser.add_argument('--warmup', type=int, default=2, help='Untimed requests per route')
+        parser.add_argument('--patient', default=f'{USERNAME_PREFIX}0')
+        parser.add_argument('--route', action='append', help='Only these route labels')
+        parser.add_argument(
+            '--base-url',
+            help='Drive a running server (e.g. http://127.0.0.1:8000) over HTTP instead of the '
+                 'test client. Query counts and memory are not available in this mode.',
+        )
+        parser.add_argument('--concurrency', type=int, default=1, help='HTTP driver connections')
+        parser.add_argument('--output', help='Write results to this JSON file')
+        parser.add_argument('--baseline', help='Compare against a previous --output file')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Allowed relative slowdown of p95 and peak memory (0.25 = 25%%)')
+        parser.add_argument('--min-delta-ms', type=float, default=2.0,
+                            help='Ignore p95 slowdowns smaller than this, which are noise')
+
+    def handle(self, *args, **options):
+        try:
+            self.user = User.objects.get(username=options['patient'])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['patient']} not found; run seed_benchmark_data first")
+
+        selected = routes()
+        if options['route']:
+            unknown = set(options['route']) - {label for label, _ in selected}
+            if unknown:
+                raise CommandError(f'Unknown routes: {", ".join(sorted(unknown))}')
+            selected = [(label, url) for label, url in selected if label in options['route']]
+
+        results = {
+            'driver': 'http' if options['base_url'] else 'client',
+            'database': connection.vendor,
+            'patient': self.user.username,
+            'rows': {model.__name__: model.objects.count() for model in (LabTest, Invoice)},
+            'requests': options['requests'],
+            'concurrency': options['concurrency'] if options['base_url'] else 1,
+            'routes': {},
+        }
+        # Rate limits would turn repeated requests into timed 429s
+        with override_settings(ALLOWED_HOSTS=['testserver', *settings.ALLOWED_HOSTS], RATE_LIMIT_ENABLED=False):
+            client = Client(raise_request_exception=False)
+            client.force_login(self.user)
+            for label, url in selected:
+                if options['base_url']:
+                    session = client.cookies[settings.SESSION_COOKIE_NAME].value
+                    result = self.run_http(options['base_url'], url, session, options)
+                else:
+                    result = self.run_client(client, url, options)
+                results['routes'][label] = result
+                self.report(label, result)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = self.compare(baseline, results, options['threshold'], options['min_delta_ms'])
+            if regressions:
+                raise CommandError('Regressions against baseline:\n  ' + '\n  '.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against baseline'))
+
+    def report(self, label, result):
+        if result['status'] != 200:
+            self.stdout.write(self.style.ERROR(f"{label:<34} HTTP {result['status']}"))
+            return
+        extra = ''
+        if result.get('queries') is not None:
+            extra = f"  {result['queries']:>4} queries  {result['peak_kb']:>8.0f} KB peak"
+        self.stdout.write(
+            f"{label:<34} p50 {result['p50']:8.2f} ms  p95 {result['p95']:8.2f} ms  "
+            f"p99 {result['p99']:8.2f} ms{extra}"
+        )
+
+    def run_client(self, client, url, options):
+        for _ in range(options['warmup']):
+            response = client.get(url)
+        if options['warmup'] and response.status_code != 200:
+            return {'status': response.status_code}
+
+        # Counted through the profiling hooks, which also see queries made
+        # from async views' sync_to_async threads
+        profiling.install()
+        profiling.instrument_connections()
+        samples = []
+        for _ in range(options['requests']):
+            profile, token = profiling.start()
+            try:
+                start = time.perf_counter()
+                response = client.get(url)
+                samples.append((time.perf_counter() - start) * 1000)
+            finally:
+                profiling.stop(token)
+            if response.status_code != 200:
+                return {'status': response.status_code}
+
+        # Separate pass: tracemalloc slows allocation-heavy code too much to time under it
+        tracemalloc.start()
+        try:
+            client.get(url)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return {
+            'status': 200, **percentiles(samples), 'queries': profile.query_count,
+            'duplicate_queries': profile.duplicate_queries, 'peak_kb': peak / 1024,
+        }
+
+    def run_http(self, base_url, url, session, options):
+        parsed = urlparse(base_url)
+        headers = {'Cookie': f'{settings.SESSION_COOKIE_NAME}={session}'}
+        samples = []
+        statuses = set()
+        lock = threading.Lock()
+
+        def worker(count):
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=60)
+            try:
+                for n in range(count):
+                    start = time.perf_counter()
+                    conn.request('GET', url, headers=headers)
+                    response = conn.getresponse()
+                    response.read()
+                    elapsed = (time.perf_counter() - start) * 1000
+                    with lock:
+                        statuses.add(response.status)
+                        if n >= options['warmup']:
+                            samples.append(elapsed)
+            finally:
+                conn.close()
+
+        concurrency = options['concurrency']
+        counts = [
+            options['warmup'] + options['requests'] // concurrency + (i < options['requests'] % concurrency)
+            for i in range(concurrency)
+        ]
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for future in [pool.submit(worker, count) for count in counts]:
+                future.result()
+        if statuses != {200} or not samples:
+            return {'status': max(statuses - {200}, default=200) if statuses else 0}
+        return {'status': 200, **percentiles(samples), 'queries': None, 'peak_kb': None}
+
+    def compare(self, baseline, results, threshold, min_delta_ms):
+        if (baseline.get('driver'), baseline.get('rows')) != (results['driver'], results['rows']):
+            self.stdout.write(self.style.WARNING('Baseline was recorded with a different driver or dataset'))
+        regressions = []
+        for label, before in baseline['routes'].items():
+            after = results['routes'].get(label)
+            if after is None or before['status'] != 200:
+                continue
+            if after['status'] != 200:
+                regressions.append(f"{label}: HTTP {after['status']} (was 200)")
+                continue
+            if after['p95'] > before['p95'] * (1 + threshold) and after['p95'] - before['p95'] > min_delta_ms:
+                regressions.append(f"{label}: p95 {before['p95']:.2f} -> {after['p95']:.2f} ms")
+            if before.get('queries') is not None and after.get('queries') is not None:
+                if after['queries'] > before['queries']:
+                    regressions.append(f"{label}: queries {before['queries']} -> {after['queries']}")
+                if after['peak_kb'] > before['peak_kb'] * (1 + threshold):
+                    regressions.append(f"{label}: peak memory {before['peak_kb']:.0f} -> {after['peak_kb']:.0f} KB")
+        return regressions
@@ -0,0 +1,141 @@
+import datetime
+import itertools
+import json
+import time
+from decimal import Decimal
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from django.utils import timezone
+
+from apps.core.models import DoctorVisit, Invoice, InvoiceLineItem, LabTest
+
+_versions = itertools.count(1)
+
+
+class Command(BaseCommand):
+    help = (
+        'Times rendering of every template in templates/core at several row counts, '
+        'cold (fragment cache empty) and warm. Uses unsaved model instances, so no '
+        'database rows are needed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', default='10,1000,10000', help='Comma-separated row counts')
+        parser.add_argument('--repeat', type=int, default=3, help='Renders per measurement (best is reported)')
+        parser.add_argument('--template', action='append', help='Only these templates (e.g. lab_tests.html)')
+
+    def handle(self, *args, **options):
+        rows = [int(n) for n in options['rows'].split(',')]
+        templates = sorted(p.name for p in (Path(settings.BASE_DIR) / 'templates' / 'core').glob('*.html'))
+        if options['template']:
+            unknown = set(options['template']) - set(templates)
+            if unknown:
+                raise CommandError(f'Unknown templates: {", ".join(sorted(unknown))}')
+            templates = options['template']
+
+        patient = User(pk=1, username='patient1', first_name='John', last_name='Smith', email='patient1@example.com')
+        request = RequestFactory().get('/')
+        request.user = patient
+
+        self.stdout.write(f"{'template':<28}{'rows':>8}{'cold ms':>12}{'warm ms':>12}")
+        for name in templates:
+            for count in rows:
+                cold = self.best_of(options['repeat'], lambda: self.context(name, patient, count), request, name)
+                context = self.context(name, patient, count)
+                render_to_string(f'core/{name}', context, request)
+                warm = self.best_of(options['repeat'], lambda: context, request, name)
+                self.stdout.write(f'{name:<28}{count:>8}{cold * 1000:>12.2f}{warm * 1000:>12.2f}')
+
+    def best_of(self, repeat, make_context, request, name):
+        best = float('inf')
+        for _ in range(repeat):
+            context = make_context()
+            start = time.perf_counter()
+            render_to_string(f'core/{name}', context, request)
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    def context(self, name, patient, count):
+        """Build a fresh context; fresh versions/timestamps make every fragment key a miss"""
+        today = datetime.date.today()
+        if name == 'lab_tests.html':
+            return {
+                'tests': [
+                    LabTest(
+                        pk=i, patient=patient, test_name=f'Test {i}', test_category='Hematology',
+                        ordered_by='Dr. Smith', order_date=today, result_date=today, status='completed',
+                        result_value='4.2', reference_range='3.5-5.0', unit='g/dL', is_abnormal=i % 7 == 0,
+                    )
+                    for i in range(count)
+                ],
+                'status_filter': 'all',
+                'category_filter': 'all',
+                'categories': ['Hematology', 'Chemistry', 'Endocrinology'],
+                'labs_version': next(_versions),
+            }
+        if name == 'doctor_visits.html':
+            return {
+                'visits': [
+                    DoctorVisit(
+                        pk=i, patient=patient, doctor_name='Dr. Brown', specialty='Cardiology',
+                        visit_date=today, visit_type='follow_up', reason='Chest pain follow-up',
+                        diagnosis='Stable', treatment_plan='Continue medication', follow_up_date=today,
+                        vitals_bp='120/80', vitals_heart_rate=72, vitals_temperature=Decimal('98.6'),
+                        vitals_weight=Decimal('170.0'),
+                    )
+                    for i in range(count)
+                ],
+                'type_filter': 'all',
+            }
+        if name == 'dashboard.html':
+            labs = self.context('lab_tests.html', patient, min(count, 5))['tests']
+            visits = self.context('doctor_visits.html', patient, min(count, 5))['visits']
+            return {
+                'recent_labs': labs, 'total_labs': count, 'pending_labs': count // 3,
+                'abnormal_labs': count // 7, 'recent_visits': visits, 'total_visits': count,
+                'upcoming_followups': visits[:3],
+            }
+        if name == 'invoices_list.html':
+            now = timezone.now()
+            invoices = []
+            for i in range(count):
+                invoice = Invoice(
+                    pk=i, invoice_number=f'INV-{i}', patient=patient, issue_date=today, due_date=today,
+                    status=('pending', 'paid', 'overdue')[i % 3], subtotal=Decimal('250.00'),
+                    tax=Decimal('20.00'), total=Decimal('270.00'), updated_at=now,
+                )
+                invoice._prefetched_objects_cache = {'line_items': [
+                    InvoiceLineItem(
+                        pk=i * 3 + j, invoice=invoice, description='Consultation', quantity=1,
+                        unit_price=Decimal('90.00'), total_price=Decimal('90.00'), service_date=today,
+                        provider_name='Dr. Smith',
+                    )
+                    for j in range(3)
+                ]}
+                invoices.append(invoice)
+            return {
+                'invoices': invoices, 'status_filter': 'all',
+                'total_unpaid_count': count, 'total_unpaid_amount': Decimal('1000.00'),
+                'total_overdue_count': count // 3, 'total_overdue_amount': Decimal('300.00'),
+                'total_paid_count': count // 3, 'total_paid_amount': Decimal('300.00'),
+                'total_revenue': Decimal('1300.00'), 'collection_rate': 23.1,
+            }
+        if name == 'investment-calculator.html':
+            yearly_data = [
+                {'year': year, 'balance': 10000 * 1.1 ** year, 'contributions': 500 * 12 * year,
+                 'interest': 10000 * (1.1 ** year - 1)}
+                for year in range(1, count + 1)
+            ]
+            return {
+                'initial_investment': 10000, 'monthly_contribution': 500, 'annual_return': 10,
+                'years': count, 'final_value': yearly_data[-1]['balance'], 'total_contributions': 0,
+                'interest_earned': 0, 'growth_multiple': 1, 'yearly_data': yearly_data,
+                'yearly_data_json': json.dumps(yearly_data),
+            }
+        # Static pages: row count does not apply
+        return {}
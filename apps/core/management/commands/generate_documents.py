@@ -0,0 +1,117 @@
+import datetime
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from apps.core import documents
+from apps.core.models import Invoice
+
+
+def last_month():
+    return (timezone.localdate().replace(day=1) - datetime.timedelta(days=1)).strftime('%Y-%m')
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes printable invoices, or the monthly statement of every patient with invoices, to '
+        '<output-dir>/invoices/ or <output-dir>/statements/<period>/. Batches of ids are '
+        'fanned out to a process pool with a bounded number in flight. Documents that '
+        'are already current are skipped, so rerunning an interrupted run resumes it.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['invoices', 'statements'])
+        parser.add_argument('--period', help='Statement month as YYYY-MM (default: last month)')
+        parser.add_argument('--output-dir', default='documents')
+        parser.add_argument('--format', choices=documents.FORMATS, default='html')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Worker processes; 1 renders in this process')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        kind = options['kind']
+        fmt = options['format']
+        if fmt == 'pdf' and not documents.pdf_available():
+            raise CommandError('PDF output needs WeasyPrint: pip install weasyprint')
+
+        period = None
+        output_dir = os.path.join(options['output_dir'], kind)
+        if kind == 'statements':
+            period = options['period'] or last_month()
+            try:
+                documents.statement_period(period)
+            except ValueError:
+                raise CommandError(f'Invalid period {period!r}; expected YYYY-MM')
+            output_dir = os.path.join(output_dir, period)
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.verbosity = options['verbosity']
+        self.written = self.skipped = 0
+        self.start = time.perf_counter()
+        batches = self.batches(kind, options['batch_size'], period)
+        args = (output_dir, fmt, period)
+        if options['workers'] <= 1:
+            for ids in batches:
+                self.tally(documents.render_batch(kind, ids, *args))
+        else:
+            self.fan_out(kind, batches, args, options['workers'])
+
+        elapsed = time.perf_counter() - self.start
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {self.written} {kind} to {output_dir}, skipped {self.skipped}, in {elapsed:.1f}s '
+            f'({(self.written + self.skipped) / elapsed if elapsed else 0:.0f} docs/s)'
+        ))
+
+    def batches(self, kind, size, period=None):
+        """Keyset-paginated id batches, so the id list is never held in memory at once"""
+        if kind == 'invoices':
+            field = 'pk'
+            queryset = Invoice.objects.values_list(field, flat=True)
+        else:
+            # Every patient with an invoice on this period's statement, whether
+            # or not they have a profile
+            field = 'patient_id'
+            queryset = documents.period_invoices(period).values_list(field, flat=True).distinct()
+        last = 0
+        while True:
+            ids = list(queryset.filter(**{f'{field}__gt': last}).order_by(field)[:size])
+            if not ids:
+                return
+            yield ids
+            last = ids[-1]
+
+    def fan_out(self, kind, batches, args, workers):
+        # Spawned rather than forked, so no worker inherits this process's
+        # database connection; each sets Django up and opens its own
+        pool = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup,
+        )
+        pending = set()
+        try:
+            for ids in batches:
+                # Cap the batches in flight so memory stays flat however many ids there are
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.tally(future.result())
+                pending.add(pool.submit(documents.render_batch, kind, ids, *args))
+            for future in wait(pending).done:
+                self.tally(future.result())
+        except KeyboardInterrupt:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise CommandError('Interrupted; run the same command again to resume')
+        pool.shutdown()
+
+    def tally(self, result):
+        written, skipped = result
+        self.written += written
+        self.skipped += skipped
+        done = self.written + self.skipped
+        if self.verbosity > 1 and done:
+            elapsed = time.perf_counter() - self.start
+            self.stdout.write(f'{done} documents ({done / elapsed:.0f}/s)')
@@ -0,0 +1,77 @@
+import csv
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.core import ingest
+from apps.core.models import LabTest
+from apps.core.signals import lab_tests_namespace
+
+
+class Command(BaseCommand):
+    help = (
+        'Streams lab results or doctor visits from a CSV or NDJSON file (optionally .gz, '
+        'or - for stdin) and upserts them on external_id in batches. Rows that fail '
+        'validation or name an unknown patient are written to a reject file; the rest of '
+        'the file is still loaded.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=ingest.MODELS)
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help='Input format (default: from the file extension)')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--match', choices=['username', 'email'], default='username',
+                            help='User field the patient column holds')
+        parser.add_argument('--rejects', help='Reject file (default: <path>.rejects.csv)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format']
+        if fmt is None:
+            name = path.removesuffix('.gz')
+            if name.endswith('.csv'):
+                fmt = 'csv'
+            elif name.endswith(('.ndjson', '.jsonl')):
+                fmt = 'ndjson'
+            else:
+                raise CommandError('Cannot tell the format from the file name; pass --format')
+        model = ingest.MODELS[options['kind']]
+        rejects = ingest.RejectFile(options['rejects'] or f'{"stdin" if path == "-" else path}.rejects.csv')
+
+        self.start = time.perf_counter()
+        written = 0
+        patients = set()
+        try:
+            with ingest.open_input(path) as stream:
+                rows = ingest.read_rows(stream, fmt)
+                rows = ingest.clean_rows(rows, model, rejects)
+                batches = ingest.batches(rows, options['batch_size'])
+                batches = ingest.resolve_patients(batches, ingest.PatientLookup(options['match']), rejects)
+                for batch in batches:
+                    count, patient_ids = ingest.upsert(model, batch, rejects)
+                    written += count
+                    patients |= patient_ids
+                    if options['verbosity'] > 1:
+                        self.stdout.write(f'{written} rows ({written / (time.perf_counter() - self.start):.0f}/s)')
+        except OSError as exc:
+            raise CommandError(f'Cannot read {path}: {exc}')
+        except (UnicodeDecodeError, csv.Error) as exc:
+            raise CommandError(f'Unreadable input after {written} rows: {exc}')
+        except KeyboardInterrupt:
+            raise CommandError(f'Interrupted after {written} rows; rerunning the file is safe')
+        finally:
+            rejects.close()
+            if model is LabTest:
+                # bulk_create sends no signals; expire the affected lab table fragments
+                for patient_id in patients:
+                    lab_tests_namespace(patient_id).bump()
+
+        elapsed = time.perf_counter() - self.start
+        self.stdout.write(self.style.SUCCESS(
+            f'Upserted {written} {options["kind"]} in {elapsed:.1f}s '
+            f'({written / elapsed if elapsed else 0:.0f} rows/s)'
+        ))
+        if rejects.count:
+            self.stdout.write(self.style.WARNING(f'Rejected {rejects.count} rows; see {rejects.path}'))
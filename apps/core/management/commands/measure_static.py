@@ -0,0 +1,61 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+
+ASSET_RE = re.compile(r'<(link|script|img)\b[^>]*?(?:href|src)="(?P<url>/static/[^"]+)"', re.IGNORECASE)
+ENCODINGS = ['identity', 'gzip', 'br']
+
+
+class Command(BaseCommand):
+    help = (
+        'Reports first-load bytes for a page and its static assets under each content '
+        'encoding, the Cache-Control each asset is served with, and an estimated '
+        'time-to-first-paint. Run with DEBUG=false after collectstatic and compress.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='/', help='Page to measure')
+        parser.add_argument('--bandwidth', type=float, default=1.6, help='Link speed in Mbit/s (default: slow 4G)')
+        parser.add_argument('--rtt', type=float, default=150, help='Round-trip time in ms')
+
+    def handle(self, *args, **options):
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            client = Client()
+            page = client.get(options['path'], headers={'accept-encoding': 'br, gzip'})
+            if page.status_code != 200:
+                raise CommandError(f"{options['path']} returned {page.status_code}")
+            html = page.content.decode()
+            assets = []
+            for match in ASSET_RE.finditer(html):
+                url = match.group('url')
+                sizes = {}
+                cache_control = ''
+                for encoding in ENCODINGS:
+                    response = client.get(url, headers={'accept-encoding': encoding})
+                    if response.status_code != 200:
+                        raise CommandError(f'{url} returned {response.status_code}')
+                    sizes[encoding] = sum(len(chunk) for chunk in response.streaming_content)
+                    cache_control = response.get('Cache-Control', '')
+                # Stylesheets in <head> block first paint; images and async scripts don't
+                assets.append((url, sizes, cache_control, match.group(1).lower() == 'link'))
+
+        self.stdout.write(self.style.WARNING(f"{options['path']}: HTML {len(page.content)} bytes"))
+        for url, sizes, cache_control, _ in assets:
+            self.stdout.write(
+                f"  {url}\n    " + '  '.join(f'{enc}={size}' for enc, size in sizes.items())
+                + f'\n    Cache-Control: {cache_control or "(none)"}'
+            )
+
+        bytes_per_ms = options['bandwidth'] * 1_000_000 / 8 / 1000
+        for encoding in ENCODINGS:
+            total = len(page.content) + sum(sizes[encoding] for _, sizes, _, _ in assets)
+            blocking = len(page.content) + sum(
+                sizes[encoding] for _, sizes, _, blocks in assets if blocks
+            )
+            # One RTT for the document, one for the stylesheets fetched in parallel
+            first_paint = 2 * options['rtt'] + blocking / bytes_per_ms
+            self.stdout.write(self.style.SUCCESS(
+                f'{encoding:<8} first-load {total:>8} bytes, render-blocking {blocking:>8} bytes, '
+                f'estimated first paint {first_paint:6.0f} ms'
+            ))
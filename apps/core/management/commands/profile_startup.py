@@ -0,0 +1,106 @@
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(?P<self>\d+)\s+\|\s+(?P<cumulative>\d+)\s+\|(?P<indent>\s+)(?P<name>\S+)$')
+
+# Runs in a fresh interpreter so nothing is already imported
+BOOT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+from django.urls import get_resolver
+get_resolver().url_patterns
+urls = time.perf_counter()
+from django.test import Client, override_settings
+with override_settings(ALLOWED_HOSTS=['testserver']):
+    status = Client().get(sys.argv[1]).status_code
+done = time.perf_counter()
+print(json.dumps({
+    'setup_ms': (setup - start) * 1000,
+    'urlconf_ms': (urls - setup) * 1000,
+    'first_request_ms': (done - urls) * 1000,
+    'total_ms': (done - start) * 1000,
+    'status': status,
+    'modules': sorted(sys.modules),
+}))
+'''
+
+
+def parse_importtime(text):
+    """Parse ``-X importtime`` output into (module, self_us, cumulative_us, depth) tuples"""
+    rows = []
+    for line in text.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            rows.append((
+                match['name'], int(match['self']), int(match['cumulative']),
+                (len(match['indent']) - 1) // 2,
+            ))
+    return rows
+
+
+def profile(path='/'):
+    """Boot Django in a subprocess and return its timings, loaded modules and import times"""
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get(
+        'DJANGO_SETTINGS_MODULE', 'StingrayHealthPortal.settings'))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', BOOT_SCRIPT, path],
+        capture_output=True, text=True, env=env,
+    )
+    if result.returncode != 0:
+        raise CommandError(f'Boot failed:\n{result.stderr[-2000:]}')
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['imports'] = parse_importtime(result.stderr)
+    return report
+
+
+def self_time_by_package(imports):
+    totals = defaultdict(int)
+    for name, self_us, _, _ in imports:
+        totals[name.split('.', 1)[0]] += self_us
+    return totals
+
+
+class Command(BaseCommand):
+    help = (
+        'Boots the project in a fresh interpreter and reports django.setup(), URLconf and '
+        'first-request time, plus the slowest imports (cumulative, as with -X importtime) '
+        'and import time per top-level package.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/', help='URL for the first request')
+        parser.add_argument('--top', type=int, default=15, help='Imports and packages to list')
+        parser.add_argument('--budget-ms', type=float, help='Fail if time-to-first-request exceeds this')
+
+    def handle(self, *args, **options):
+        report = profile(options['path'])
+
+        self.stdout.write(self.style.WARNING(
+            f"setup {report['setup_ms']:.0f} ms, URLconf {report['urlconf_ms']:.0f} ms, "
+            f"first request {report['first_request_ms']:.0f} ms (HTTP {report['status']}), "
+            f"time-to-first-request {report['total_ms']:.0f} ms"
+        ))
+
+        self.stdout.write(f"\n{'cumulative ms':>14}{'self ms':>10}  module")
+        slowest = sorted(report['imports'], key=lambda row: row[2], reverse=True)[:options['top']]
+        for name, self_us, cumulative_us, depth in slowest:
+            self.stdout.write(f"{cumulative_us / 1000:>14.1f}{self_us / 1000:>10.1f}  {'  ' * depth}{name}")
+
+        self.stdout.write(f"\n{'self ms':>14}  package")
+        totals = self_time_by_package(report['imports'])
+        for package, self_us in sorted(totals.items(), key=lambda item: item[1], reverse=True)[:options['top']]:
+            self.stdout.write(f'{self_us / 1000:>14.1f}  {package}')
+
+        budget = options['budget_ms']
+        if budget is not None and report['total_ms'] > budget:
+            raise CommandError(f"Time-to-first-request {report['total_ms']:.0f} ms exceeds budget {budget:.0f} ms")
+        self.stdout.write(self.style.SUCCESS('Done'))
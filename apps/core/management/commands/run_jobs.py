@@ -0,0 +1,153 @@
+import multiprocessing
+import signal
+import threading
+import time
+
+from django.conf import settings
+from django.core.management import execute_from_command_line
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+
+from apps.core import jobs
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs queued background jobs on --threads worker threads in each of --processes '
+        'processes. SIGTERM or Ctrl-C stops taking new jobs and waits for the running '
+        'ones. --stats prints queue depth and latency per lane and exits.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=2, help='Worker threads per process')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Worker processes; more than 1 spawns children of this command')
+        parser.add_argument('--lanes', help=f'Comma-separated lanes to serve (default: all; {", ".join(jobs.LANES)})')
+        parser.add_argument('--poll-interval', type=float, default=settings.JOB_POLL_INTERVAL,
+                            help='Seconds an idle worker waits before polling again')
+        parser.add_argument('--burst', action='store_true', help='Exit once no job is due')
+        parser.add_argument('--stats', action='store_true', help='Print queue stats and exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            return self.print_stats()
+
+        priorities = None
+        if options['lanes']:
+            try:
+                priorities = [jobs.LANES[lane.strip()] for lane in options['lanes'].split(',')]
+            except KeyError as exc:
+                raise CommandError(f'Unknown lane {exc.args[0]!r}; choose from {", ".join(jobs.LANES)}')
+
+        self.stop = threading.Event()
+        previous = signal.signal(signal.SIGTERM, lambda *_: self.stop.set())
+        try:
+            if options['processes'] > 1:
+                self.supervise(options)
+            else:
+                self.work(priorities, options)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+
+    def work(self, priorities, options):
+        self.processed = 0
+        self.lock = threading.Lock()
+        start = time.perf_counter()
+        self.maintained = None
+        self.maintain()
+
+        args = (priorities, options['poll_interval'], options['burst'])
+        try:
+            if options['threads'] <= 1:
+                self.loop(*args)
+            else:
+                threads = [
+                    threading.Thread(target=self.thread_loop, args=args, name=f'job-worker-{n}', daemon=True)
+                    for n in range(options['threads'])
+                ]
+                for thread in threads:
+                    thread.start()
+                # Wait in short steps so Ctrl-C reaches this thread promptly
+                while any(thread.is_alive() for thread in threads):
+                    self.stop.wait(options['poll_interval'])
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('Stopping; waiting for running jobs to finish'))
+            self.stop.set()
+            for thread in threading.enumerate():
+                if thread.name.startswith('job-worker-'):
+                    thread.join()
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Ran {self.processed} jobs in {elapsed:.1f}s ({self.processed / elapsed if elapsed else 0:.1f} jobs/s)'
+        ))
+
+    def loop(self, priorities, poll_interval, burst):
+        worker = jobs.worker_id()
+        while not self.stop.is_set():
+            close_old_connections()
+            job = jobs.claim(worker, priorities)
+            if job is None:
+                if burst:
+                    return
+                self.maintain()
+                self.stop.wait(poll_interval)
+                continue
+            jobs.run(job)
+            with self.lock:
+                self.processed += 1
+
+    def thread_loop(self, *args):
+        try:
+            self.loop(*args)
+        finally:
+            # Each thread has its own database connection
+            connections.close_all()
+
+    def maintain(self):
+        """Requeue orphaned jobs and purge old ones, at most once per lease period"""
+        with self.lock:
+            now = time.monotonic()
+            if self.maintained is not None and now - self.maintained < settings.JOB_LEASE_SECONDS:
+                return
+            self.maintained = now
+        requeued, _ = jobs.recover_and_purge()
+        if requeued:
+            self.stdout.write(self.style.WARNING(f'Requeued {requeued} jobs left running by a dead worker'))
+
+    def supervise(self, options):
+        argv = ['manage.py', 'run_jobs', '--threads', str(options['threads']),
+                '--poll-interval', str(options['poll_interval'])]
+        if options['lanes']:
+            argv += ['--lanes', options['lanes']]
+        if options['burst']:
+            argv.append('--burst')
+        # Spawned, not forked: each child sets Django up and opens its own connections
+        context = multiprocessing.get_context('spawn')
+        children = [
+            context.Process(target=execute_from_command_line, args=(argv,), name=f'run_jobs-{n}')
+            for n in range(options['processes'])
+        ]
+        for child in children:
+            child.start()
+        try:
+            while any(child.is_alive() for child in children) and not self.stop.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+            child.join()
+
+    def print_stats(self):
+        stats = jobs.queue_stats()
+        if not stats:
+            self.stdout.write('No queued, running or failed jobs')
+            return
+        self.stdout.write(f'{"lane":<10} {"depth":>7} {"scheduled":>10} {"running":>8} {"failed":>7} {"oldest":>9}')
+        for lane, row in stats.items():
+            self.stdout.write(
+                f'{lane:<10} {row["depth"]:>7} {row["scheduled"]:>10} {row["running"]:>8} '
+                f'{row["failed"]:>7} {row["oldest_seconds"]:>8.1f}s'
+            )
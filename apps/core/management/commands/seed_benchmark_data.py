@@ -0,0 +1,174 @@
+import random
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from apps.core.models import (
+    ArchivedDoctorVisit, ArchivedLabTest, DeletedRecord, DoctorVisit, Invoice, InvoiceLineItem, LabTest,
+    PatientProfile,
+)
+from apps.core.signals import lab_tests_namespace
+
+# scale -> (patients, total rows across lab tests, visits, invoices and line items)
+SCALES = {
+    'small': (20, 2_000),
+    '100k': (200, 100_000),
+    '10m': (10_000, 10_000_000),
+}
+# Share of the rows that goes to each table; every invoice gets two line items
+LAB_SHARE, VISIT_SHARE, INVOICE_SHARE = 0.4, 0.3, 0.1
+
+USERNAME_PREFIX = 'bench'
+CATEGORIES = ['Hematology', 'Chemistry', 'Endocrinology', 'Lipids', 'Urinalysis']
+TESTS = ['Complete Blood Count', 'Basic Metabolic Panel', 'Thyroid Panel', 'Lipid Panel', 'Urinalysis']
+DOCTORS = [('Dr. Sarah Mitchell', 'Family Medicine'), ('Dr. James Chen', 'Cardiology'),
+           ('Dr. Emily Rodriguez', 'Endocrinology'), ('Dr. Michael Brown', 'Internal Medicine')]
+VISIT_TYPES = [choice for choice, _ in DoctorVisit.VISIT_TYPE_CHOICES]
+LAB_STATUSES = [choice for choice, _ in LabTest.STATUS_CHOICES]
+INVOICE_STATUSES = [choice for choice, _ in Invoice.STATUS_CHOICES]
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds deterministic benchmark data (users bench0..benchN) at one of the '
+        'scales small, 100k or 10m. Used by benchmark_routes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=SCALES, default='small')
+        parser.add_argument('--batch-size', type=int, default=10_000)
+        parser.add_argument('--seed', type=int, default=42, help='Random seed, for reproducible data')
+        parser.add_argument('--reset', action='store_true', help='Delete existing benchmark data first')
+
+    def handle(self, *args, **options):
+        existing = User.objects.filter(username__startswith=USERNAME_PREFIX)
+        if existing.exists():
+            if not options['reset']:
+                raise CommandError('Benchmark data already exists; pass --reset to replace it')
+            self.reset(existing)
+
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        patient_count, rows = SCALES[options['scale']]
+        start = time.perf_counter()
+
+        patients = self.create_patients(patient_count)
+        labs = int(rows * LAB_SHARE)
+        visits = int(rows * VISIT_SHARE)
+        invoices = int(rows * INVOICE_SHARE)
+        self.write(LabTest, labs, lambda n: self.lab_test(patients[n % len(patients)], n))
+        self.write(DoctorVisit, visits, lambda n: self.visit(patients[n % len(patients)], n))
+        self.write_invoices(patients, invoices)
+
+        # bulk_create skips the signals that version the lab-table fragment cache
+        for patient in patients:
+            lab_tests_namespace(patient.pk).bump()
+        # Fresh planner statistics; the admin's estimated counts read them
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        total = labs + visits + invoices * 3
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded scale {options['scale']}: {patient_count} patients, {total} rows "
+            f"in {elapsed:.1f}s ({total / elapsed:.0f} rows/s)"
+        ))
+
+    def reset(self, users):
+        self.stdout.write(self.style.WARNING('Deleting existing benchmark data...'))
+        # Raw deletes: the ORM's cascade would load every row to send delete signals
+        with transaction.atomic():
+            for queryset in (
+                InvoiceLineItem.objects.filter(invoice__patient__in=users),
+                Invoice.objects.filter(patient__in=users),
+                LabTest.objects.filter(patient__in=users),
+                DoctorVisit.objects.filter(patient__in=users),
+                ArchivedLabTest.objects.filter(patient__in=users),
+                ArchivedDoctorVisit.objects.filter(patient__in=users),
+                DeletedRecord.objects.filter(patient__in=users),
+                PatientProfile.objects.filter(user__in=users),
+            ):
+                queryset._raw_delete(queryset.db)
+            users.delete()
+
+    def create_patients(self, count):
+        password = make_password('password123')
+        users = User.objects.bulk_create([
+            User(username=f'{USERNAME_PREFIX}{i}', email=f'{USERNAME_PREFIX}{i}@example.com',
+                 first_name='Bench', last_name=f'Patient {i}', password=password)
+            for i in range(count)
+        ], batch_size=self.batch_size)
+        PatientProfile.objects.bulk_create([
+            PatientProfile(
+                user=user, date_of_birth=date(1950 + i % 50, i % 12 + 1, 15),
+                phone_number=f'555-{i % 10000:04d}', address=f'{i} Benchmark Way',
+                insurance_provider=('BlueCross', 'Aetna', 'Cigna', 'UnitedHealth')[i % 4],
+                insurance_policy_number=f'BENCH-{i}',
+            )
+            for i, user in enumerate(users)
+        ], batch_size=self.batch_size)
+        return users
+
+    def write(self, model, count, make):
+        for offset in range(0, count, self.batch_size):
+            model.objects.bulk_create(
+                [make(n) for n in range(offset, min(offset + self.batch_size, count))],
+                batch_size=self.batch_size,
+            )
+
+    def write_invoices(self, patients, count):
+        for offset in range(0, count, self.batch_size):
+            with transaction.atomic():
+                invoices = Invoice.objects.bulk_create([
+                    self.invoice(patients[n % len(patients)], n)
+                    for n in range(offset, min(offset + self.batch_size, count))
+                ], batch_size=self.batch_size)
+                InvoiceLineItem.objects.bulk_create([
+                    InvoiceLineItem(
+                        invoice=invoice, description=description, unit_price=invoice.subtotal / 2,
+                        total_price=invoice.subtotal / 2, service_date=invoice.due_date - timedelta(days=30),
+                        provider_name=DOCTORS[invoice.pk % len(DOCTORS)][0],
+                    )
+                    for invoice in invoices
+                    for description in ('Office visit', 'Laboratory services')
+                ], batch_size=self.batch_size)
+
+    def day(self):
+        return date.today() - timedelta(days=self.rng.randrange(3 * 365))
+
+    def lab_test(self, patient, n):
+        status = self.rng.choice(LAB_STATUSES)
+        order_date = self.day()
+        return LabTest(
+            patient=patient, test_name=TESTS[n % len(TESTS)], test_category=CATEGORIES[n % len(CATEGORIES)],
+            ordered_by=DOCTORS[n % len(DOCTORS)][0], order_date=order_date,
+            result_date=None if status == 'pending' else order_date + timedelta(days=2), status=status,
+            result_value='' if status == 'pending' else f'{self.rng.uniform(1, 200):.1f}',
+            reference_range='1.0-150.0', unit='mg/dL', is_abnormal=self.rng.random() < 0.15,
+        )
+
+    def visit(self, patient, n):
+        doctor, specialty = DOCTORS[n % len(DOCTORS)]
+        visit_date = self.day()
+        return DoctorVisit(
+            patient=patient, doctor_name=doctor, specialty=specialty, visit_date=visit_date,
+            visit_type=VISIT_TYPES[n % len(VISIT_TYPES)], reason='Routine evaluation',
+            diagnosis='Stable', treatment_plan='Continue current plan',
+            follow_up_date=visit_date + timedelta(days=self.rng.randrange(30, 1200)) if n % 3 == 0 else None,
+            vitals_bp='120/80', vitals_heart_rate=self.rng.randrange(55, 100),
+            vitals_temperature=Decimal('98.6'), vitals_weight=Decimal(self.rng.randrange(110, 260)),
+        )
+
+    def invoice(self, patient, n):
+        subtotal = Decimal(self.rng.randrange(5_000, 200_000)) / 100
+        tax = (subtotal * Decimal('0.08')).quantize(Decimal('0.01'))
+        return Invoice(
+            invoice_number=f'BENCH-{n:08d}', patient=patient, due_date=self.day() + timedelta(days=30),
+            status=INVOICE_STATUSES[n % len(INVOICE_STATUSES)], subtotal=subtotal, tax=tax,
+            total=subtotal + tax,
+        )
@@ -0,0 +1,67 @@
+import datetime
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.core import reminders
+
+
+class Command(BaseCommand):
+    help = (
+        'Emails payment reminders for pending and overdue invoices, at most --rate '
+        'messages per second over --concurrency mail connections. Invoices reminded '
+        'within REMINDER_INTERVAL_DAYS are skipped, so reruns never duplicate.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Invoices sent per mail connection')
+        parser.add_argument('--rate', type=float, default=settings.REMINDER_SEND_RATE,
+                            help='Messages per second across all connections; 0 for no limit')
+        parser.add_argument('--concurrency', type=int, default=settings.REMINDER_CONCURRENCY)
+        parser.add_argument('--due-within', type=int, default=7, help='Also remind invoices due in this many days')
+        parser.add_argument('--today', type=datetime.date.fromisoformat, help='Run as of this date (YYYY-MM-DD)')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the reminders that would be sent')
+
+    def handle(self, *args, **options):
+        today = options['today'] or timezone.localdate()
+        due = reminders.due_for_reminder(today, options['due_within'])
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'{due.count()} reminders would be sent'))
+            return
+
+        limiter = reminders.RateLimiter(options['rate'])
+        batches = reminders.batches(due, options['batch_size'])
+        start = time.perf_counter()
+        sent = failed = 0
+
+        if options['concurrency'] <= 1:
+            results = (reminders.send_batch(batch, limiter, today) for batch in batches)
+        else:
+            results = self.fan_out(batches, limiter, today, options['concurrency'])
+        for batch_sent, batch_failed in results:
+            sent += batch_sent
+            failed += batch_failed
+
+        elapsed = time.perf_counter() - start
+        style = self.style.WARNING if failed else self.style.SUCCESS
+        self.stdout.write(style(
+            f'Sent {sent} reminders ({failed} failed) in {elapsed:.1f}s '
+            f'({sent / elapsed if elapsed else 0:.1f} msgs/s)'
+        ))
+
+    def fan_out(self, batches, limiter, today, concurrency):
+        with ThreadPoolExecutor(concurrency) as pool:
+            pending = set()
+            for batch in batches:
+                # Only fetch the next page once a connection is free for it
+                if len(pending) >= concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                pending.add(pool.submit(reminders.send_batch_in_thread, batch, limiter, today))
+            for future in wait(pending).done:
+                yield future.result()
@@ -0,0 +1,244 @@
+"""
+Lightweight in-process metrics with optional multiprocess aggregation.
+
+Counters and histograms are plain Python objects updated under a lock, so
+recording costs about a microsecond. When ``METRICS_DIR`` is set, a daemon
+thread in each worker process writes that process's values to
+``<METRICS_DIR>/metrics-<pid>.json`` every ``METRICS_FLUSH_INTERVAL`` seconds
+and ``collect()`` sums the files of every worker, so any worker can answer a
+scrape. Files of exited workers are kept so counters never go backwards; clear
+the directory when the server (not a single worker) restarts.
+"""
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+# Upper bounds in seconds, tuned for page-render budgets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """Histogram of observed values; ``counts[i]`` holds values in bucket i only (not cumulative)"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'buckets': dict(zip(self.buckets + (float('inf'),), self.counts)),
+                'sum': self.sum,
+                'count': self.count,
+            }
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return {'value': self.value}
+
+
+_metrics = {}
+_registry_lock = threading.Lock()
+_collectors = []
+
+
+def _get(cls, name, labels, **kwargs):
+    _ensure_flusher()
+    key = (name, tuple(sorted(labels.items())))
+    metric = _metrics.get(key)
+    if metric is None:
+        with _registry_lock:
+            metric = _metrics.get(key)
+            if metric is None:
+                metric = _metrics[key] = cls(name, **kwargs)
+    return metric
+
+
+def histogram(name, buckets=DEFAULT_BUCKETS, **labels):
+    """Return the process-wide histogram registered under ``name`` and ``labels``"""
+    return _get(Histogram, name, labels, buckets=buckets)
+
+
+def counter(name, **labels):
+    """Return the process-wide counter registered under ``name`` and ``labels``"""
+    return _get(Counter, name, labels)
+
+
+def register_collector(func):
+    """
+    Add series kept outside this registry (e.g. cache counters) to every
+    snapshot. ``func()`` returns ``[(name, labels, 'counter', {'value': n}), ...]``.
+    """
+    _collectors.append(func)
+
+
+def snapshot():
+    """This process's metrics as ``{name: [(labels, kind, data), ...]}``"""
+    result = {}
+    for (name, labels), metric in list(_metrics.items()):
+        data = metric.snapshot()
+        if metric.kind == 'histogram':
+            # JSON keys must be strings; +Inf is the last bucket
+            data['buckets'] = [[str(bound), count] for bound, count in data['buckets'].items()]
+        result.setdefault(name, []).append((dict(labels), metric.kind, data))
+    for collector in _collectors:
+        for name, labels, kind, data in collector():
+            result.setdefault(name, []).append((labels, kind, data))
+    return result
+
+
+# -- multiprocess ------------------------------------------------------------
+
+_flusher_pid = None
+
+
+def _metrics_dir():
+    path = getattr(settings, 'METRICS_DIR', None)
+    return Path(path) if path else None
+
+
+def _ensure_flusher():
+    """Start this process's flush thread; re-run after a fork since threads don't survive it"""
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+    if _metrics_dir() is None:
+        return
+    thread = threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True)
+    thread.start()
+
+
+def _flush_loop():
+    interval = float(getattr(settings, 'METRICS_FLUSH_INTERVAL', 1.0))
+    while True:
+        time.sleep(interval)
+        flush()
+
+
+def flush():
+    """Write this process's metrics to METRICS_DIR (atomically, via rename)"""
+    directory = _metrics_dir()
+    if directory is None:
+        return
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f'metrics-{os.getpid()}.json'
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(snapshot()))
+    os.replace(tmp, path)
+
+
+atexit.register(flush)
+
+
+def collect():
+    """Metrics summed over every worker process (or just this one without METRICS_DIR)"""
+    directory = _metrics_dir()
+    if directory is None:
+        return _merge([snapshot()])
+    flush()
+    snapshots = []
+    for path in directory.glob('metrics-*.json'):
+        try:
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            # Vanished or being replaced; its values come back next scrape
+            continue
+    return _merge(snapshots)
+
+
+def _merge(snapshots):
+    merged = {}
+    for snap in snapshots:
+        for name, series in snap.items():
+            for labels, kind, data in series:
+                key = tuple(sorted(labels.items()))
+                target = merged.setdefault(name, {}).get(key)
+                if target is None:
+                    merged[name][key] = (kind, json.loads(json.dumps(data)))
+                elif kind == 'counter':
+                    target[1]['value'] += data['value']
+                else:
+                    target[1]['sum'] += data['sum']
+                    target[1]['count'] += data['count']
+                    for bucket, (_, count) in zip(target[1]['buckets'], data['buckets']):
+                        bucket[1] += count
+    return merged
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def render(merged, help_texts=None, gauges=()):
+    """
+    Prometheus text exposition of ``collect()`` output. ``gauges`` is an
+    iterable of ``(name, labels_dict, value)`` computed at scrape time.
+    """
+    help_texts = help_texts or {}
+    lines = []
+    for name in sorted(merged):
+        series = merged[name]
+        kind = next(iter(series.values()))[0]
+        if name in help_texts:
+            lines.append(f'# HELP {name} {help_texts[name]}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, (kind, data) in sorted(series.items()):
+            if kind == 'counter':
+                lines.append(f'{name}{_format_labels(labels)} {data["value"]}')
+                continue
+            cumulative = 0
+            for bound, count in data['buckets']:
+                cumulative += count
+                le = '+Inf' if bound == 'inf' else bound
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {data["sum"]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {data["count"]}')
+
+    seen = set()
+    for name, labels, value in gauges:
+        if name not in seen:
+            seen.add(name)
+            if name in help_texts:
+                lines.append(f'# HELP {name} {help_texts[name]}')
+            lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name}{_format_labels(tuple(sorted(labels.items())))} {value}')
+    return '\n'.join(lines) + '\n'
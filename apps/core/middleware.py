@@ -0,0 +1,343 @@
+import cProfile
+import json
+import logging
+import math
+import os
+import random
+import time
+from functools import partial
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import router
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+
+from . import metrics, profiling, ratelimit, routers
+
+profile_logger = logging.getLogger('apps.core.profiling')
+
+
+def user_cache_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def _user_cache():
+    return caches[getattr(settings, 'AUTH_USER_CACHE_ALIAS', 'default')]
+
+
+def get_cached_user(request):
+    """
+    Resolve ``request.user`` from the cache when possible. A cached user is only
+    trusted if the session's auth hash still matches it (the same check
+    ``auth.get_user`` makes), so password changes still log other sessions out.
+    Anything unusual falls back to ``auth.get_user``.
+    """
+    if not hasattr(request, '_cached_user'):
+        request._cached_user = _load_user(request)
+    return request._cached_user
+
+
+def _cached_fields(model):
+    # The password hash never goes into the shared cache; the session auth
+    # hash derived from it is stored instead
+    return [field.attname for field in model._meta.concrete_fields if field.attname != 'password']
+
+
+def _load_user(request):
+    user_id = request.session.get(auth.SESSION_KEY)
+    if user_id is None:
+        return auth.get_user(request)
+
+    cache = _user_cache()
+    model = auth.get_user_model()
+    names = _cached_fields(model)
+    cached = cache.get(user_cache_key(user_id))
+    session_hash = request.session.get(auth.HASH_SESSION_KEY)
+    if (
+        cached is not None
+        and request.session.get(auth.BACKEND_SESSION_KEY) in settings.AUTHENTICATION_BACKENDS
+        and session_hash
+        and constant_time_compare(session_hash, cached['session_auth_hash'])
+    ):
+        # password is left deferred: it loads on first access, and save()
+        # writes only the fields that were loaded
+        user = model.from_db(router.db_for_read(model), names, [cached['fields'][name] for name in names])
+        user.backend = request.session[auth.BACKEND_SESSION_KEY]
+        return user
+
+    user = auth.get_user(request)
+    if user.is_authenticated:
+        cache.set(user_cache_key(user.pk), {
+            'fields': {name: getattr(user, name) for name in names},
+            'session_auth_hash': user.get_session_auth_hash(),
+        }, getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', 300))
+    return user
+
+
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    """Drop-in AuthenticationMiddleware that skips the auth_user query on warm requests"""
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: get_cached_user(request))
+        request.auser = partial(_aget_cached_user, request)
+
+
+async def _aget_cached_user(request):
+    return await sync_to_async(get_cached_user)(request)
+
+
+class MetricsMiddleware:
+    """
+    Records latency, status and query count per URL name for ``/metrics``.
+    Labels use the URL name rather than the path so series stay bounded.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        profiling.install()
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        profiling.instrument_connections()
+        profile, token = profiling.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiling.stop(token)
+        self._record(request, response, profile)
+        return response
+
+    async def __acall__(self, request):
+        profile, token = profiling.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profiling.stop(token)
+        self._record(request, response, profile)
+        return response
+
+    def _record(self, request, response, profile):
+        match = request.resolver_match
+        url_name = (match.url_name if match else None) or 'unresolved'
+        metrics.histogram('portal_http_request_duration_seconds', url_name=url_name).observe(
+            time.perf_counter() - profile.started
+        )
+        metrics.counter('portal_http_responses_total', url_name=url_name, status=response.status_code).inc()
+        metrics.histogram(
+            'portal_db_queries_per_request', buckets=metrics.QUERY_COUNT_BUCKETS, url_name=url_name,
+        ).observe(profile.query_count)
+
+
+class ProfilingMiddleware:
+    """
+    Opt-in (``PROFILING_ENABLED``) per-request profile: wall, DB, template and
+    Stripe time plus query and duplicate-query counts, sent as a
+    ``Server-Timing`` header and one JSON log line on ``apps.core.profiling``.
+    A ``PROFILING_SAMPLE_RATE`` fraction of requests is also run under cProfile
+    and dumped to ``PROFILING_DIR`` as ``<url_name>-<timestamp>-<pid>.prof``.
+    cProfile only sees the thread that handles the request, so for async views
+    it captures ORM and template work but not the event loop.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = float(getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0))
+        self.profile_dir = Path(getattr(settings, 'PROFILING_DIR', Path(settings.BASE_DIR) / 'profiles'))
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        profiling.install()
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        profiling.instrument_connections()
+        profiler = self._sampled_profiler()
+        profile, token = profiling.start()
+        try:
+            if profiler is None:
+                response = self.get_response(request)
+            else:
+                response = profiler.runcall(self.get_response, request)
+        finally:
+            profiling.stop(token)
+        return self._finish(request, response, profile, profiler)
+
+    async def __acall__(self, request):
+        profiler = self._sampled_profiler()
+        profile, token = profiling.start()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            response = await self.get_response(request)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            profiling.stop(token)
+        return self._finish(request, response, profile, profiler)
+
+    def _sampled_profiler(self):
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return cProfile.Profile()
+        return None
+
+    def _finish(self, request, response, profile, profiler):
+        profile.finish()
+        url_name = request.resolver_match.url_name if request.resolver_match else None
+        response['Server-Timing'] = profile.server_timing()
+
+        record = {
+            'path': request.path,
+            'url_name': url_name,
+            'status': response.status_code,
+            'wall_ms': round(profile.wall * 1000, 2),
+            'db_ms': round(profile.db_time * 1000, 2),
+            'queries': profile.query_count,
+            'duplicate_queries': profile.duplicate_queries,
+            'template_ms': round(profile.template_time * 1000, 2),
+            'stripe_ms': round(profile.stripe_time * 1000, 2),
+        }
+        duplicated = profile.most_duplicated()
+        if duplicated:
+            record['most_duplicated'] = {'sql': duplicated[0], 'count': duplicated[1]}
+        if profiler is not None:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            path = self.profile_dir / f'{url_name or "unresolved"}-{time.time():.6f}-{os.getpid()}.prof'
+            profiler.dump_stats(path)
+            record['cprofile'] = str(path)
+        profile_logger.info(json.dumps(record))
+        return response
+
+
+class ReplicaPinningMiddleware:
+    """
+    Pins a client's reads to the primary for ``REPLICA_STICKY_SECONDS`` after it
+    writes, using a cookie so no server-side state is needed. A request counts
+    as a write if it uses an unsafe method or the router sent a write to the DB.
+    """
+
+    sync_capable = True
+    async_capable = True
+    SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.cookie_name = getattr(settings, 'REPLICA_PIN_COOKIE', 'db_primary')
+        self.sticky_seconds = int(getattr(settings, 'REPLICA_STICKY_SECONDS', 5))
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        token = self._begin(request)
+        try:
+            response = self.get_response(request)
+            self._pin(request, response)
+        finally:
+            routers.end(token)
+        return response
+
+    async def __acall__(self, request):
+        token = self._begin(request)
+        try:
+            response = await self.get_response(request)
+            self._pin(request, response)
+        finally:
+            routers.end(token)
+        return response
+
+    def _begin(self, request):
+        return routers.begin(
+            pinned=self.cookie_name in request.COOKIES or request.method not in self.SAFE_METHODS
+        )
+
+    def _pin(self, request, response):
+        if routers.current().wrote or request.method not in self.SAFE_METHODS:
+            response.set_cookie(
+                self.cookie_name, '1', max_age=self.sticky_seconds, httponly=True,
+                samesite='Lax', secure=request.is_secure(),
+            )
+
+
+class RateLimitMiddleware:
+    """
+    Token-bucket limits per URL name (``RATE_LIMITS``), drawn from buckets in
+    the shared cache keyed by user, or by client IP for anonymous requests.
+    Over-limit requests get a 429 with ``Retry-After`` before the view runs.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        limits = getattr(settings, 'RATE_LIMITS', {})
+        if not getattr(settings, 'RATE_LIMIT_ENABLED', True) or not limits:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.limits = {url_name: ratelimit.parse_rate(rate) for url_name, rate in limits.items()}
+        self.limiter = ratelimit.TokenBucketLimiter(getattr(settings, 'RATE_LIMIT_CACHE_ALIAS', 'shared'))
+        self.ip_header = getattr(settings, 'RATE_LIMIT_IP_HEADER', None)
+        self.proxy_hops = max(int(getattr(settings, 'RATE_LIMIT_TRUSTED_PROXIES', 1)), 1)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        return await self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        url_name = request.resolver_match.url_name
+        limit = self.limits.get(url_name)
+        if limit is None:
+            return None
+        allowed, retry_after = self.limiter.consume(f'{url_name}:{self._client(request)}', *limit)
+        metrics.counter(
+            'portal_rate_limit_decisions_total', url_name=url_name, result='allowed' if allowed else 'throttled',
+        ).inc()
+        if allowed:
+            return None
+        response = HttpResponse('Too many requests. Please try again later.', status=429, content_type='text/plain')
+        response['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+
+    def _client(self, request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return f'user:{user.pk}'
+        # Behind a proxy REMOTE_ADDR is the proxy. Each trusted proxy appends the
+        # address it saw, so the client is the entry the outermost one added,
+        # counted from the right; entries left of it are whatever the client sent
+        forwarded = request.META.get(self.ip_header, '') if self.ip_header else ''
+        entries = [entry.strip() for entry in forwarded.split(',') if entry.strip()]
+        if not entries:
+            return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+        return f'ip:{entries[-min(self.proxy_hops, len(entries))]}'
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.6 on 2026-10-19 12:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_doctorvisit_labtest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='doctorvisit',
+            name='doctor_name',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='doctorvisit',
+            name='visit_date',
+            field=models.DateField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='invoice',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='invoicelineitem',
+            name='provider_name',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='labtest',
+            name='order_date',
+            field=models.DateField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='labtest',
+            name='test_name',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.6 on 2026-10-19 12:09
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_admin_search_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['due_date'], name='invoice_pending_due_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-19 12:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_invoice_pending_due_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='last_reminder_sent_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
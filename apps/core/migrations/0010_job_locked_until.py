@@ -0,0 +1,29 @@
+# Generated by Django 5.2.6 on 2026-10-19 14:54
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_locked_until(apps, schema_editor):
+    # Jobs running across the deploy keep the lease they were claimed with
+    apps.get_model('core', 'Job').objects.filter(status='running').update(
+        locked_until=models.F('started_at') + timedelta(seconds=settings.JOB_LEASE_SECONDS),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_external_ids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_locked_until, migrations.RunPython.noop),
+    ]
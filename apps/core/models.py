@@ -17,19 +17,21 @@ class PatientProfile(models.Model):
         return f"{self.user.get_full_name()} - {self.user.email}"
 
 
-class LabTest(models.Model):
-    """Lab test results for a patient"""
+class LabTestBase(models.Model):
+    """Lab test fields shared by the live table and its archive"""
     STATUS_CHOICES = [
         ('pending', 'Pending'),
         ('completed', 'Completed'),
         ('reviewed', 'Reviewed'),
     ]
 
-    patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='lab_tests')
-    test_name = models.CharField(max_length=200)
+    # The sending system's id, which ingest_records upserts on; null for rows entered here
+    external_id = models.CharField(max_length=64, unique=True, null=True, blank=True)
+
+    test_name = models.CharField(max_length=200, db_index=True)
     test_category = models.CharField(max_length=100)
     ordered_by = models.CharField(max_length=100)
-    order_date = models.DateField()
+    order_date = models.DateField(db_index=True)
     result_date = models.DateField(null=True, blank=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     result_value = models.CharField(max_length=100, blank=True)
@@ -38,16 +40,36 @@ class LabTest(models.Model):
     is_abnormal = models.BooleanField(default=False)
     notes = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
+        abstract = True
         ordering = ['-order_date']
 
     def __str__(self):
         return f"{self.test_name} - {self.patient.get_full_name()} ({self.status})"
 
 
-class DoctorVisit(models.Model):
-    """Record of a patient's doctor visit"""
+class LabTest(LabTestBase):
+    """Lab test results for a patient"""
+    patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='lab_tests')
+
+    class Meta(LabTestBase.Meta):
+        # Delta sync: a patient's rows changed since a watermark
+        indexes = [models.Index(fields=['patient', 'updated_at'], name='labtest_patient_updated_idx')]
+
+
+class ArchivedLabTest(LabTestBase):
+    """Lab tests older than ARCHIVE_HORIZON_DAYS, moved here by archive_records with their ids kept"""
+    patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_lab_tests')
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta(LabTestBase.Meta):
+        indexes = [models.Index(fields=['patient', '-order_date'], name='archived_lab_patient_idx')]
+
+
+class DoctorVisitBase(models.Model):
+    """Doctor visit fields shared by the live table and its archive"""
     VISIT_TYPE_CHOICES = [
         ('checkup', 'Annual Checkup'),
         ('follow_up', 'Follow-up'),
@@ -56,10 +78,11 @@ class DoctorVisit(models.Model):
         ('preventive', 'Preventive Care'),
     ]
 
-    patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='doctor_visits')
-    doctor_name = models.CharField(max_length=100)
+    external_id = models.CharField(max_length=64, unique=True, null=True, blank=True)
+
+    doctor_name = models.CharField(max_length=100, db_index=True)
     specialty = models.CharField(max_length=100)
-    visit_date = models.DateField()
+    visit_date = models.DateField(db_index=True)
     visit_type = models.CharField(max_length=20, choices=VISIT_TYPE_CHOICES, default='checkup')
     reason = models.CharField(max_length=300)
     diagnosis = models.TextField(blank=True)
@@ -71,14 +94,52 @@ class DoctorVisit(models.Model):
     vitals_weight = models.DecimalField(max_digits=5, decimal_places=1, null=True, blank=True)
     notes = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
+        abstract = True
         ordering = ['-visit_date']
 
     def __str__(self):
         return f"{self.doctor_name} - {self.patient.get_full_name()} ({self.visit_date})"
 
 
+class DoctorVisit(DoctorVisitBase):
+    """Record of a patient's doctor visit"""
+    patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='doctor_visits')
+
+    class Meta(DoctorVisitBase.Meta):
+        indexes = [models.Index(fields=['patient', 'updated_at'], name='visit_patient_updated_idx')]
+
+
+class ArchivedDoctorVisit(DoctorVisitBase):
+    """Doctor visits older than ARCHIVE_HORIZON_DAYS, moved here by archive_records with their ids kept"""
+    patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_doctor_visits')
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta(DoctorVisitBase.Meta):
+        indexes = [models.Index(fields=['patient', '-visit_date'], name='archived_visit_patient_idx')]
+
+
+class DeletedRecord(models.Model):
+    """Tombstone for a deleted lab test or doctor visit, so delta sync can tell clients to drop it"""
+    RECORD_TYPE_CHOICES = [
+        ('lab_tests', 'Lab test'),
+        ('visits', 'Doctor visit'),
+    ]
+
+    record_type = models.CharField(max_length=20, choices=RECORD_TYPE_CHOICES)
+    record_id = models.BigIntegerField()
+    patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='deleted_records')
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['patient', 'deleted_at'], name='deleted_patient_idx')]
+
+    def __str__(self):
+        return f"{self.record_type} #{self.record_id} deleted {self.deleted_at}"
+
+
 class Invoice(models.Model):
     """Medical invoice for patient services"""
     STATUS_CHOICES = [
@@ -98,11 +159,17 @@ class Invoice(models.Model):
     total = models.DecimalField(max_digits=10, decimal_places=2)
     notes = models.TextField(blank=True)
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='created_invoices')
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
+    last_reminder_sent_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Only pending invoices are candidates for mark_overdue_invoices, and
+            # rows leave this index as soon as they are transitioned
+            models.Index(fields=['due_date'], condition=models.Q(status='pending'), name='invoice_pending_due_idx'),
+        ]
 
     def __str__(self):
         return f"{self.invoice_number} - {self.patient.get_full_name()} - ${self.total}"
@@ -116,7 +183,46 @@ class InvoiceLineItem(models.Model):
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
     service_date = models.DateField()
-    provider_name = models.CharField(max_length=100)
+    provider_name = models.CharField(max_length=100, db_index=True)
 
     def __str__(self):
         return f"{self.description} - ${self.total_price}"
+
+
+class Job(models.Model):
+    """Background job in the database-backed queue (see apps/core/jobs.py)"""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+
+    task = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    priority = models.SmallIntegerField(default=10)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    # Renewed by the worker while the job runs; past it, the worker is presumed dead
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['priority', 'run_at']
+        indexes = [
+            # The dequeue query; finished jobs drop out of it
+            models.Index(
+                fields=['priority', 'run_at'], condition=models.Q(status='queued'), name='job_queued_idx',
+            ),
+            models.Index(fields=['status', 'finished_at'], name='job_status_finished_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.task} #{self.pk} ({self.status})"
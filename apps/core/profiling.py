@@ -0,0 +1,136 @@
+"""
+Per-request profile collected by ``ProfilingMiddleware``.
+
+The active profile lives in a context variable, so it follows a request into
+``sync_to_async`` threads. Database time is recorded by an execute wrapper
+installed on every connection, template time by wrapping ``Template.render``
+(outermost render only, so includes and nested renders aren't counted twice),
+and Stripe time by ``stripe_client.call``. With no active profile, each hook
+is a single context-variable lookup.
+"""
+import contextvars
+import time
+from collections import Counter
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template import base as template_base
+
+_current = contextvars.ContextVar('request_profile', default=None)
+_installed = False
+
+
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.wall = 0.0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.stripe_time = 0.0
+        self.template_depth = 0
+        self.queries = Counter()
+
+    @property
+    def query_count(self):
+        return sum(self.queries.values())
+
+    @property
+    def duplicate_queries(self):
+        """Queries repeated with the same SQL (differing only in parameters), the usual N+1 shape"""
+        return sum(count - 1 for count in self.queries.values() if count > 1)
+
+    def most_duplicated(self):
+        sql, count = self.queries.most_common(1)[0] if self.queries else ('', 0)
+        return (sql, count) if count > 1 else None
+
+    def finish(self):
+        self.wall = time.perf_counter() - self.started
+
+    def server_timing(self):
+        return ', '.join([
+            f'total;dur={self.wall * 1000:.1f}',
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.query_count} queries, '
+            f'{self.duplicate_queries} duplicate"',
+            f'tpl;dur={self.template_time * 1000:.1f}',
+            f'stripe;dur={self.stripe_time * 1000:.1f}',
+        ])
+
+
+def start():
+    """
+    Begin profiling the current request; returns (profile, token) for ``stop``.
+    Nested calls (metrics and profiling middleware both active) share the outer profile.
+    """
+    profile = _current.get()
+    if profile is not None:
+        return profile, None
+    profile = RequestProfile()
+    return profile, _current.set(profile)
+
+
+def stop(token):
+    if token is not None:
+        _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+def record_stripe(seconds):
+    profile = _current.get()
+    if profile is not None:
+        profile.stripe_time += seconds
+
+
+def _record_query(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.db_time += time.perf_counter() - start
+        profile.queries[sql] += 1
+
+
+def _add_query_recorder(connection):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    _add_query_recorder(connection)
+
+
+def instrument_connections():
+    """Make sure this thread's open connections record queries (new ones are covered by the signal)"""
+    for connection in connections.all(initialized_only=True):
+        _add_query_recorder(connection)
+
+
+def install():
+    """Hook queries and template rendering; idempotent"""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    connection_created.connect(_on_connection_created, dispatch_uid='apps.core.profiling')
+
+    render = template_base.Template.render
+
+    def timed_render(self, context):
+        profile = _current.get()
+        if profile is None:
+            return render(self, context)
+        profile.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return render(self, context)
+        finally:
+            profile.template_depth -= 1
+            if profile.template_depth == 0:
+                profile.template_time += time.perf_counter() - start
+
+    template_base.Template.render = timed_render
@@ -0,0 +1,78 @@
+"""
+Token-bucket rate limits kept in the shared cache, so every worker process
+draws from the same buckets.
+
+A limit such as ``"30/m"`` is a bucket holding 30 tokens that refills at 30
+per minute: a client can burst 30 requests, then continue at the refill
+rate. Each bucket is a single cache entry holding ``(tokens, last_refill)``.
+On Redis the read-refill-take-write step runs as one Lua script, so it is
+atomic across workers and costs one round trip. Other backends do it with
+get and set under a per-process lock, which is exact within a process but
+can let a few extra requests through when processes race.
+"""
+import math
+import threading
+import time
+
+from django.core.cache import caches
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return {allowed, tostring(tokens)}
+"""
+
+
+def parse_rate(rate):
+    """``"30/m"`` -> ``(30, 0.5)``: bucket capacity and tokens refilled per second"""
+    count, _, period = rate.partition('/')
+    try:
+        capacity = int(count)
+        seconds = PERIODS[period.strip()[:1].lower()]
+    except (KeyError, ValueError):
+        raise ValueError(f'Invalid rate {rate!r}; expected e.g. "30/m"')
+    return capacity, capacity / seconds
+
+
+class TokenBucketLimiter:
+    """``consume(key, capacity, refill)`` takes a token and returns ``(allowed, retry_after_seconds)``"""
+
+    def __init__(self, cache_alias='shared'):
+        self.cache_alias = cache_alias
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, refill):
+        # Looked up per call: Django hands each thread its own cache connection
+        cache = caches[self.cache_alias]
+        key = f'ratelimit:{key}'
+        # Long enough to refill completely; an expired bucket is a full one
+        timeout = math.ceil(capacity / refill) + 1
+        now = time.time()
+        client = getattr(cache, '_cache', None)
+        if hasattr(client, 'get_client'):
+            script = client.get_client(write=True).register_script(TOKEN_BUCKET_LUA)
+            allowed, tokens = script(keys=[cache.make_and_validate_key(key)], args=[capacity, refill, now, timeout])
+            allowed, tokens = bool(int(allowed)), float(tokens)
+        else:
+            with self._lock:
+                tokens, updated = cache.get(key, (capacity, now))
+                tokens = min(capacity, tokens + max(0.0, now - updated) * refill)
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= 1
+                cache.set(key, (tokens, now), timeout)
+        return allowed, 0 if allowed else (1 - tokens) / refill
@@ -0,0 +1,115 @@
+"""
+Payment reminder emails for pending and overdue invoices.
+
+Invoices are read in keyset-paged batches and each batch is sent over a
+single mail connection from ``get_connection``. Up to ``concurrency`` batches
+send at once (SMTP connections aren't thread-safe, so each has its own),
+while one ``RateLimiter`` paces messages across all of them. Every sent
+reminder is stamped on ``Invoice.last_reminder_sent_at`` straight away, so a
+rerun, even after a crash, doesn't email the same invoice twice within
+``REMINDER_INTERVAL_DAYS``.
+"""
+import datetime
+import logging
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connections
+from django.db.models import Q
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .models import Invoice
+
+logger = logging.getLogger(__name__)
+
+UNPAID_STATUSES = ['pending', 'overdue']
+
+
+class RateLimiter:
+    """Spaces calls to ``wait()`` at least ``1 / rate`` seconds apart, across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def due_for_reminder(as_of, due_within_days=7, interval_days=None):
+    """Unpaid invoices due by ``as_of + due_within_days`` that weren't reminded recently"""
+    if interval_days is None:
+        interval_days = settings.REMINDER_INTERVAL_DAYS
+    reminded_before = timezone.now() - datetime.timedelta(days=interval_days)
+    return (
+        Invoice.objects.filter(
+            status__in=UNPAID_STATUSES, due_date__lte=as_of + datetime.timedelta(days=due_within_days),
+        )
+        .filter(Q(last_reminder_sent_at__isnull=True) | Q(last_reminder_sent_at__lt=reminded_before))
+        .exclude(patient__email='')
+    )
+
+
+def batches(queryset, size):
+    """Keyset pages of ``queryset`` with the patient loaded"""
+    last = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last).select_related('patient').order_by('pk')[:size])
+        if not batch:
+            return
+        yield batch
+        last = batch[-1].pk
+
+
+def reminder_message(invoice, as_of, connection=None):
+    context = {
+        'invoice': invoice,
+        'patient': invoice.patient,
+        'days_overdue': (as_of - invoice.due_date).days,
+    }
+    subject = render_to_string('core/emails/invoice_reminder_subject.txt', context).strip()
+    body = render_to_string('core/emails/invoice_reminder.txt', context)
+    return EmailMessage(subject, body, to=[invoice.patient.email], connection=connection)
+
+
+def send_batch(invoices, limiter, as_of):
+    """Send one batch over one connection; returns ``(sent, failed)``"""
+    sent = failed = 0
+    connection = get_connection()
+    try:
+        connection.open()
+    except (smtplib.SMTPException, OSError):
+        logger.exception('Could not connect to the mail server; %d reminders not sent', len(invoices))
+        return 0, len(invoices)
+    try:
+        for invoice in invoices:
+            limiter.wait()
+            try:
+                connection.send_messages([reminder_message(invoice, as_of, connection)])
+            except (smtplib.SMTPException, OSError):
+                logger.exception('Reminder for invoice %s failed', invoice.invoice_number)
+                failed += 1
+                continue
+            Invoice.objects.filter(pk=invoice.pk).update(last_reminder_sent_at=timezone.now())
+            sent += 1
+    finally:
+        connection.close()
+    return sent, failed
+
+
+def send_batch_in_thread(invoices, limiter, as_of):
+    try:
+        return send_batch(invoices, limiter, as_of)
+    finally:
+        # Worker threads open their own database connections
+        connections.close_all()
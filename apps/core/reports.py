@@ -0,0 +1,95 @@
+"""Accounts-receivable aging, bucketed and summed in the database"""
+import csv
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import Count, F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Invoice
+from .routers import replica_reads
+from .signals import invoices_namespace
+
+CENT = Decimal('0.01')
+UNPAID_STATUSES = ['pending', 'overdue']
+# (key, label, first day past due, last day past due); None is open-ended
+AGING_BUCKETS = [
+    ('current', 'Current', None, 0),
+    ('days_1_30', '1-30 days', 1, 30),
+    ('days_31_60', '31-60 days', 31, 60),
+    ('days_61_90', '61-90 days', 61, 90),
+    ('days_over_90', '90+ days', 91, None),
+]
+NO_INSURANCE_LABEL = 'No insurance on file'
+# Aging only moves at midnight, so one computation serves the whole day
+AGING_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def _bucket_filter(as_of, first, last):
+    # n days past due <=> due_date == as_of - n, so the bounds flip
+    condition = Q()
+    if first is not None:
+        condition &= Q(due_date__lte=as_of - timedelta(days=first))
+    if last is not None:
+        condition &= Q(due_date__gte=as_of - timedelta(days=last))
+    return condition
+
+
+def compute_ar_aging(as_of):
+    """
+    One row per insurance provider with the unpaid amount and invoice count in
+    each aging bucket. A single GROUP BY over unpaid invoices joined to the
+    patient profile; each bucket is a conditional aggregate.
+    """
+    aggregates = {}
+    for key, _, first, last in AGING_BUCKETS:
+        condition = _bucket_filter(as_of, first, last)
+        aggregates[f'{key}_amount'] = Sum('total', filter=condition, default=0)
+        aggregates[f'{key}_count'] = Count('pk', filter=condition)
+    aggregates['total_amount'] = Sum('total', default=0)
+    aggregates['total_count'] = Count('pk')
+
+    rows = list(
+        Invoice.objects.filter(status__in=UNPAID_STATUSES)
+        .values(insurance_provider=Coalesce(F('patient__patient_profile__insurance_provider'), Value('')))
+        .annotate(**aggregates)
+        .order_by()
+    )
+    # Providers alphabetically, patients without insurance last
+    rows.sort(key=lambda row: (not row['insurance_provider'], row['insurance_provider']))
+    for row in rows:
+        row['insurance_provider'] = row['insurance_provider'] or NO_INSURANCE_LABEL
+        # SQLite sums decimals as floats
+        for field in aggregates:
+            if field.endswith('_amount'):
+                row[field] = Decimal(row[field]).quantize(CENT)
+
+    totals = {'insurance_provider': 'Total'}
+    for field in aggregates:
+        totals[field] = sum(row[field] for row in rows)
+    return {'as_of': as_of, 'rows': rows, 'totals': totals}
+
+
+def ar_aging(as_of=None):
+    """The aging report for ``as_of`` (default today), cached until invoices change or the day ends"""
+    as_of = as_of or timezone.localdate()
+
+    def compute():
+        with replica_reads():
+            return compute_ar_aging(as_of)
+
+    return invoices_namespace().get_or_set(f'ar_aging:{as_of.isoformat()}', compute, AGING_CACHE_TIMEOUT)
+
+
+def write_ar_aging_csv(report, file):
+    writer = csv.writer(file)
+    header = ['Insurance provider']
+    for _, label, _, _ in AGING_BUCKETS:
+        header += [f'{label} amount', f'{label} count']
+    writer.writerow(header + ['Total amount', 'Total count'])
+    for row in [*report['rows'], report['totals']]:
+        values = [row['insurance_provider']]
+        for key, _, _, _ in AGING_BUCKETS:
+            values += [row[f'{key}_amount'], row[f'{key}_count']]
+        writer.writerow(values + [row['total_amount'], row['total_count']])
@@ -0,0 +1,177 @@
+"""
+Read-replica routing.
+
+Reads go to a replica only inside ``replica_reads`` (a decorator for read-only
+views, or a context manager for reports); everything else, and every write,
+uses ``default``. Within such a block reads still fall back to the primary
+when:
+
+- the request has already written, or is inside a transaction,
+- the client wrote within the last ``REPLICA_STICKY_SECONDS`` (a cookie set by
+  ``ReplicaPinningMiddleware``), so users always see their own writes,
+- every replica lags more than ``REPLICA_MAX_LAG_SECONDS``.
+
+``REPLICA_SELECTION`` picks among the replicas within the lag limit by
+``round_robin`` or ``least_lag``.
+Replicas are configured with ``DATABASE_REPLICA_URLS`` (see settings).
+"""
+import contextvars
+import functools
+import itertools
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+PRIMARY = 'default'
+
+
+class RoutingState:
+    """Per-request routing flags; mutated in place so sync_to_async threads share it"""
+
+    __slots__ = ('replica_ok', 'pinned', 'wrote')
+
+    def __init__(self, pinned=False):
+        self.replica_ok = False
+        self.pinned = pinned
+        self.wrote = False
+
+
+_state = contextvars.ContextVar('db_routing', default=None)
+
+
+def begin(pinned=False):
+    """Start routing state for a request; returns a token for ``end``"""
+    return _state.set(RoutingState(pinned))
+
+
+def end(token):
+    _state.reset(token)
+
+
+def current():
+    return _state.get()
+
+
+class replica_reads:
+    """
+    Allow reads to go to a replica. Works as a context manager and as a
+    decorator for sync and async views.
+    """
+
+    def __enter__(self):
+        state = _state.get()
+        if state is None:
+            self._token = _state.set(RoutingState())
+            state = _state.get()
+        else:
+            self._token = None
+        self._previous = state.replica_ok
+        state.replica_ok = True
+        return state
+
+    def __exit__(self, *exc_info):
+        _state.get().replica_ok = self._previous
+        if self._token is not None:
+            _state.reset(self._token)
+
+    def __call__(self, func):
+        if iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with replica_reads():
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with replica_reads():
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def replica_lag(alias):
+    """Seconds the replica is behind its primary; 0 where the backend can't tell (e.g. SQLite)"""
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)'
+        )
+        return float(cursor.fetchone()[0])
+
+
+class ReplicaRouter:
+    def __init__(self):
+        self.replicas = list(getattr(settings, 'DATABASE_REPLICAS', []))
+        self.selection = getattr(settings, 'REPLICA_SELECTION', 'round_robin')
+        self.max_lag = float(getattr(settings, 'REPLICA_MAX_LAG_SECONDS', 10))
+        self.lag_check_interval = float(getattr(settings, 'REPLICA_LAG_CHECK_INTERVAL', 5))
+        self._cycle = itertools.cycle(self.replicas)
+        self._lock = threading.Lock()
+        self._lags = {}
+        self._lags_checked_at = float('-inf')
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if (
+            not self.replicas
+            or state is None
+            or not state.replica_ok
+            or state.pinned
+            or state.wrote
+            or connections[PRIMARY].in_atomic_block
+        ):
+            return PRIMARY
+        return self.pick_replica()
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY, *self.replicas}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive schema changes through replication
+        if db in self.replicas:
+            return False
+        return None
+
+    def pick_replica(self):
+        lags = self.lags()
+        healthy = [alias for alias in self.replicas if lags.get(alias, float('inf')) <= self.max_lag]
+        if not healthy:
+            return PRIMARY
+        if self.selection == 'least_lag':
+            return min(healthy, key=lags.__getitem__)
+        with self._lock:
+            # Lagging replicas are skipped over, not taken out of the rotation
+            for _ in self.replicas:
+                alias = next(self._cycle)
+                if alias in healthy:
+                    return alias
+
+    def lags(self):
+        """Replica lags, re-measured at most every ``REPLICA_LAG_CHECK_INTERVAL`` seconds"""
+        with self._lock:
+            if time.monotonic() - self._lags_checked_at < self.lag_check_interval:
+                return self._lags
+            self._lags_checked_at = time.monotonic()
+        lags = {}
+        for alias in self.replicas:
+            try:
+                lags[alias] = replica_lag(alias)
+            except DatabaseError:
+                # Unreachable replicas drop out until the next check
+                lags[alias] = float('inf')
+        self._lags = lags
+        return lags
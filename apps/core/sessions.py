@@ -0,0 +1,79 @@
+"""
+Cache-first session engine with write-behind to the database.
+
+Reads come from the cache and only fall back to the ``django_session`` table
+on a miss. Creating a session (login, key rotation) always writes the row.
+Later changes are written to the cache immediately but reach the database at
+most once every ``SESSION_WRITE_BEHIND_SECONDS``, so a busy session costs one
+UPDATE per window instead of one per request. Saves that would not change the
+stored data are skipped entirely.
+
+If the cache loses an entry between database writes, up to one window of
+session changes is lost; the session itself survives from the database copy.
+"""
+import copy
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+
+KEY_PREFIX = 'apps.core.sessions'
+
+
+class SessionStore(CachedDBStore):
+    cache_key_prefix = KEY_PREFIX
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        self._loaded_snapshot = None
+
+    def load(self):
+        data = super().load()
+        self._loaded_snapshot = copy.deepcopy(data)
+        return data
+
+    async def aload(self):
+        data = await super().aload()
+        self._loaded_snapshot = copy.deepcopy(data)
+        return data
+
+    def _is_unchanged(self):
+        return (
+            self._loaded_snapshot is not None
+            and self.session_key is not None
+            and self._session == self._loaded_snapshot
+        )
+
+    def _persisted_key(self, session_key):
+        return f'{self.cache_key_prefix}{session_key}:persisted'
+
+    def _db_write_due(self):
+        # add() is atomic in the shared cache, so one request per window wins
+        return self._cache.add(
+            self._persisted_key(self.session_key), 1,
+            getattr(settings, 'SESSION_WRITE_BEHIND_SECONDS', 60),
+        )
+
+    def save(self, must_create=False):
+        if not must_create and self._is_unchanged():
+            return
+        if must_create or self.session_key is None:
+            super().save(must_create)
+            self._cache.set(
+                self._persisted_key(self.session_key), 1,
+                getattr(settings, 'SESSION_WRITE_BEHIND_SECONDS', 60),
+            )
+        elif self._db_write_due():
+            super().save(must_create)
+        else:
+            self._cache.set(self.cache_key, self._session, self.get_expiry_age())
+        self._loaded_snapshot = copy.deepcopy(self._session)
+
+    async def asave(self, must_create=False):
+        await sync_to_async(self.save)(must_create)
+
+    def delete(self, session_key=None):
+        key = session_key or self.session_key
+        super().delete(session_key)
+        if key is not None:
+            self._cache.delete(self._persisted_key(key))
@@ -0,0 +1,56 @@
+"""Cache invalidation for the cached user loader and template fragments"""
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import Namespace
+from .middleware import user_cache_key
+from .models import DeletedRecord, DoctorVisit, Invoice, InvoiceLineItem, LabTest
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    """Drop the cached copy so the next request reloads the user from the DB."""
+    caches[getattr(settings, 'AUTH_USER_CACHE_ALIAS', 'default')].delete(user_cache_key(instance.pk))
+
+
+def lab_tests_namespace(patient_id):
+    return Namespace(cache, f'labs:{patient_id}')
+
+
+@receiver([post_save, post_delete], sender=LabTest)
+def bump_lab_tests_version(sender, instance, **kwargs):
+    """Invalidate the patient's cached lab table fragments."""
+    lab_tests_namespace(instance.patient_id).bump()
+
+
+@receiver(post_delete, sender=LabTest)
+@receiver(post_delete, sender=DoctorVisit)
+def record_deletion(sender, instance, origin=None, **kwargs):
+    """Leave a tombstone so delta sync clients drop the row too."""
+    if isinstance(origin, User) or getattr(origin, 'model', None) is User:
+        # The patient is being deleted; their tombstones go with them
+        return
+    DeletedRecord.objects.create(
+        record_type='lab_tests' if sender is LabTest else 'visits', record_id=instance.pk, patient_id=instance.patient_id,
+    )
+
+
+def invoices_namespace():
+    """Versions every cached invoice rollup; bumped on any invoice change"""
+    return Namespace(cache, 'invoices')
+
+
+@receiver([post_save, post_delete], sender=Invoice)
+def bump_invoices_version(sender, instance, **kwargs):
+    """Invalidate cached invoice rollups."""
+    invoices_namespace().bump()
+
+
+@receiver([post_save, post_delete], sender=InvoiceLineItem)
+def touch_invoice(sender, instance, **kwargs):
+    """Line items render inside the invoice card, so bump the invoice's updated_at."""
+    Invoice.objects.filter(pk=instance.invoice_id).update(updated_at=timezone.now())
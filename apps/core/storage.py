@@ -0,0 +1,18 @@
+"""Static file storage used by django-compressor's offline bundles"""
+from compressor.storage import CompressorFileStorage
+from whitenoise.compress import Compressor
+
+
+class PrecompressedCompressorFileStorage(CompressorFileStorage):
+    """
+    Writes gzip and Brotli siblings next to every bundle ``compress`` emits, so
+    WhiteNoise can serve them without compressing at request time.
+    """
+
+    def save(self, filename, content):
+        filename = super().save(filename, content)
+        compressor = Compressor(quiet=True)
+        path = self.path(filename)
+        if compressor.should_compress(path):
+            compressor.compress(path)
+        return filename
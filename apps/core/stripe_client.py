@@ -0,0 +1,180 @@
+"""
+Shared Stripe client with pooled connections, timeouts and a circuit breaker.
+
+``stripe``, ``requests`` and dj-stripe's settings are imported on first use so
+importing this module (and the views that use it) costs nothing at boot.
+"""
+import os
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import metrics, profiling
+
+
+class StripeUnavailable(Exception):
+    """Raised when Stripe is failing and calls are being short-circuited"""
+
+
+class CircuitBreaker:
+    """
+    Opens after ``failure_threshold`` consecutive failures and rejects calls
+    until ``reset_timeout`` seconds have passed. The first call after that is
+    a trial: success closes the circuit, failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                return True
+            # Only one trial call at a time while half-open
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+breaker = CircuitBreaker(
+    failure_threshold=getattr(settings, 'STRIPE_CIRCUIT_FAILURE_THRESHOLD', 5),
+    reset_timeout=getattr(settings, 'STRIPE_CIRCUIT_RESET_TIMEOUT', 30.0),
+)
+
+_local = threading.local()
+_client_pid = None
+
+
+def build_client(api_base=None):
+    """Build a StripeClient with its own keep-alive pool; ``api_base`` points it at a stand-in API"""
+    import requests
+    import stripe
+    from djstripe.settings import djstripe_settings
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=getattr(settings, 'STRIPE_POOL_MAXSIZE', 10),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    http_client = stripe.RequestsClient(
+        session=session,
+        timeout=(
+            getattr(settings, 'STRIPE_CONNECT_TIMEOUT', 2.0),
+            getattr(settings, 'STRIPE_READ_TIMEOUT', 5.0),
+        ),
+    )
+    return stripe.StripeClient(
+        djstripe_settings.STRIPE_SECRET_KEY,
+        http_client=http_client,
+        base_addresses={'api': api_base} if api_base else {},
+        max_network_retries=0,
+    )
+
+
+def get_client():
+    """
+    Return this worker's StripeClient. The client (and its keep-alive pool) is
+    rebuilt after a fork so gunicorn workers never share sockets.
+    """
+    global _client_pid
+    client = getattr(_local, 'client', None)
+    if client is None or _client_pid != os.getpid():
+        client = build_client()
+        _local.client = client
+        _client_pid = os.getpid()
+    return client
+
+
+def call(endpoint, func, *args, **kwargs):
+    """
+    Run ``func(client, *args, **kwargs)`` through the circuit breaker and record
+    its latency in the ``portal_stripe_request_duration_seconds`` histogram.
+    """
+    import stripe
+
+    if not breaker.allow():
+        raise StripeUnavailable(endpoint)
+
+    start = time.perf_counter()
+    try:
+        result = func(get_client(), *args, **kwargs)
+    except (stripe.APIConnectionError, stripe.RateLimitError, stripe.APIError) as exc:
+        breaker.record_failure()
+        raise StripeUnavailable(endpoint) from exc
+    except stripe.StripeError:
+        # Client errors (bad params, auth) say nothing about Stripe's health
+        breaker.record_success()
+        raise
+    except Exception:
+        # Anything else still has to settle the call, or a failed half-open
+        # trial would leave the circuit rejecting calls for good
+        breaker.record_failure()
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.histogram('portal_stripe_request_duration_seconds', endpoint=endpoint).observe(elapsed)
+        profiling.record_stripe(elapsed)
+
+    breaker.record_success()
+    return result
+
+
+def create_customer_session(customer_id):
+    """Create a pricing-table customer session; returns None when Stripe is unavailable"""
+    import stripe
+
+    try:
+        session = call(
+            'customer_sessions.create',
+            lambda client: client.customer_sessions.create(params={
+                'customer': customer_id,
+                'components': {'pricing_table': {'enabled': True}},
+            }),
+        )
+    except (StripeUnavailable, stripe.StripeError):
+        return None
+    return session.client_secret
+
+
+# Runs on the default executor rather than the request's ORM thread, so the
+# Stripe round trip overlaps with the view's database work
+acreate_customer_session = sync_to_async(create_customer_session, thread_sensitive=False)
+
+
+def create_billing_portal_session(customer_id, return_url):
+    """Create a billing portal session; raises StripeUnavailable when Stripe is degraded"""
+    return call(
+        'billing_portal.sessions.create',
+        lambda client: client.billing_portal.sessions.create(params={
+            'customer': customer_id,
+            'return_url': return_url,
+        }),
+    )
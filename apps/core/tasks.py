@@ -0,0 +1,17 @@
+"""
+Background tasks for the job queue. Queue one with
+``jobs.enqueue(tasks.render_invoice_document, invoice.pk, 'pdf')``;
+arguments are stored as JSON, so pass ids rather than model instances. An
+exception makes the job retry, so tasks should be safe to run twice.
+"""
+from . import documents
+from .models import Invoice
+
+
+def render_invoice_document(invoice_id, fmt='html'):
+    """Render into the document cache, so the first download is served from it"""
+    invoice = (
+        Invoice.objects.select_related('patient__patient_profile').prefetch_related('line_items')
+        .get(pk=invoice_id)
+    )
+    documents.invoice_document(invoice, fmt)
@@ -1,3 +1,1279 @@
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import json
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import stripe
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import export, jobs, metrics, profiling, ratelimit, reminders, reports, routers, stripe_client
+from .admin import estimate_count
+from .signals import invoices_namespace
+from .management.commands import profile_startup
+from .models import (
+    ArchivedDoctorVisit, ArchivedLabTest, DeletedRecord, DoctorVisit, Invoice, InvoiceLineItem, Job, LabTest,
+    PatientProfile,
+)
+from .stripe_client import CircuitBreaker, StripeUnavailable
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: self.now)
+
+    def test_opens_after_threshold_and_half_opens_after_timeout(self):
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+
+        self.now = 11
+        self.assertTrue(self.breaker.allow())
+        # Only a single trial call is let through while half-open
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now = 11
+        self.breaker.allow()
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+
+
+class StripeClientCallTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(stripe_client, 'breaker', CircuitBreaker(failure_threshold=1))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_connection_errors_open_the_circuit(self):
+        def boom(client):
+            raise stripe.APIConnectionError('timed out')
+
+        with self.assertRaises(StripeUnavailable):
+            stripe_client.call('test', boom)
+        with self.assertRaises(StripeUnavailable):
+            stripe_client.call('test', lambda client: 'ok')
+
+    def test_unexpected_errors_settle_a_half_open_trial(self):
+        stripe_client.breaker.record_failure()
+        stripe_client.breaker.opened_at -= stripe_client.breaker.reset_timeout
+        with self.assertRaises(KeyError):
+            stripe_client.call('test', lambda client: {}['missing'])
+        self.assertEqual(stripe_client.breaker.state, CircuitBreaker.OPEN)
+
+        stripe_client.breaker.opened_at -= stripe_client.breaker.reset_timeout
+        self.assertEqual(stripe_client.call('test', lambda client: 'ok'), 'ok')
+        self.assertEqual(stripe_client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_customer_session_falls_back_to_none(self):
+        stripe_client.breaker.record_failure()
+        self.assertIsNone(stripe_client.create_customer_session('cus_123'))
+
+
+class StandInStripeHandler(BaseHTTPRequestHandler):
+    """
+    Serves ``/v1/customers`` with cursor paging over ``server.customer_ids``,
+    and ``/v1/account``, which dj-stripe looks up for the key's owner
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/v1/account':
+            body = json.dumps({
+                'id': 'acct_standin', 'object': 'account', 'type': 'standard', 'charges_enabled': True,
+                'payouts_enabled': True, 'details_submitted': True,
+            }).encode()
+        else:
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            ids = self.server.customer_ids
+            start = ids.index(query['starting_after']) + 1 if 'starting_after' in query else 0
+            page = ids[start:start + int(query.get('limit', 10))]
+            body = json.dumps({
+                'object': 'list',
+                'url': url.path,
+                'has_more': start + len(page) < len(ids),
+                'data': [
+                    {'id': obj_id, 'object': 'customer', 'livemode': False, 'created': 1767225600}
+                    for obj_id in page
+                ],
+            }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(STRIPE_TEST_SECRET_KEY='sk_test_' + 'standin' * 4)
+class SyncStripeCommandTests(TransactionTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInStripeHandler)
+        self.server.customer_ids = [f'cus_{i:03d}' for i in range(25)]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.checkpoint = Path(tmpdir.name) / 'checkpoint.json'
+        self.synced = []
+
+    def run_sync(self, workers=2):
+        call_command(
+            'sync_stripe', resource=['customers'], page_size=4, workers=workers,
+            checkpoint=str(self.checkpoint), api_base=f'http://127.0.0.1:{self.server.server_port}',
+            stdout=mock.Mock(),
+        )
+
+    def record(self, resource, objects):
+        self.synced.extend(obj.id for obj in objects)
+        return len(objects)
+
+    def test_pages_through_every_customer(self):
+        with mock.patch('apps.core.management.commands.sync_stripe.Command.upsert_batch',
+                        side_effect=self.record):
+            self.run_sync()
+        self.assertEqual(sorted(self.synced), self.server.customer_ids)
+        self.assertEqual(json.loads(self.checkpoint.read_text()), {})
+
+    def test_upserts_customers_into_djstripe(self):
+        from djstripe.models import Account, Customer
+
+        # One worker, as SQLite's shared in-memory test database locks whole tables
+        api_base = stripe.api_base
+        self.run_sync(workers=1)
+        # The owner account dj-stripe fetched came from the stand-in too
+        self.assertTrue(Account.objects.filter(id='acct_standin').exists())
+        self.assertEqual(stripe.api_base, api_base)
+        self.assertEqual(sorted(Customer.objects.values_list('id', flat=True)), self.server.customer_ids)
+        # A second run updates the same rows rather than adding more
+        self.run_sync(workers=1)
+        self.assertEqual(Customer.objects.count(), 25)
+
+    def test_resumes_from_checkpoint_after_failure(self):
+        def fail_on_third_page(resource, objects):
+            if objects[0].id == 'cus_008':
+                raise RuntimeError('db went away')
+            return self.record(resource, objects)
+
+        with mock.patch('apps.core.management.commands.sync_stripe.Command.upsert_batch',
+                        side_effect=fail_on_third_page):
+            with self.assertRaises(RuntimeError):
+                self.run_sync()
+        self.assertEqual(json.loads(self.checkpoint.read_text()), {'customers': 'cus_007'})
+
+        self.synced = []
+        with mock.patch('apps.core.management.commands.sync_stripe.Command.upsert_batch',
+                        side_effect=self.record):
+            self.run_sync()
+        self.assertEqual(sorted(self.synced), self.server.customer_ids[8:])
+
+
+class AsyncPortalViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('patient', password='x', first_name='Pat')
+        today = datetime.date.today()
+        LabTest.objects.create(
+            patient=cls.user, test_name='CBC', test_category='Hematology', ordered_by='Dr. Smith',
+            order_date=today, status='pending',
+        )
+        LabTest.objects.create(
+            patient=cls.user, test_name='Lipid Panel', test_category='Chemistry', ordered_by='Dr. Smith',
+            order_date=today, status='completed', is_abnormal=True,
+        )
+        DoctorVisit.objects.create(
+            patient=cls.user, doctor_name='Dr. Brown', specialty='Cardiology', visit_date=today,
+            reason='Checkup', follow_up_date=today + datetime.timedelta(days=30),
+        )
+
+    async def test_dashboard_renders_under_asgi(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get('/portal/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_labs'], 2)
+        self.assertEqual(response.context['pending_labs'], 1)
+        self.assertEqual(response.context['abnormal_labs'], 1)
+        self.assertEqual(len(response.context['upcoming_followups']), 1)
+
+    async def test_lab_tests_filter_under_asgi(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get('/portal/lab-tests/', {'status': 'pending'})
+        # Still lazy if the table fragment came from the cache, so evaluate it off the event loop
+        tests = await sync_to_async(list)(response.context['tests'])
+        self.assertEqual([test.test_name for test in tests], ['CBC'])
+
+    def test_portal_requires_login(self):
+        response = self.client.get('/portal/visits/')
+        self.assertEqual(response.status_code, 302)
+
+
+TIERED_CACHES = {
+    'default': {
+        'BACKEND': 'apps.core.cache.TieredCache',
+        'OPTIONS': {'L2': 'shared', 'L1_MAX_ENTRIES': 2, 'L1_TIMEOUT': 60},
+    },
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tiered-tests'},
+}
+
+
+@override_settings(CACHES=TIERED_CACHES)
+class TieredCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = caches['default']
+        self.cache.clear()
+        self.cache._stats.clear()
+
+    def test_reads_fall_through_to_l2_and_populate_l1(self):
+        self.cache.l2.set('portal:a', 1)
+        self.assertEqual(self.cache.get('portal:a'), 1)
+        self.cache.l2.delete('portal:a')
+        # Still served from this process's L1
+        self.assertEqual(self.cache.get('portal:a'), 1)
+        self.assertEqual(self.cache.stats()['portal'], {'l2_hits': 1, 'l1_hits': 1})
+
+    def test_l1_is_bounded_and_counts_evictions(self):
+        for key in ('billing:a', 'billing:b', 'billing:c'):
+            self.cache.set(key, key)
+        self.assertEqual(self.cache.stats()['billing']['evictions'], 1)
+        self.assertEqual(self.cache.get('billing:a'), 'billing:a')
+        self.assertEqual(self.cache.stats()['billing']['l2_hits'], 1)
+
+    def test_namespace_bump_invalidates_all_keys(self):
+        portal = self.cache.namespace('portal')
+        portal.set('dashboard:1', 'old')
+        version = portal.version
+        portal.bump()
+        self.assertIsNone(portal.get('dashboard:1'))
+        # Each bump increments the shared counter, whatever this process's L1 holds
+        portal.bump()
+        self.assertEqual(self.cache.l2.get('portal:__version__'), version + 2)
+        self.assertEqual(portal.version, version + 2)
+
+    def test_get_or_set_computes_once(self):
+        compute = mock.Mock(return_value=42)
+        self.assertEqual(self.cache.get_or_set('portal:x', compute, 60), 42)
+        self.assertEqual(self.cache.get_or_set('portal:x', compute, 60), 42)
+        compute.assert_called_once()
+
+    def test_get_or_set_waits_for_lock_holder(self):
+        # Another worker holds the recompute lock and publishes while we wait
+        self.cache.l2.add('portal:y:lock', 1)
+        compute = mock.Mock()
+        with mock.patch('apps.core.cache.time.sleep',
+                        side_effect=lambda _: self.cache.l2.set('portal:y', 'from other worker')):
+            self.assertEqual(self.cache.get_or_set('portal:y', compute, 60), 'from other worker')
+        compute.assert_not_called()
+
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default-tests'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared-tests'},
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CachedSessionAuthTests(TestCase):
+    def setUp(self):
+        caches['shared'].clear()
+        self.user = User.objects.create_user('patient', password='x')
+        self.client.force_login(self.user)
+
+    def test_warm_request_makes_no_queries(self):
+        self.client.get('/about/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/about/')
+        self.assertTrue(response.wsgi_request.user.is_authenticated)
+
+    def test_password_hash_is_not_cached(self):
+        from .middleware import user_cache_key
+
+        self.client.get('/about/')
+        cached = caches['shared'].get(user_cache_key(self.user.pk))
+        self.assertNotIn('password', cached['fields'])
+        self.assertNotIn(self.user.password, repr(cached))
+
+        user = self.client.get('/about/').wsgi_request.user
+        self.assertEqual(user.username, 'patient')
+        user.first_name = 'Pat'
+        user.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, 'Pat')
+        self.assertTrue(self.user.check_password('x'))
+
+    def test_user_changes_invalidate_the_cached_user(self):
+        self.client.get('/about/')
+        self.user.set_password('new-password')
+        self.user.save()
+        response = self.client.get('/about/')
+        self.assertFalse(response.wsgi_request.user.is_authenticated)
+
+    def test_session_changes_are_written_behind(self):
+        from django.contrib.sessions.models import Session
+        from .sessions import SessionStore
+
+        session_key = self.client.session.session_key
+        store = SessionStore(session_key)
+        store['step'] = 1
+        store.save()
+        store['step'] = 2
+        store.save()
+
+        stored = Session.objects.get(session_key=session_key).get_decoded()
+        self.assertNotIn('step', stored)
+        self.assertEqual(SessionStore(session_key)['step'], 2)
+
+    def test_unchanged_session_is_not_saved(self):
+        store = self.client.session
+        store.load()
+        with mock.patch.object(caches['shared'], 'set') as cache_set, self.assertNumQueries(0):
+            store.modified = True
+            store.save()
+        cache_set.assert_not_called()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FragmentCacheTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        caches['shared'].clear()
+        self.user = User.objects.create_user('patient', password='x')
+        self.client.force_login(self.user)
+
+    def test_lab_table_is_invalidated_when_a_lab_test_changes(self):
+        test = LabTest.objects.create(
+            patient=self.user, test_name='CBC', test_category='Hematology', ordered_by='Dr. Smith',
+            order_date=datetime.date.today(),
+        )
+        self.assertContains(self.client.get('/portal/lab-tests/'), 'CBC')
+        test.test_name = 'Basic Metabolic Panel'
+        test.save()
+        self.assertContains(self.client.get('/portal/lab-tests/'), 'Basic Metabolic Panel')
+
+    def test_line_item_changes_touch_the_invoice(self):
+        invoice = Invoice.objects.create(
+            invoice_number='INV-1', patient=self.user, due_date=datetime.date.today(),
+            subtotal=100, total=100,
+        )
+        before = invoice.updated_at
+        InvoiceLineItem.objects.create(
+            invoice=invoice, description='X-Ray', unit_price=100, total_price=100,
+            service_date=datetime.date.today(), provider_name='Dr. Brown',
+        )
+        invoice.refresh_from_db()
+        self.assertGreater(invoice.updated_at, before)
+
+
+class StartupBudgetTests(SimpleTestCase):
+    # Generous ceilings: the point is to catch a heavy import sneaking into boot
+    FIRST_PARTY_IMPORT_BUDGET_MS = 100
+    TIME_TO_FIRST_REQUEST_BUDGET_MS = 10000
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.report = profile_startup.profile('/about/')
+
+    def test_boot_stays_within_budget(self):
+        self.assertEqual(self.report['status'], 200)
+        first_party = profile_startup.self_time_by_package(self.report['imports'])['apps'] / 1000
+        self.assertLess(first_party, self.FIRST_PARTY_IMPORT_BUDGET_MS)
+        self.assertLess(self.report['total_ms'], self.TIME_TO_FIRST_REQUEST_BUDGET_MS)
+
+    def test_stripe_client_is_not_imported_until_used(self):
+        self.assertIn('apps.core.views', self.report['modules'])
+        self.assertNotIn('apps.core.stripe_client', self.report['modules'])
+
+    def test_parse_importtime(self):
+        rows = profile_startup.parse_importtime(
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       120 |        120 |     stripe._error\n'
+            'import time:      2200 |    1084500 |   stripe\n'
+        )
+        self.assertEqual(rows, [('stripe._error', 120, 120, 2), ('stripe', 2200, 1084500, 1)])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=0)
+class ProfilingMiddlewareTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        caches['shared'].clear()
+        self.user = User.objects.create_user('patient', password='x')
+        self.client.force_login(self.user)
+
+    def test_server_timing_and_log_line(self):
+        with self.assertLogs('apps.core.profiling', 'INFO') as logs:
+            response = self.client.get('/invoices/')
+        self.assertRegex(response['Server-Timing'], r'^total;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries')
+        self.assertIn('tpl;dur=', response['Server-Timing'])
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(record['url_name'], 'invoice_list')
+        self.assertGreater(record['queries'], 0)
+        self.assertGreater(record['template_ms'], 0)
+
+    def test_counts_duplicate_queries(self):
+        for n in range(3):
+            User.objects.create_user(f'other{n}')
+        profile, token = profiling.start()
+        try:
+            profiling.instrument_connections()
+            for user in User.objects.all():
+                list(user.groups.all())
+        finally:
+            profiling.stop(token)
+        self.assertEqual(profile.duplicate_queries, User.objects.count() - 1)
+        self.assertIn('auth_group', profile.most_duplicated()[0])
+
+    def test_sampled_requests_write_cprofile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with override_settings(PROFILING_SAMPLE_RATE=1.0, PROFILING_DIR=tmp), \
+                    self.assertLogs('apps.core.profiling', 'INFO'):
+                self.client.get('/portal/lab-tests/')
+            dumps = list(Path(tmp).glob('lab_tests-*.prof'))
+        self.assertEqual(len(dumps), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BenchmarkRoutesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_benchmark_data', scale='small', stdout=StringIO())
+
+    def setUp(self):
+        caches['default'].clear()
+        caches['shared'].clear()
+
+    def run_benchmark(self, **options):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = Path(tmp) / 'results.json'
+            call_command(
+                'benchmark_routes', requests=3, warmup=1, output=str(output),
+                route=['portal', 'invoices?status=paid'], stdout=StringIO(), **options,
+            )
+            return json.loads(output.read_text())
+
+    def test_records_percentiles_queries_and_memory(self):
+        results = self.run_benchmark()
+        self.assertEqual(results['rows']['LabTest'], 800)
+        portal = results['routes']['portal']
+        self.assertEqual(portal['status'], 200)
+        self.assertLessEqual(portal['p50'], portal['p99'])
+        self.assertGreater(portal['queries'], 0)
+        self.assertGreater(portal['peak_kb'], 0)
+
+    def test_fails_on_regression(self):
+        baseline = self.run_benchmark()
+        baseline['routes']['invoices?status=paid']['queries'] -= 1
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            json.dump(baseline, f)
+            f.flush()
+            with self.assertRaisesMessage(CommandError, 'invoices?status=paid: queries'):
+                self.run_benchmark(baseline=f.name)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MetricsEndpointTests(TestCase):
+    def test_exposes_request_metrics_by_url_name(self):
+        self.client.get('/about/')
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('# TYPE portal_http_request_duration_seconds histogram', body)
+        self.assertRegex(body, r'portal_http_request_duration_seconds_bucket\{url_name="about",le="\+Inf"\} [1-9]')
+        self.assertRegex(body, r'portal_http_responses_total\{status="200",url_name="about"\} [1-9]')
+        self.assertIn('portal_db_queries_per_request_count{url_name="about"}', body)
+        self.assertIn('portal_stripe_webhook_queue_depth 0', body)
+
+    def test_rejects_other_clients(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 403)
+
+    def test_sums_worker_files(self):
+        with tempfile.TemporaryDirectory() as tmp, override_settings(METRICS_DIR=tmp):
+            metrics.counter('portal_test_total', kind='a').inc(2)
+            other_worker = {'portal_test_total': [[{'kind': 'a'}, 'counter', {'value': 5}]]}
+            (Path(tmp) / 'metrics-999999.json').write_text(json.dumps(other_worker))
+            merged = metrics.collect()
+        self.assertEqual(merged['portal_test_total'][(('kind', 'a'),)][1]['value'], 7)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'], REPLICA_SELECTION='round_robin')
+class ReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        self.lags = {'replica1': 0.0, 'replica2': 0.0}
+        patcher = mock.patch.object(routers, 'replica_lag', lambda alias: self.lags[alias])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_use_primary_unless_allowed(self):
+        self.assertEqual(self.router.db_for_read(LabTest), 'default')
+        with routers.replica_reads():
+            self.assertEqual(
+                [self.router.db_for_read(LabTest) for _ in range(3)], ['replica1', 'replica2', 'replica1']
+            )
+        self.assertEqual(self.router.db_for_read(LabTest), 'default')
+
+    def test_reads_after_a_write_or_in_a_transaction_use_primary(self):
+        with routers.replica_reads():
+            with mock.patch.object(connections['default'], 'in_atomic_block', True):
+                self.assertEqual(self.router.db_for_read(LabTest), 'default')
+            self.assertEqual(self.router.db_for_read(LabTest), 'replica1')
+            self.router.db_for_write(LabTest)
+            self.assertEqual(self.router.db_for_read(LabTest), 'default')
+
+    def test_least_lag_skips_lagging_replicas(self):
+        self.lags.update(replica1=3.0, replica2=0.5)
+        with override_settings(REPLICA_SELECTION='least_lag', REPLICA_MAX_LAG_SECONDS=2):
+            router = routers.ReplicaRouter()
+        with routers.replica_reads():
+            self.assertEqual(router.db_for_read(LabTest), 'replica2')
+            router._lags_checked_at = float('-inf')
+            self.lags['replica2'] = 5.0
+            self.assertEqual(router.db_for_read(LabTest), 'default')
+
+    def test_round_robin_skips_lagging_replicas(self):
+        self.lags['replica1'] = 30.0
+        with routers.replica_reads():
+            self.assertEqual([self.router.db_for_read(LabTest) for _ in range(2)], ['replica2', 'replica2'])
+            self.router._lags_checked_at = float('-inf')
+            self.lags['replica2'] = 30.0
+            self.assertEqual(self.router.db_for_read(LabTest), 'default')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ReplicaPinningTests(TestCase):
+    def test_writes_pin_the_client_to_the_primary(self):
+        user = User.objects.create_user('patient', password='x')
+        response = self.client.post('/accounts/login/', {'login': 'patient', 'password': 'x'})
+        self.assertIn('db_primary', response.cookies)
+
+        self.client.force_login(user)
+        seen = []
+
+        def spy(router, model, **hints):
+            seen.append((routers.current().pinned, routers.current().replica_ok))
+            return 'default'
+
+        with mock.patch.object(routers.ReplicaRouter, 'db_for_read', spy):
+            self.client.get('/portal/visits/')
+        self.assertTrue(all(pinned for pinned, _ in seen))
+        self.assertTrue(any(replica_ok for _, replica_ok in seen))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class LargeTableAdminTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        cls.patients = [User.objects.create_user(f'patient{n}', first_name='Pat') for n in range(2)]
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client.force_login(self.admin_user)
+
+    def add_labs(self, count):
+        LabTest.objects.bulk_create([
+            LabTest(
+                patient=self.patients[n % 2], test_name=f'Test {n}', test_category='Hematology',
+                ordered_by='Dr. Smith', order_date=datetime.date.today(),
+            )
+            for n in range(count)
+        ])
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connections['default']) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        self.add_labs(2)
+        self.changelist_queries('/admin/core/labtest/')  # warm the user and filter caches
+        few = self.changelist_queries('/admin/core/labtest/')
+        self.add_labs(30)
+        self.assertEqual(self.changelist_queries('/admin/core/labtest/'), few)
+
+    def test_prefix_search_on_column_and_patient_username(self):
+        self.add_labs(4)
+        response = self.client.get('/admin/core/labtest/', {'q': 'Test 1'})
+        self.assertEqual([t.test_name for t in response.context['cl'].result_list], ['Test 1'])
+        response = self.client.get('/admin/core/labtest/', {'q': 'patient1'})
+        self.assertEqual(len(response.context['cl'].result_list), 2)
+
+    def test_estimate_count_reads_sqlite_statistics(self):
+        self.add_labs(3)
+        with connections['default'].cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.assertEqual(estimate_count(LabTest.objects.all()), 3)
+        self.assertIsNone(estimate_count(LabTest.objects.filter(status='pending')))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MarkOverdueInvoicesTests(TestCase):
+    def test_transitions_only_past_due_pending_invoices_in_chunks(self):
+        patient = User.objects.create_user('patient')
+        today = datetime.date(2026, 3, 1)
+        cases = [
+            ('pending', today - datetime.timedelta(days=1)),
+            ('pending', today - datetime.timedelta(days=40)),
+            ('pending', today - datetime.timedelta(days=2)),
+            ('pending', today),
+            ('paid', today - datetime.timedelta(days=5)),
+        ]
+        invoices = [
+            Invoice.objects.create(
+                invoice_number=f'INV-{n}', patient=patient, status=status, due_date=due, subtotal=10, total=10,
+            )
+            for n, (status, due) in enumerate(cases)
+        ]
+        version = invoices_namespace().version
+
+        call_command('mark_overdue_invoices', today='2026-03-01', chunk_size=2, stdout=StringIO())
+
+        statuses = [Invoice.objects.get(pk=invoice.pk).status for invoice in invoices]
+        self.assertEqual(statuses, ['overdue', 'overdue', 'overdue', 'pending', 'paid'])
+        self.assertGreater(Invoice.objects.get(pk=invoices[0].pk).updated_at, invoices[0].updated_at)
+        self.assertEqual(invoices_namespace().version, version + 1)
+
+    def test_an_invoice_paid_mid_run_does_not_end_it_early(self):
+        patient = User.objects.create_user('patient')
+        today = datetime.date(2026, 3, 1)
+        for n in range(4):
+            Invoice.objects.create(
+                invoice_number=f'INV-{n}', patient=patient, due_date=today - datetime.timedelta(days=n + 1),
+                subtotal=10, total=10,
+            )
+        due = Invoice.objects.filter(status='pending', due_date__lt=today).order_by()
+        paid = due.values_list('pk', flat=True)[0]
+        now = timezone.now
+        calls = []
+
+        def clock():
+            # Runs as the first chunk's UPDATE is built, so the invoice is
+            # paid after the chunk was selected but before it is updated
+            if not calls:
+                Invoice.objects.filter(pk=paid).update(status='paid')
+            calls.append(1)
+            return now()
+
+        out = StringIO()
+        with mock.patch('apps.core.management.commands.mark_overdue_invoices.timezone.now', side_effect=clock):
+            call_command('mark_overdue_invoices', today='2026-03-01', chunk_size=2, stdout=out)
+        self.assertIn('Marked 3 invoices overdue', out.getvalue())
+        # The first chunk updated one row of two and the run still went on
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(Invoice.objects.get(pk=paid).status, 'paid')
+        self.assertFalse(due.exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ArAgingReportTests(TestCase):
+    def setUp(self):
+        self.today = datetime.date(2026, 3, 1)
+        insured = User.objects.create_user('insured', password='pw')
+        PatientProfile.objects.create(
+            user=insured, date_of_birth=datetime.date(1980, 1, 1), phone_number='555-0100',
+            address='1 Main St', insurance_provider='Aetna', insurance_policy_number='A-1',
+        )
+        uninsured = User.objects.create_user('uninsured')
+        cases = [
+            (insured, 'pending', 0, 100),
+            (insured, 'overdue', 1, 10),
+            (insured, 'overdue', 30, 20),
+            (insured, 'overdue', 31, 30),
+            (insured, 'overdue', 90, 40),
+            (insured, 'overdue', 91, 50),
+            (insured, 'paid', 200, 1000),
+            (uninsured, 'pending', -5, 7),
+        ]
+        for n, (patient, status, days_past_due, total) in enumerate(cases):
+            Invoice.objects.create(
+                invoice_number=f'INV-{n}', patient=patient, status=status, subtotal=total, total=total,
+                due_date=self.today - datetime.timedelta(days=days_past_due),
+            )
+
+    def test_buckets_by_provider_in_one_query(self):
+        with self.assertNumQueries(1):
+            report = reports.compute_ar_aging(self.today)
+
+        aetna, uninsured = report['rows']
+        self.assertEqual(aetna['insurance_provider'], 'Aetna')
+        self.assertEqual(
+            [(aetna[f'{key}_amount'], aetna[f'{key}_count']) for key, _, _, _ in reports.AGING_BUCKETS],
+            [(100, 1), (30, 2), (30, 1), (40, 1), (50, 1)],
+        )
+        self.assertEqual(uninsured['insurance_provider'], reports.NO_INSURANCE_LABEL)
+        self.assertEqual((uninsured['current_amount'], uninsured['current_count']), (7, 1))
+        self.assertEqual((report['totals']['total_amount'], report['totals']['total_count']), (257, 7))
+
+    def test_cached_per_day_until_an_invoice_changes(self):
+        reports.ar_aging(self.today)
+        with self.assertNumQueries(0):
+            reports.ar_aging(self.today)
+
+        Invoice.objects.filter(invoice_number='INV-0').get().delete()
+        self.assertEqual(reports.ar_aging(self.today)['totals']['total_count'], 6)
+
+    def test_only_staff_see_the_report(self):
+        self.client.force_login(User.objects.get(username='insured'))
+        self.assertEqual(self.client.get('/invoices/aging/?format=csv').status_code, 302)
+
+    def test_csv_export(self):
+        self.client.force_login(User.objects.create_user('billing', is_staff=True))
+        with mock.patch('django.utils.timezone.localdate', return_value=self.today):
+            response = self.client.get('/invoices/aging/?format=csv')
+
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('ar-aging-2026-03-01.csv', response['Content-Disposition'])
+        lines = response.content.decode().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith('Insurance provider,Current amount,Current count,1-30 days amount'))
+        self.assertTrue(lines[1].startswith('Aetna,100.00,1,30.00,2'))
+        self.assertTrue(lines[3].startswith('Total,'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DocumentTests(TestCase):
+    def setUp(self):
+        self.patient = User.objects.create_user('patient', first_name='Pat', last_name='Lee')
+        self.invoice = Invoice.objects.create(
+            invoice_number='INV-1', patient=self.patient, due_date=datetime.date(2026, 3, 1), subtotal=50, total=50,
+        )
+        InvoiceLineItem.objects.create(
+            invoice=self.invoice, description='Office visit', unit_price=50, total_price=50,
+            service_date=datetime.date(2026, 2, 1), provider_name='Dr. Chen',
+        )
+        self.client.force_login(self.patient)
+
+    def test_invoice_document_is_cached_until_a_line_item_changes(self):
+        response = self.client.get(f'/invoices/{self.invoice.pk}/document/')
+        self.assertContains(response, 'Office visit')
+
+        with mock.patch('apps.core.documents.render_to_string') as render:
+            self.client.get(f'/invoices/{self.invoice.pk}/document/')
+        render.assert_not_called()
+
+        InvoiceLineItem.objects.create(
+            invoice=self.invoice, description='Lab panel', unit_price=5, total_price=5,
+            service_date=datetime.date(2026, 2, 1), provider_name='Dr. Chen',
+        )
+        self.assertContains(self.client.get(f'/invoices/{self.invoice.pk}/document/'), 'Lab panel')
+
+    def test_pdf_is_rendered_by_a_background_job(self):
+        url = f'/invoices/{self.invoice.pk}/document/?format=pdf'
+        with mock.patch('apps.core.documents.pdf_available', return_value=True), \
+                mock.patch('apps.core.documents.html_to_pdf', return_value=b'%PDF-1.7') as html_to_pdf:
+            responses = [self.client.get(url) for _ in range(2)]
+            self.assertEqual([response.status_code for response in responses], [202, 202])
+            self.assertEqual(responses[0]['Retry-After'], '3')
+            html_to_pdf.assert_not_called()
+            job = Job.objects.get()
+            self.assertEqual((job.task, job.args), ('apps.core.tasks.render_invoice_document', [self.invoice.pk, 'pdf']))
+
+            call_command('run_jobs', threads=1, burst=True, stdout=StringIO())
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response.content, b'%PDF-1.7')
+        html_to_pdf.assert_called_once()
+
+    def test_other_patients_invoices_are_not_found(self):
+        other = User.objects.create_user('other')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(f'/invoices/{self.invoice.pk}/document/').status_code, 404)
+
+        other.is_staff = True
+        other.save()
+        self.client.force_login(other)
+        self.assertContains(self.client.get(f'/invoices/{self.invoice.pk}/document/'), 'Office visit')
+
+    def test_statement_run_writes_documents_and_resumes(self):
+        PatientProfile.objects.create(
+            user=self.patient, date_of_birth=datetime.date(1980, 1, 1), phone_number='555-0100',
+            address='1 Main St', insurance_provider='Aetna', insurance_policy_number='A-1',
+        )
+        idle = User.objects.create_user('idle')
+        PatientProfile.objects.create(
+            user=idle, date_of_birth=datetime.date(1980, 1, 1), phone_number='555-0101',
+            address='2 Main St', insurance_provider='Aetna', insurance_policy_number='A-2',
+        )
+        period = datetime.date.today().strftime('%Y-%m')
+        with tempfile.TemporaryDirectory() as output_dir:
+            def run():
+                out = StringIO()
+                call_command('generate_documents', 'statements', period=period, output_dir=output_dir,
+                             workers=1, batch_size=1, stdout=out)
+                return out.getvalue()
+
+            self.assertIn('Wrote 1 statements', run())
+            statement = Path(output_dir, 'statements', period, f'{self.patient.pk}.html').read_text()
+            self.assertIn('INV-1', statement)
+            self.assertIn('$50.00', statement)
+
+            self.assertIn('Wrote 0 statements', run())
+            self.invoice.save()
+            self.assertIn('Wrote 1 statements', run())
+
+    def test_patients_without_a_profile_get_a_statement(self):
+        period = datetime.date.today().strftime('%Y-%m')
+        with tempfile.TemporaryDirectory() as output_dir:
+            out = StringIO()
+            call_command('generate_documents', 'statements', period=period, output_dir=output_dir, workers=1,
+                         stdout=out)
+            self.assertIn('Wrote 1 statements', out.getvalue())
+            statement = Path(output_dir, 'statements', period, f'{self.patient.pk}.html').read_text()
+        self.assertIn('INV-1', statement)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class InvoiceReminderTests(TestCase):
+    def test_sends_each_due_reminder_once(self):
+        patient = User.objects.create_user('patient', email='patient@example.com')
+        no_email = User.objects.create_user('no-email')
+        cases = [
+            (patient, 'overdue', -10),
+            (patient, 'pending', 3),
+            (patient, 'pending', 30),
+            (patient, 'paid', -10),
+            (no_email, 'overdue', -10),
+        ]
+        for n, (owner, status, due_in) in enumerate(cases):
+            Invoice.objects.create(
+                invoice_number=f'INV-{n}', patient=owner, status=status, subtotal=10, total=10,
+                due_date=datetime.date(2026, 3, 1) + datetime.timedelta(days=due_in),
+            )
+
+        def run():
+            call_command('send_invoice_reminders', today=datetime.date(2026, 3, 1), batch_size=1, rate=0, concurrency=1,
+                         stdout=StringIO())
+
+        run()
+        self.assertEqual(sorted(message.subject for message in mail.outbox), [
+            'Overdue: invoice INV-0 was due Feb 19, 2026',
+            'Reminder: invoice INV-1 is due Mar 04, 2026',
+        ])
+        self.assertIn('10 days past due', mail.outbox[0].body)
+        self.assertEqual(mail.outbox[0].to, ['patient@example.com'])
+
+        run()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(Invoice.objects.filter(last_reminder_sent_at__isnull=False).count(), 2)
+
+    def test_rate_limiter_spaces_calls(self):
+        limiter = reminders.RateLimiter(50)
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.08)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, RATE_LIMITS={'about': '2/m'})
+class RateLimitTests(TestCase):
+    def setUp(self):
+        caches['shared'].clear()
+
+    def test_throttles_per_client_with_retry_after(self):
+        statuses = [self.client.get('/about/').status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        response = self.client.get('/about/')
+        self.assertEqual(response['Retry-After'], '30')
+
+        self.assertEqual(self.client.get('/about/', REMOTE_ADDR='10.0.0.2').status_code, 200)
+        self.client.force_login(User.objects.create_user('patient'))
+        self.assertEqual(self.client.get('/about/').status_code, 200)
+        # Unlimited routes are untouched
+        self.assertEqual(self.client.get('/').status_code, 200)
+
+        rendered = metrics.render(metrics.collect(), {}, [])
+        self.assertIn('portal_rate_limit_decisions_total{result="throttled",url_name="about"}', rendered)
+
+    @override_settings(RATE_LIMIT_IP_HEADER='HTTP_X_FORWARDED_FOR')
+    def test_spoofed_forwarded_for_entries_are_ignored(self):
+        statuses = [
+            self.client.get('/about/', HTTP_X_FORWARDED_FOR=f'10.9.9.{n}, 203.0.113.7').status_code
+            for n in range(3)
+        ]
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(self.client.get('/about/', HTTP_X_FORWARDED_FOR='203.0.113.8').status_code, 200)
+
+        # Two proxies: the client is the entry the outer one appended. A new
+        # client, as middleware reads its settings once
+        with override_settings(RATE_LIMIT_TRUSTED_PROXIES=2):
+            response = self.client_class().get(
+                '/about/', HTTP_X_FORWARDED_FOR='10.9.9.9, 203.0.113.7, 198.51.100.1',
+            )
+        self.assertEqual(response.status_code, 429)
+
+    def test_bucket_refills_over_time(self):
+        limiter = ratelimit.TokenBucketLimiter()
+        capacity, refill = ratelimit.parse_rate('2/s')
+        with mock.patch('apps.core.ratelimit.time.time', return_value=1000.0):
+            self.assertEqual(
+                [limiter.consume('k', capacity, refill)[0] for _ in range(3)], [True, True, False],
+            )
+        with mock.patch('apps.core.ratelimit.time.time', return_value=1000.5):
+            self.assertEqual(limiter.consume('k', capacity, refill), (True, 0))
+            allowed, retry_after = limiter.consume('k', capacity, refill)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 0.5)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ArchiveRecordsTests(TestCase):
+    def test_moves_old_rows_and_serves_them_on_request(self):
+        patient = User.objects.create_user('patient', password='pw')
+        today = datetime.date.today()
+        old_test = LabTest.objects.create(
+            patient=patient, test_name='Old Panel', test_category='Chemistry', ordered_by='Dr. Chen',
+            order_date=today - datetime.timedelta(days=400),
+        )
+        LabTest.objects.create(
+            patient=patient, test_name='New Panel', test_category='Chemistry', ordered_by='Dr. Chen',
+            order_date=today - datetime.timedelta(days=10),
+        )
+        DoctorVisit.objects.create(
+            patient=patient, doctor_name='Dr. Chen', specialty='Cardiology', reason='Old visit',
+            visit_date=today - datetime.timedelta(days=400),
+        )
+        self.client.force_login(patient)
+        self.assertContains(self.client.get('/portal/lab-tests/'), 'Old Panel')
+
+        call_command('archive_records', horizon_days=365, batch_size=1, stdout=StringIO())
+
+        archived = ArchivedLabTest.objects.get()
+        self.assertEqual((archived.pk, archived.created_at), (old_test.pk, old_test.created_at))
+        self.assertEqual(list(LabTest.objects.values_list('test_name', flat=True)), ['New Panel'])
+        self.assertEqual(ArchivedDoctorVisit.objects.count(), 1)
+        self.assertFalse(DoctorVisit.objects.exists())
+
+        recent = self.client.get('/portal/lab-tests/')
+        self.assertNotContains(recent, 'Old Panel')
+        self.assertContains(recent, 'New Panel')
+        older = self.client.get('/portal/lab-tests/older/')
+        self.assertContains(older, 'Old Panel')
+        self.assertNotContains(older, 'New Panel')
+        self.assertContains(self.client.get('/portal/visits/older/'), 'Old visit')
+
+
+JOB_CALLS = []
+
+
+def record_job(name, suffix=''):
+    JOB_CALLS.append(name + suffix)
+
+
+def failing_job():
+    raise ValueError('boom')
+
+
+@override_settings(JOB_RETRY_BACKOFF_SECONDS=60)
+class JobQueueTests(TestCase):
+    def setUp(self):
+        JOB_CALLS.clear()
+
+    def test_worker_runs_due_jobs_by_priority(self):
+        jobs.enqueue(record_job, 'low', lane='low')
+        jobs.enqueue(record_job, 'default', suffix='!')
+        jobs.enqueue(record_job, 'high', lane='high')
+        jobs.enqueue(record_job, 'later', delay=3600)
+
+        call_command('run_jobs', threads=1, burst=True, stdout=StringIO())
+
+        self.assertEqual(JOB_CALLS, ['high', 'default!', 'low'])
+        self.assertEqual(Job.objects.filter(status='succeeded').count(), 3)
+        self.assertEqual(jobs.queue_stats()['default']['scheduled'], 1)
+
+    def test_lanes_restrict_what_a_worker_takes(self):
+        jobs.enqueue(record_job, 'low', lane='low')
+        jobs.enqueue(record_job, 'high', lane='high')
+        call_command('run_jobs', threads=1, burst=True, lanes='high', stdout=StringIO())
+        self.assertEqual(JOB_CALLS, ['high'])
+        self.assertEqual(jobs.queue_stats()['low']['depth'], 1)
+
+    def test_failures_back_off_then_fail(self):
+        job = jobs.enqueue(failing_job, max_attempts=2)
+
+        self.assertFalse(jobs.run(jobs.claim('test')))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertIn('ValueError: boom', job.last_error)
+        self.assertGreater(job.run_at, job.created_at + datetime.timedelta(seconds=40))
+        self.assertIsNone(jobs.claim('test'))
+
+        Job.objects.filter(pk=job.pk).update(run_at=job.created_at)
+        jobs.run(jobs.claim('test'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        self.assertEqual(jobs.queue_stats()['default']['failed'], 1)
+
+    def test_claimed_job_is_not_claimed_again_and_orphans_are_requeued(self):
+        job = jobs.enqueue(record_job, 'once')
+        first = jobs.claim('first')
+        self.assertEqual(first.pk, job.pk)
+        self.assertIsNone(jobs.claim('second'))
+
+        # A renewed lease keeps the job; an expired one gets it requeued
+        self.assertTrue(jobs.renew_lease(first))
+        self.assertEqual(jobs.recover_and_purge(), (0, 0))
+        expired = timezone.now() - datetime.timedelta(seconds=1)
+        Job.objects.filter(pk=job.pk).update(locked_until=expired)
+        self.assertEqual(jobs.recover_and_purge(), (1, 0))
+        second = jobs.claim('second')
+        self.assertEqual(second.locked_by, 'second')
+
+        # The first worker finishing late neither renews nor records over the second's run
+        self.assertFalse(jobs.renew_lease(first))
+        jobs.run(first)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by), ('running', 'second'))
+
+        # Out of attempts: an orphan is failed rather than queued again
+        Job.objects.filter(pk=job.pk).update(locked_until=expired, max_attempts=2)
+        self.assertEqual(jobs.recover_and_purge(), (0, 0))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.locked_by), ('failed', 2, ''))
+        self.assertIn('Worker lost', job.last_error)
+        self.assertIsNone(jobs.claim('third'))
+
+    def test_enqueue_rejects_unimportable_tasks(self):
+        with self.assertRaises(ImportError):
+            jobs.enqueue('apps.core.tests.no_such_job')
+
+
+class JsonApiTests(TestCase):
+    def setUp(self):
+        self.patient = User.objects.create_user('patient', password='pw')
+        other = User.objects.create_user('other', password='pw')
+        today = datetime.date.today()
+        for days in range(5):
+            LabTest.objects.create(
+                patient=self.patient, test_name=f'Panel {days}', test_category='Chemistry', ordered_by='Dr. Chen',
+                order_date=today - datetime.timedelta(days=days // 2),
+            )
+        LabTest.objects.create(
+            patient=other, test_name='Not mine', test_category='Chemistry', ordered_by='Dr. Chen', order_date=today,
+        )
+        invoice = Invoice.objects.create(
+            invoice_number='INV-API', patient=self.patient, due_date=today, subtotal=10, tax=1, total=11,
+        )
+        InvoiceLineItem.objects.create(
+            invoice=invoice, description='Visit', unit_price=10, total_price=10, service_date=today,
+            provider_name='Dr. Chen',
+        )
+        self.client.force_login(self.patient)
+
+    def test_pages_through_own_rows_with_selected_fields(self):
+        names = []
+        url = '/api/lab-tests/?fields=test_name&limit=2'
+        while url:
+            with CaptureQueriesContext(connections['default']) as queries:
+                data = self.client.get(url).json()
+            self.assertEqual(sum('core_labtest' in query['sql'] for query in queries), 1)
+            self.assertTrue(all(row.keys() == {'test_name'} for row in data['results']))
+            names += [row['test_name'] for row in data['results']]
+            url = data['next']
+        self.assertEqual(sorted(names), [f'Panel {days}' for days in range(5)])
+
+    def test_invoices_include_line_items_and_decimals_as_strings(self):
+        data = self.client.get('/api/invoices/?fields=invoice_number,total,line_items').json()
+        self.assertEqual(data['results'], [{
+            'invoice_number': 'INV-API', 'total': '11.00',
+            'line_items': [{
+                'id': InvoiceLineItem.objects.get().pk, 'description': 'Visit', 'quantity': 1,
+                'unit_price': '10.00', 'total_price': '10.00', 'service_date': datetime.date.today().isoformat(),
+                'provider_name': 'Dr. Chen',
+            }],
+        }])
+
+    def test_etag_revalidation(self):
+        response = self.client.get('/api/visits/')
+        self.assertEqual(response.json(), {'results': [], 'next': None})
+        self.assertEqual(self.client.get('/api/visits/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_rejects_bad_requests(self):
+        self.assertEqual(self.client.get('/api/lab-tests/?fields=password').status_code, 400)
+        self.assertEqual(self.client.get('/api/lab-tests/?after=garbage').status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get('/api/lab-tests/').status_code, 401)
+
+
+@override_settings(SYNC_SETTLE_SECONDS=0)
+class DeltaSyncTests(TestCase):
+    def setUp(self):
+        self.patient = User.objects.create_user('patient', password='pw')
+        self.client.force_login(self.patient)
+
+    def lab_test(self, name):
+        return LabTest.objects.create(
+            patient=self.patient, test_name=name, test_category='Chemistry', ordered_by='Dr. Chen',
+            order_date=datetime.date.today(),
+        )
+
+    def sync(self, watermark=None, **params):
+        if watermark:
+            params['since'] = watermark
+        return self.client.get('/api/sync/', params).json()
+
+    def test_sends_only_changes_and_deletions_since_the_watermark(self):
+        first, second = self.lab_test('First'), self.lab_test('Second')
+        data = self.sync(limit=1)
+        self.assertEqual(([row['test_name'] for row in data['lab_tests']], data['more']), (['First'], True))
+        data = self.sync(data['watermark'], limit=1)
+        self.assertEqual([row['test_name'] for row in data['lab_tests']], ['Second'])
+        data = self.sync(data['watermark'], limit=1)
+        self.assertEqual((data['lab_tests'], data['deleted'], data['more']), ([], [], False))
+
+        first.status = 'completed'
+        first.save()
+        second_id = second.pk
+        second.delete()
+        changes = self.sync(data['watermark'])
+        self.assertEqual([(row['id'], row['status']) for row in changes['lab_tests']], [(first.pk, 'completed')])
+        self.assertEqual(changes['deleted'], [{'type': 'lab_tests', 'id': second_id}])
+        self.assertEqual(changes['visits'], [])
+
+        with CaptureQueriesContext(connections['default']) as queries:
+            steady = self.sync(changes['watermark'])
+        self.assertEqual((steady['lab_tests'], steady['deleted']), ([], []))
+        self.assertEqual(sum('"core_' in query['sql'] for query in queries), 3)
+
+    def test_expired_and_invalid_watermarks(self):
+        watermark = self.sync()['watermark']
+        with override_settings(SYNC_TOMBSTONE_DAYS=0):
+            self.assertEqual(self.client.get('/api/sync/', {'since': watermark}).status_code, 410)
+        self.assertEqual(self.client.get('/api/sync/', {'since': 'garbage'}).status_code, 400)
+
+    def test_deleting_a_patient_leaves_no_tombstones(self):
+        self.lab_test('Gone')
+        self.patient.delete()
+        self.assertFalse(DeletedRecord.objects.exists())
+
+
+class IngestRecordsTests(TestCase):
+    def test_upserts_valid_rows_and_rejects_the_rest(self):
+        patient = User.objects.create_user('patient', email='patient@example.com', password='pw')
+        header = 'external_id,patient,test_name,test_category,ordered_by,order_date,status,is_abnormal\n'
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'labs.csv'
+            path.write_text(
+                header
+                + 'L1,patient,Lipid Panel,Chemistry,Dr. Chen,2026-09-01,,no\n'
+                + 'L2,patient,CBC,Hematology,Dr. Chen,2026-13-01,completed,no\n'
+                + 'L3,stranger,CBC,Hematology,Dr. Chen,2026-09-01,completed,no\n'
+                + 'L4,patient,CBC,Hematology,Dr. Chen,2026-09-02,finished,yes\n'
+            )
+            out = StringIO()
+            call_command('ingest_records', 'lab_tests', str(path), batch_size=2, stdout=out)
+            self.assertIn('Upserted 1 lab_tests', out.getvalue())
+            with open(f'{path}.rejects.csv', newline='') as f:
+                rejects = {int(row['line']): row['error'] for row in csv.DictReader(f)}
+            self.assertEqual(sorted(rejects), [3, 4, 5])
+            self.assertIn('order_date', rejects[3])
+            self.assertIn("Unknown patient 'stranger'", rejects[4])
+            self.assertIn('status', rejects[5])
+
+            lab = LabTest.objects.get(external_id='L1')
+            self.assertEqual((lab.patient, lab.status, lab.is_abnormal), (patient, 'pending', False))
+
+            path.write_text(header + 'L1,patient@example.com,Lipid Panel,Chemistry,Dr. Chen,2026-09-01,completed,yes\n')
+            call_command('ingest_records', 'lab_tests', str(path), match='email', stdout=StringIO())
+        lab = LabTest.objects.get()
+        self.assertEqual((lab.external_id, lab.status, lab.is_abnormal), ('L1', 'completed', True))
+
+    def test_reingesting_an_archived_record_updates_the_archive(self):
+        User.objects.create_user('patient', password='pw')
+        order_date = datetime.date.today() - datetime.timedelta(days=400)
+        header = 'external_id,patient,test_name,test_category,ordered_by,order_date,status\n'
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'labs.csv'
+            path.write_text(header + f'L1,patient,Lipid Panel,Chemistry,Dr. Chen,{order_date},pending\n')
+            call_command('ingest_records', 'lab_tests', str(path), stdout=StringIO())
+            call_command('archive_records', horizon_days=365, stdout=StringIO())
+
+            path.write_text(header + f'L1,patient,Lipid Panel,Chemistry,Dr. Chen,{order_date},completed\n')
+            call_command('ingest_records', 'lab_tests', str(path), stdout=StringIO())
+        self.assertFalse(LabTest.objects.exists())
+        self.assertEqual(ArchivedLabTest.objects.get(external_id='L1').status, 'completed')
+
+        # A live copy that slipped in anyway replaces the archived one
+        LabTest.objects.create(
+            external_id='L1', patient=User.objects.get(), test_name='Lipid Panel', test_category='Chemistry',
+            ordered_by='Dr. Chen', order_date=order_date, status='reviewed',
+        )
+        call_command('archive_records', horizon_days=365, stdout=StringIO())
+        self.assertEqual(ArchivedLabTest.objects.get(external_id='L1').status, 'reviewed')
+
+
+class BulkExportTests(TestCase):
+    def test_writes_one_gzipped_file_per_type_and_a_manifest(self):
+        today = datetime.date.today()
+        for n in range(3):
+            patient = User.objects.create_user(f'patient{n}', password='pw', last_name=f'Patient {n}')
+            PatientProfile.objects.create(user=patient, date_of_birth=today, phone_number='555', address='Here')
+            LabTest.objects.create(
+                patient=patient, test_name='CBC', test_category='Hematology', ordered_by='Dr. Chen',
+                order_date=today, status='completed', result_value='5', unit='g/dL',
+            )
+        ArchivedLabTest.objects.create(
+            patient=patient, test_name='Old CBC', test_category='Hematology', ordered_by='Dr. Chen', order_date=today,
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            call_command('bulk_export', output_dir=tmp, workers=1, partitions=2, stdout=StringIO())
+            manifest = json.loads((Path(tmp) / 'manifest.json').read_text())
+            with gzip.open(Path(tmp) / 'Observation.ndjson.gz', 'rt') as f:
+                observations = [json.loads(line) for line in f]
+            self.assertEqual(sorted(path.name for path in Path(tmp).iterdir()), [
+                'Encounter.ndjson.gz', 'Observation.ndjson.gz', 'Patient.ndjson.gz', 'manifest.json',
+            ])
+        self.assertEqual(
+            {output['type']: output['count'] for output in manifest['output']},
+            {'Patient': 3, 'Observation': 4, 'Encounter': 0},
+        )
+        self.assertEqual(sorted(observation['code']['text'] for observation in observations), ['CBC'] * 3 + ['Old CBC'])
+        self.assertEqual(observations[0]['valueString'], '5 g/dL')
+        self.assertEqual(observations[0]['subject']['reference'], f'Patient/{User.objects.get(username="patient0").pk}')
+
+    def test_records_of_patients_without_a_profile_are_exported(self):
+        today = datetime.date.today()
+        patients = [User.objects.create_user(f'patient{n}', password='pw') for n in range(3)]
+        PatientProfile.objects.create(user=patients[1], date_of_birth=today, phone_number='555', address='Here')
+        for patient in (patients[0], patients[2]):
+            DoctorVisit.objects.create(
+                patient=patient, doctor_name='Dr. Chen', specialty='Cardiology', reason='Checkup', visit_date=today,
+            )
+        self.assertEqual(export.patient_ranges(4), [(None, None)])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            call_command('bulk_export', output_dir=tmp, workers=1, partitions=2, stdout=StringIO())
+            manifest = json.loads((Path(tmp) / 'manifest.json').read_text())
+        self.assertEqual(
+            {output['type']: output['count'] for output in manifest['output']},
+            {'Patient': 1, 'Observation': 0, 'Encounter': 2},
+        )
+
+        PatientProfile.objects.all().delete()
+        with tempfile.TemporaryDirectory() as tmp:
+            call_command('bulk_export', output_dir=tmp, workers=1, stdout=StringIO())
+            manifest = json.loads((Path(tmp) / 'manifest.json').read_text())
+        self.assertEqual(manifest['output'][2], {'type': 'Encounter', 'url': 'Encounter.ndjson.gz', 'count': 2})
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 urlpatterns = [
     path('', views.home, name='home'),
@@ -10,6 +10,15 @@ urlpatterns = [
     path('welcome/', views.welcome, name='welcome'),
     path('portal/', views.patient_dashboard, name='patient_dashboard'),
     path('portal/lab-tests/', views.lab_tests, name='lab_tests'),
+    path('portal/lab-tests/older/', views.lab_tests, {'archived': True}, name='archived_lab_tests'),
     path('portal/visits/', views.doctor_visits, name='doctor_visits'),
+    path('portal/visits/older/', views.doctor_visits, {'archived': True}, name='archived_doctor_visits'),
     path('invoices/', views.invoice_list, name='invoice_list'),
+    path('invoices/<int:pk>/document/', views.invoice_document, name='invoice_document'),
+    path('invoices/aging/', views.ar_aging_report, name='ar_aging_report'),
+    path('api/lab-tests/', api.resource_list, {'resource': 'lab_tests'}, name='api_lab_tests'),
+    path('api/visits/', api.resource_list, {'resource': 'visits'}, name='api_doctor_visits'),
+    path('api/invoices/', api.resource_list, {'resource': 'invoices'}, name='api_invoices'),
+    path('api/sync/', api.sync, name='api_sync'),
+    path('metrics', views.metrics_endpoint, name='metrics'),
 ]
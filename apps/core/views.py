@@ -1,12 +1,33 @@
+import asyncio
 import os
 
-import stripe
-from django.shortcuts import render
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.http import HttpResponse, HttpResponseForbidden
+from django.shortcuts import get_object_or_404, render
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from djstripe import models as djstripe_models
-from djstripe.settings import djstripe_settings
 import json
 
+from . import documents, jobs, metrics, reports, tasks
+from .routers import replica_reads
+from .signals import lab_tests_namespace
+
+
+async def _resolve_user(request):
+    """
+    Load the user without blocking the event loop and pin it on the request, so
+    templates reading ``user`` never trigger a synchronous query from async code.
+    """
+    request.user = await request.auser()
+    return request.user
+
+
+async def _alist(queryset):
+    return [obj async for obj in queryset]
+
 
 def home(request):
     return render(request, 'core/home.html')
@@ -14,25 +35,30 @@ def home(request):
 def about(request):
     return render(request, 'core/about.html')
 
-def pricing(request):
+async def pricing(request):
     """Display pricing page with Stripe Pricing Table."""
+    from djstripe import models as djstripe_models
+    from djstripe.settings import djstripe_settings
+
+    from . import stripe_client
+
     context = {
         "STRIPE_PUBLIC_KEY": djstripe_settings.STRIPE_PUBLIC_KEY,
         "pricing_table_id": os.environ.get("STRIPE_PRICING_TABLE_ID", "prctbl_1Sn3haBjJ6zCPbztehr74kjO"),
     }
 
-    if request.user.is_authenticated:
+    user = await _resolve_user(request)
+    if user.is_authenticated:
         try:
-            customer = djstripe_models.Customer.objects.get(subscriber=request.user)
-            stripe.api_key = djstripe_settings.STRIPE_SECRET_KEY
-
-            customer_session = stripe.CustomerSession.create(
-                customer=customer.id,
-                components={"pricing_table": {"enabled": True}},
-            )
-            context["customer_session_client_secret"] = customer_session.client_secret
+            customer = await djstripe_models.Customer.objects.aget(subscriber=user)
         except djstripe_models.Customer.DoesNotExist:
-            pass
+            customer = None
+
+        if customer is not None:
+            # Falls back to the anonymous pricing table when Stripe is degraded
+            client_secret = await stripe_client.acreate_customer_session(customer.id)
+            if client_secret:
+                context["customer_session_client_secret"] = client_secret
 
     return render(request, "core/pricing.html", context)
 
@@ -90,31 +116,34 @@ def investment_calculator(request):
 
 
 @login_required
-def patient_dashboard(request):
+@replica_reads()
+async def patient_dashboard(request):
     """Patient dashboard showing overview of health records"""
     from .models import LabTest, DoctorVisit
-
-    user = request.user
-
-    recent_labs = LabTest.objects.filter(patient=user)[:5]
-    total_labs = LabTest.objects.filter(patient=user).count()
-    pending_labs = LabTest.objects.filter(patient=user, status='pending').count()
-    abnormal_labs = LabTest.objects.filter(patient=user, is_abnormal=True).count()
-
-    recent_visits = DoctorVisit.objects.filter(patient=user)[:5]
-    total_visits = DoctorVisit.objects.filter(patient=user).count()
-
     from django.utils import timezone
-    upcoming_followups = DoctorVisit.objects.filter(
-        patient=user,
-        follow_up_date__gte=timezone.now().date()
-    ).order_by('follow_up_date')[:3]
+
+    user = await _resolve_user(request)
+
+    lab_counts, recent_labs, recent_visits, total_visits, upcoming_followups = await asyncio.gather(
+        LabTest.objects.filter(patient=user).aaggregate(
+            total=Count('id'),
+            pending=Count('id', filter=Q(status='pending')),
+            abnormal=Count('id', filter=Q(is_abnormal=True)),
+        ),
+        _alist(LabTest.objects.filter(patient=user)[:5]),
+        _alist(DoctorVisit.objects.filter(patient=user)[:5]),
+        DoctorVisit.objects.filter(patient=user).acount(),
+        _alist(DoctorVisit.objects.filter(
+            patient=user,
+            follow_up_date__gte=timezone.now().date()
+        ).order_by('follow_up_date')[:3]),
+    )
 
     context = {
         'recent_labs': recent_labs,
-        'total_labs': total_labs,
-        'pending_labs': pending_labs,
-        'abnormal_labs': abnormal_labs,
+        'total_labs': lab_counts['total'],
+        'pending_labs': lab_counts['pending'],
+        'abnormal_labs': lab_counts['abnormal'],
         'recent_visits': recent_visits,
         'total_visits': total_visits,
         'upcoming_followups': upcoming_followups,
@@ -124,12 +153,14 @@ def patient_dashboard(request):
 
 
 @login_required
-def lab_tests(request):
-    """Display patient's lab test results"""
-    from .models import LabTest
+@replica_reads()
+async def lab_tests(request, archived=False):
+    """Display patient's lab test results; ``archived`` reads the older records instead"""
+    from .models import ArchivedLabTest, LabTest
 
-    user = request.user
-    tests = LabTest.objects.filter(patient=user)
+    model = ArchivedLabTest if archived else LabTest
+    user = await _resolve_user(request)
+    tests = model.objects.filter(patient=user)
 
     status_filter = request.GET.get('status', 'all')
     if status_filter != 'all':
@@ -139,33 +170,45 @@ def lab_tests(request):
     if category_filter != 'all':
         tests = tests.filter(test_category=category_filter)
 
-    categories = LabTest.objects.filter(patient=user).values_list('test_category', flat=True).distinct()
+    categories, labs_version = await asyncio.gather(
+        _alist(model.objects.filter(patient=user).values_list('test_category', flat=True).distinct()),
+        sync_to_async(lambda: lab_tests_namespace(user.pk).version)(),
+    )
 
     context = {
         'tests': tests,
         'status_filter': status_filter,
         'category_filter': category_filter,
         'categories': categories,
+        'labs_version': labs_version,
+        'archived': archived,
+        'archive_horizon_days': settings.ARCHIVE_HORIZON_DAYS,
     }
 
-    return render(request, 'core/lab_tests.html', context)
+    # Rendered on the request's sync thread: ``tests`` stays lazy and is only
+    # queried when the cached table fragment misses
+    return await sync_to_async(render)(request, 'core/lab_tests.html', context)
 
 
 @login_required
-def doctor_visits(request):
-    """Display patient's doctor visit history"""
-    from .models import DoctorVisit
+@replica_reads()
+async def doctor_visits(request, archived=False):
+    """Display patient's doctor visit history; ``archived`` reads the older records instead"""
+    from .models import ArchivedDoctorVisit, DoctorVisit
 
-    user = request.user
-    visits = DoctorVisit.objects.filter(patient=user)
+    model = ArchivedDoctorVisit if archived else DoctorVisit
+    user = await _resolve_user(request)
+    visits = model.objects.filter(patient=user)
 
     type_filter = request.GET.get('type', 'all')
     if type_filter != 'all':
         visits = visits.filter(visit_type=type_filter)
 
     context = {
-        'visits': visits,
+        'visits': await _alist(visits),
         'type_filter': type_filter,
+        'archived': archived,
+        'archive_horizon_days': settings.ARCHIVE_HORIZON_DAYS,
     }
 
     return render(request, 'core/doctor_visits.html', context)
@@ -214,3 +257,113 @@ def invoice_list(request):
     }
 
     return render(request, 'core/invoices_list.html', context)
+
+
+
+@login_required
+def invoice_document(request, pk):
+    """Printable invoice; ?format=pdf for a PDF when WeasyPrint is installed"""
+    from .models import Invoice
+
+    invoices = Invoice.objects.select_related('patient__patient_profile').prefetch_related('line_items')
+    # Patients see only their own invoices; clinic staff see any
+    if not request.user.is_staff:
+        invoices = invoices.filter(patient=request.user)
+    invoice = get_object_or_404(invoices, pk=pk)
+    if request.GET.get('format') != 'pdf':
+        return HttpResponse(documents.invoice_document(invoice))
+    if not documents.pdf_available():
+        return HttpResponse('PDF output is not available on this server.', status=501, content_type='text/plain')
+
+    pdf = documents.cached_invoice_document(invoice, 'pdf')
+    if pdf is None:
+        # Rendering takes seconds, so a worker does it; the marker keeps
+        # repeated requests from queueing the same render again
+        key = documents.invoice_document_key(invoice, 'pdf')
+        if cache.add(f'{key}:queued', 1, settings.JOB_LEASE_SECONDS):
+            jobs.enqueue(tasks.render_invoice_document, invoice.pk, 'pdf', lane='high')
+        response = HttpResponse(
+            'Your PDF is being prepared and will download shortly.', status=202, content_type='text/plain',
+        )
+        response['Retry-After'] = response['Refresh'] = '3'
+        return response
+
+    response = HttpResponse(pdf, content_type='application/pdf')
+    response['Content-Disposition'] = f'inline; filename="{invoice.invoice_number}.pdf"'
+    return response
+
+@staff_member_required
+def ar_aging_report(request):
+    """Accounts-receivable aging by insurance provider, as a page or a CSV download"""
+    report = reports.ar_aging()
+
+    if request.GET.get('format') == 'csv':
+        response = HttpResponse(content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="ar-aging-{report["as_of"].isoformat()}.csv"'
+        reports.write_ar_aging_csv(report, response)
+        return response
+
+    def table_row(row):
+        return {
+            'insurance_provider': row['insurance_provider'],
+            'buckets': [(row[f'{key}_amount'], row[f'{key}_count']) for key, _, _, _ in reports.AGING_BUCKETS],
+            'total_amount': row['total_amount'],
+            'total_count': row['total_count'],
+        }
+
+    context = {
+        'as_of': report['as_of'],
+        'bucket_labels': [label for _, label, _, _ in reports.AGING_BUCKETS],
+        'rows': [table_row(row) for row in report['rows']],
+        'totals': table_row(report['totals']),
+    }
+
+    return render(request, 'core/ar_aging.html', context)
+
+METRIC_HELP = {
+    'portal_http_request_duration_seconds': 'Request latency by URL name.',
+    'portal_http_responses_total': 'Responses by URL name and status code.',
+    'portal_db_queries_per_request': 'Database queries per request by URL name.',
+    'portal_cache_requests_total': 'Tiered cache lookups by namespace and result (l1_hits, l2_hits, misses).',
+    'portal_cache_hit_ratio': 'Share of tiered cache lookups served from L1 or L2.',
+    'portal_stripe_request_duration_seconds': 'Stripe API call latency by endpoint.',
+    'portal_stripe_webhook_queue_depth': 'Valid Stripe webhooks received but not yet processed.',
+    'portal_rate_limit_decisions_total': 'Rate-limited requests by URL name and result (allowed, throttled).',
+    'portal_job_wait_seconds': 'Time from a job becoming due to a worker starting it, by lane.',
+    'portal_job_duration_seconds': 'Background job run time by task.',
+    'portal_jobs_total': 'Background job runs by task and outcome (succeeded, retried, failed).',
+    'portal_job_queue_depth': 'Background jobs due and waiting for a worker, by lane.',
+    'portal_job_queue_oldest_seconds': 'How long the oldest due background job has waited, by lane.',
+}
+
+
+def metrics_endpoint(request):
+    """Prometheus scrape endpoint, aggregated across worker processes"""
+    from djstripe.models import WebhookEventTrigger
+
+    allowed = settings.METRICS_ALLOWED_IPS
+    if '*' not in allowed and request.META.get('REMOTE_ADDR') not in allowed:
+        return HttpResponseForbidden()
+
+    merged = metrics.collect()
+    lookups = {}
+    for labels, (_, data) in merged.get('portal_cache_requests_total', {}).items():
+        labels = dict(labels)
+        hits, total = lookups.get(labels['namespace'], (0, 0))
+        hit = data['value'] if labels['result'] != 'misses' else 0
+        lookups[labels['namespace']] = (hits + hit, total + data['value'])
+    gauges = [
+        ('portal_cache_hit_ratio', {'namespace': namespace}, round(hits / total, 6))
+        for namespace, (hits, total) in sorted(lookups.items()) if total
+    ]
+    gauges.append((
+        'portal_stripe_webhook_queue_depth', {},
+        WebhookEventTrigger.objects.filter(valid=True, processed=False).count(),
+    ))
+    for lane, stats in jobs.queue_stats().items():
+        gauges.append(('portal_job_queue_depth', {'lane': lane}, stats['depth']))
+        gauges.append(('portal_job_queue_oldest_seconds', {'lane': lane}, stats['oldest_seconds']))
+    return HttpResponse(
+        metrics.render(merged, METRIC_HELP, gauges),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
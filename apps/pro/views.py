@@ -1,30 +1,36 @@
-import stripe
 from django.shortcuts import redirect, render
 from django.contrib.auth.decorators import login_required
-from djstripe import models as djstripe_models
-from djstripe.settings import djstripe_settings
 
 
 @login_required
-def dashboard(request):
+async def dashboard(request):
     """Display Pro dashboard with subscription status."""
+    from djstripe import models as djstripe_models
+
     context = {
         "customer": None,
         "subscriptions": [],
         "has_active_subscription": False,
     }
 
+    request.user = await request.auser()
     try:
-        customer = djstripe_models.Customer.objects.get(subscriber=request.user)
+        customer = await djstripe_models.Customer.objects.aget(subscriber=request.user)
+    except djstripe_models.Customer.DoesNotExist:
+        customer = None
+
+    if customer is not None:
+        subscriptions = [
+            subscription async for subscription in customer.subscriptions.filter(
+                status__in=["active", "trialing", "past_due"]
+            ).select_related("plan__product")
+        ]
         context["customer"] = customer
-        context["subscriptions"] = customer.subscriptions.filter(
-            status__in=["active", "trialing", "past_due"]
+        context["subscriptions"] = subscriptions
+        # Active/trialing is a subset of the rows already fetched
+        context["has_active_subscription"] = any(
+            subscription.status in ("active", "trialing") for subscription in subscriptions
         )
-        context["has_active_subscription"] = customer.subscriptions.filter(
-            status__in=["active", "trialing"]
-        ).exists()
-    except djstripe_models.Customer.DoesNotExist:
-        pass
 
     return render(request, "pro/dashboard.html", context)
 
@@ -32,16 +38,21 @@ def dashboard(request):
 @login_required
 def customer_portal(request):
     """Redirect user to Stripe Customer Portal for billing management."""
+    from djstripe import models as djstripe_models
+
+    from apps.core import stripe_client
+
     try:
         customer = djstripe_models.Customer.objects.get(subscriber=request.user)
     except djstripe_models.Customer.DoesNotExist:
         return redirect("pricing")
 
-    stripe.api_key = djstripe_settings.STRIPE_SECRET_KEY
-
-    portal_session = stripe.billing_portal.Session.create(
-        customer=customer.id,
-        return_url=request.build_absolute_uri("/pro/dashboard/"),
-    )
+    try:
+        portal_session = stripe_client.create_billing_portal_session(
+            customer.id,
+            return_url=request.build_absolute_uri("/pro/dashboard/"),
+        )
+    except stripe_client.StripeUnavailable:
+        return redirect("dashboard")
 
     return redirect(portal_session.url)
\ No newline at end of file
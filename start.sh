@@ -1,19 +1,31 @@
 #!/bin/bash
 
 # Local development script for Broader Django app
-# Sets DEBUG=TRUE and starts the Django development server
+# Defaults DEBUG=TRUE and starts the Django development server.
+# Run with DEBUG=false to exercise the production static pipeline
+# (hashed + precompressed assets, offline compressor bundles, WhiteNoise).
+# With DEBUG=false Django only answers the hosts in ALLOWED_HOSTS
+# (comma-separated, default localhost,127.0.0.1), e.g.
+#   DEBUG=false ALLOWED_HOSTS=localhost,portal.test ./start.sh
 
 echo "Starting Broader web app for local development..."
-echo "Setting DEBUG=TRUE for local development"
+export DEBUG=${DEBUG:-true}
+echo "Setting DEBUG=$DEBUG"
+export ALLOWED_HOSTS=${ALLOWED_HOSTS:-localhost,127.0.0.1}
 
 echo "Compiling Tailwind CSS..."
-npx @tailwindcss/cli -i static/input.css -o static/output.css --config tailwind.config.js
+npx @tailwindcss/cli -i static/input.css -o static/output.css --config tailwind.config.js --minify
 
 echo "Collecting static files..."
 python manage.py collectstatic --noinput
 
+if [ "$DEBUG" != "true" ]; then
+    # Must follow collectstatic: bundles reference the hashed file names
+    echo "Building compressor bundles offline..."
+    python manage.py compress --force
+fi
+
 echo "Waiting for CSS compilation to finish..."
 sleep 2
 
-export DEBUG=true
-python manage.py runserver
\ No newline at end of file
+python manage.py runserver